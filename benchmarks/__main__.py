@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import logging
+import argparse
+import warnings
+
+from .synthetic import make_media_folder, media_service_settings
+from .timing import BenchmarkResults, compare
+from . import bench_service, bench_clients
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Times MediaService and the MediaClient modes against synthetic media folders.'
+    )
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='files per synthetic media folder, one run per size (up to 1000000)')
+    parser.add_argument('--folders', type=int, default=1,
+                        help='subfolders the files are spread over (scanned recursively)')
+    parser.add_argument('--iterations', type=int, default=20, help='timed runs per benchmark')
+    parser.add_argument('--modes', nargs='*', default=bench_clients.CLIENT_MODES,
+                        choices=bench_clients.CLIENT_MODES, help='client modes to time (none to skip)')
+    parser.add_argument('--work-folder', default='./.benchmarks',
+                        help='where synthetic folders, catalogs and results are kept')
+    parser.add_argument('--output', default=None, help='results file (JSON)')
+    parser.add_argument('--compare', default=None, help='baseline results file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='slowdown of a median over the baseline that counts as a regression')
+    parser.add_argument('--min-delta-ms', type=float, default=0.1,
+                        help='smallest slowdown of a median (ms) that counts as a regression')
+    args = parser.parse_args()
+
+    warnings.filterwarnings('ignore')
+    logging.getLogger('streamlit').setLevel(logging.ERROR)
+
+    work_folder = os.path.abspath(args.work_folder)
+    os.makedirs(work_folder, exist_ok=True)
+
+    results = BenchmarkResults(config={
+        'sizes': args.sizes, 'folders': args.folders, 'iterations': args.iterations, 'modes': args.modes,
+    })
+
+    from media_server.media_service import MediaService
+
+    for files in args.sizes:
+        media_folder = make_media_folder(os.path.join(work_folder, 'media'), files, folders=args.folders)
+        run_folder = os.path.join(work_folder, f'run_{files}')
+        settings_file = media_service_settings(
+            os.path.join(work_folder, f'media_service_{files}.toml'), run_folder, {bench_service.SOURCE: media_folder}
+        )
+        # Client modes (and the media servers they start) pick the settings up from the environment
+        os.environ['MEDIA_SERVICE_SETTINGS'] = settings_file
+
+        ms = MediaService()
+        try:
+            sample = bench_service.run(results, ms, files, args.iterations)
+        finally:
+            ms.close()
+
+        for mode in args.modes:
+            client, teardown = bench_clients.client_for_mode(mode, work_folder)
+            try:
+                bench_clients.run(results, mode, client, files, sample, args.iterations)
+            finally:
+                teardown()
+
+    output = args.output or os.path.join(work_folder, 'results', time.strftime('%Y%m%dT%H%M%S.json'))
+    results.write(output)
+
+    if args.compare:
+        regressions = compare(results.results, args.compare, args.tolerance, args.min_delta_ms / 1000)
+        for result, base in regressions:
+            print(
+                f"REGRESSION {result['group']} {result['name']} {result['params']}: "
+                f"median {base['median'] * 1000:.3f} ms -> {result['median'] * 1000:.3f} ms"
+            )
+        if regressions:
+            sys.exit(1)
+        print('No regressions against', args.compare)
+
+if __name__ == '__main__':
+    main()
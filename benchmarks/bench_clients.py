@@ -0,0 +1,124 @@
+import os
+import sys
+import time
+import socket
+import subprocess
+
+from .timing import measure
+from .bench_service import SOURCE, SORTS, PAGE_SIZE
+
+CLIENT_MODES = ['service', 'remote', 'embedded']
+
+# Files fetched one by one per timed run (prefetches use the whole sample)
+MEDIA_FILES = 20
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_for_server(base_url: str, timeout: float = 60):
+    import requests
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f'{base_url}/media_sources', timeout=1).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'Media server at {base_url} did not start within {timeout}s')
+
+def start_media_server(host: str, port: int, log_file: str):
+    """
+    Runs media_server.py in a child process, which inherits MEDIA_SERVICE_SETTINGS from this one.
+    """
+    with open(log_file, 'ab') as log:
+        return subprocess.Popen(
+            [sys.executable, os.path.join('media_server', 'media_server.py'), host, str(port)],
+            stdout=log, stderr=subprocess.STDOUT
+        )
+
+def stop_media_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+def client_for_mode(mode: str, work_folder: str):
+    """
+    An initialized MediaClient for a client mode, and a function that tears it down.
+    """
+    import media_client
+
+    if mode == 'service':
+        client = media_client.MediaServiceClient()
+        client.initialize_media_backend()
+        return client, client.MEDIA_SERVICE.close
+
+    host, port = '127.0.0.1', free_port()
+    base_url = f'http://{host}:{port}'
+
+    if mode == 'remote':
+        proc = start_media_server(host, port, os.path.join(work_folder, 'media_server.log'))
+        wait_for_server(base_url)
+        client = media_client.RemoteMediaServerClient()
+        client.BASE_URL = base_url
+        client.initialize_media_backend()
+        return client, lambda: stop_media_server(proc)
+
+    if mode == 'embedded':
+        client = media_client.EmbeddedMediaServerClient()
+        client.MEDIA_SERVER_HOST, client.MEDIA_SERVER_PORT, client.BASE_URL = host, port, base_url
+        client.initialize_media_backend()
+        wait_for_server(base_url)
+        return client, client.shutdown
+
+    raise ValueError(f'Unknown client mode: {mode}')
+
+def run(results, mode: str, client, files: int, sample: list, iterations: int):
+    """
+    Times a MediaClient's listing and media calls the way client_app makes them, with its memo
+    and media cache cleared before each run so every call reaches the backend.
+    """
+    import media_client
+
+    params = {'files': files, 'mode': mode}
+    clear_memo = type(client).get_media_list.clear
+
+    results.add('client', 'get_media_list_version', params, measure(
+        lambda: client.get_media_list_version(SOURCE), iterations=iterations
+    ))
+
+    for sort in ('unsorted', 'date_desc'):
+        sort_args = {key: value for key, value in SORTS[sort].items() if key != 'sort_by_size_flag'}
+        results.add('client', 'get_media_list', {**params, 'sort': sort, 'limit': PAGE_SIZE}, measure(
+            lambda: client.get_media_list(
+                media_source=SOURCE, list_version=client.get_media_list_version(SOURCE), limit=PAGE_SIZE, **sort_args
+            ),
+            iterations=iterations, setup=clear_memo
+        ))
+
+    media_files = sample[:MEDIA_FILES]
+    media_params = {**params, 'sample_files': len(media_files)}
+
+    def get_media():
+        for media_file in media_files:
+            client.get_media(SOURCE, media_file)
+
+    def get_media_b64():
+        for media_file in media_files:
+            client.get_media_b64(SOURCE, media_file)
+
+    results.add('client', 'get_media', media_params, measure(
+        get_media, iterations=iterations, setup=media_client.MEDIA_CACHE.clear
+    ))
+    results.add('client', 'get_media_cached', media_params, measure(get_media, iterations=iterations))
+    results.add('client', 'get_media_b64', media_params, measure(
+        get_media_b64, iterations=iterations, setup=media_client.MEDIA_CACHE.clear
+    ))
+    results.add('client', 'prefetch_media', {**params, 'sample_files': len(sample)}, measure(
+        lambda: client.prefetch_media(SOURCE, sample),
+        iterations=iterations, setup=media_client.MEDIA_CACHE.clear
+    ))
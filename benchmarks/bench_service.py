@@ -0,0 +1,108 @@
+import os
+import random
+
+from .timing import measure
+
+SOURCE = 'BENCH'
+
+# media_list sort orders, as the keyword arguments that select them
+SORTS = {
+    'unsorted': {},
+    'name_asc': dict(sort_flag=True, sort_by_date_flag=False, ascending=True),
+    'date_desc': dict(sort_flag=True, sort_by_date_flag=True, ascending=False),
+    'size_desc': dict(sort_flag=True, sort_by_size_flag=True, ascending=False),
+}
+
+# Substring (case-insensitive and not), prefix and glob filters over the synthetic names
+FILTERS = ['wallpaper', 'Holiday', 'IMG_000*', '*.png', '*sunset*unsplash*']
+
+PAGE_SIZE = 100
+SAMPLE_FILES = 100
+
+def _forget_listings(ms, source: str, defer_index: bool):
+    """
+    Drops a source's built listings and sort index, as happens after its folder changes. With defer_index
+    the next limited query is answered by top-k selection, otherwise it rebuilds the sort index.
+    """
+    catalog = ms._catalog(source)
+    catalog._sort_index = None
+    catalog._sort_index_deferred = None if defer_index else catalog.version
+    ms._media_list_cache.clear()
+
+def _forget_catalog(ms, source: str):
+    catalog = ms._catalogs.pop(source, None)
+    if catalog:
+        catalog.close()
+        os.remove(catalog.catalog_file)
+
+def run(results, ms, files: int, iterations: int):
+    """
+    Times MediaService listing, sorting, filtering, byte reads and base64 encoding for a source of files files.
+    """
+    params = {'files': files}
+
+    results.add('service', 'catalog_build', params, measure(
+        lambda: ms.media_list_version(SOURCE),
+        iterations=min(iterations, 3), warmup=0, setup=lambda: _forget_catalog(ms, SOURCE)
+    ))
+    catalog = ms._catalog(SOURCE)
+    results.add('service', 'catalog_rescan', params, measure(
+        lambda: catalog.refresh(force=True), iterations=min(iterations, 5), warmup=0
+    ))
+    results.add('service', 'media_list_version', params, measure(
+        lambda: ms.media_list_version(SOURCE), iterations=iterations
+    ))
+
+    for sort, sort_args in SORTS.items():
+        first_page = lambda: ms.media_list(SOURCE, limit=PAGE_SIZE, **sort_args)
+        sort_params = {**params, 'sort': sort, 'limit': PAGE_SIZE}
+
+        results.add('service', 'media_list_page_top_k', sort_params, measure(
+            first_page, iterations=iterations, warmup=0, setup=lambda: _forget_listings(ms, SOURCE, True)
+        ))
+        results.add('service', 'media_list_page_build_index', sort_params, measure(
+            first_page, iterations=min(iterations, 5), warmup=0, setup=lambda: _forget_listings(ms, SOURCE, False)
+        ))
+        results.add('service', 'media_list_page', sort_params, measure(first_page, iterations=iterations))
+
+        next_cursor = ms.media_list(SOURCE, limit=PAGE_SIZE, **sort_args)['next_cursor']
+        if next_cursor:
+            results.add('service', 'media_list_next_page', sort_params, measure(
+                lambda: ms.media_list(SOURCE, limit=PAGE_SIZE, cursor=next_cursor, **sort_args),
+                iterations=iterations
+            ))
+
+        results.add('service', 'media_list_full', {**params, 'sort': sort}, measure(
+            lambda: ms.media_list(SOURCE, **sort_args), iterations=min(iterations, 5)
+        ))
+
+    for media_filter in FILTERS:
+        filtered_page = lambda: ms.media_list(SOURCE, filter_string=media_filter, limit=PAGE_SIZE, **SORTS['date_desc'])
+        filter_params = {**params, 'filter': media_filter, 'sort': 'date_desc', 'limit': PAGE_SIZE}
+        # Built listings are dropped before each run, but the sort and name indexes are kept
+        results.add('service', 'media_list_filter', filter_params, measure(
+            filtered_page, iterations=iterations, setup=ms._media_list_cache.clear
+        ))
+        results.add('service', 'media_list_filter_cached', filter_params, measure(filtered_page, iterations=iterations))
+
+    sample = ms.media_list(SOURCE)['media_list']
+    sample = random.Random(files).sample(sample, min(SAMPLE_FILES, len(sample)))
+    sample_params = {**params, 'sample_files': len(sample)}
+
+    def read_bytes():
+        for media_file in sample:
+            ms.media(SOURCE, media_file, encode=False)
+
+    def read_base64():
+        for media_file in sample:
+            ms.media(SOURCE, media_file, encode=True)
+
+    def image_base64():
+        for media_file in sample:
+            ms._image_base64(ms.media_full_path(SOURCE, media_file)['media_full_path'])
+
+    results.add('service', 'media_bytes', sample_params, measure(read_bytes, iterations=iterations))
+    results.add('service', 'media_base64', sample_params, measure(read_base64, iterations=iterations))
+    results.add('service', '_image_base64', sample_params, measure(image_base64, iterations=iterations))
+
+    return sample
@@ -0,0 +1,263 @@
+import os
+import time
+import random
+import asyncio
+import argparse
+import threading
+from urllib.parse import quote
+
+import psutil
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from .timing import BenchmarkResults, compare
+from .bench_clients import free_port, wait_for_server, start_media_server, stop_media_server
+from .synthetic import make_media_folder, media_service_settings
+
+ENDPOINTS = ['media', 'media_list', 'media_sources']
+
+# A grid load is a listing followed by a page of images, with the occasional sources refresh
+DEFAULT_MIX = 'media=20,media_list=1,media_sources=0.2'
+
+def percentile(samples: list, p: float):
+    return samples[min(len(samples) - 1, int(len(samples) * p))] if samples else 0.0
+
+def parse_mix(mix: str):
+    weights = {}
+    for part in mix.split(','):
+        endpoint, _, weight = part.partition('=')
+        if endpoint.strip() not in ENDPOINTS:
+            raise ValueError(f'Unknown endpoint in mix: {endpoint} (choose from {ENDPOINTS})')
+        weights[endpoint.strip()] = float(weight)
+    return weights
+
+class RssSampler():
+
+    def __init__(self, pid: int, interval: float = 0.25):
+        """
+        Samples the resident memory of a process and its children (e.g. rendition workers) on a thread.
+        """
+        self.process = psutil.Process(pid)
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _rss(self):
+        processes = [self.process]
+        try:
+            processes += self.process.children(recursive=True)
+        except psutil.Error:
+            pass
+        rss = 0
+        for process in processes:
+            try:
+                rss += process.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.samples.append(self._rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+class Session():
+
+    def __init__(self, client, base_url: str, source: str, weights: dict, page_size: int, width, rng: random.Random):
+        """
+        One simulated client app session: it lists a page of the source and then loads that page's
+        images, picking each next request by the traffic mix weights.
+        """
+        self.client = client
+        self.base_url = base_url
+        self.source = quote(source)
+        self.endpoints, self.weights = list(weights), list(weights.values())
+        self.page_size = page_size
+        self.width = width
+        self.rng = rng
+        self.page = []
+        self.next_media = 0
+
+    async def request(self):
+        endpoint = self.rng.choices(self.endpoints, self.weights)[0]
+        if endpoint == 'media' and not self.page:
+            endpoint = 'media_list'
+
+        if endpoint == 'media_list':
+            url = f'{self.base_url}/media_list/{self.source}?limit={self.page_size}&sort_flag=true'
+        elif endpoint == 'media_sources':
+            url = f'{self.base_url}/media_sources'
+        else:
+            media_file = self.page[self.next_media % len(self.page)]
+            self.next_media += 1
+            url = f'{self.base_url}/media/{self.source}/{quote(media_file)}'
+            if self.width:
+                url = f'{url}?width={self.width}'
+
+        start = time.perf_counter()
+        response = await self.client.get(url)
+        content = response.content
+        latency = time.perf_counter() - start
+
+        if endpoint == 'media_list' and response.status_code == 200:
+            self.page = response.json()['media_list']
+            self.next_media = 0
+        return endpoint, response.status_code, latency, len(content)
+
+async def run_level(base_url: str, source: str, concurrency: int, duration: float, warmup: float, args):
+    """
+    Runs concurrency sessions against the server for warmup + duration seconds, returning the
+    (endpoint, status, latency, bytes) of every request completed after the warmup.
+    """
+    weights = parse_mix(args.mix)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    records = []
+
+    async with httpx.AsyncClient(limits=limits, timeout=args.timeout) as client:
+        loop = asyncio.get_running_loop()
+        measure_from = loop.time() + warmup
+        stop_at = measure_from + duration
+
+        async def session_loop(i):
+            session = Session(client, base_url, source, weights, args.page_size, args.width, random.Random(i))
+            while loop.time() < stop_at:
+                try:
+                    record = await session.request()
+                except httpx.HTTPError as e:
+                    record = (type(e).__name__, None, 0.0, 0)
+                if loop.time() >= measure_from:
+                    records.append(record)
+
+        await asyncio.gather(*(session_loop(i) for i in range(concurrency)))
+
+    return records
+
+def summarize(records: list, duration: float):
+    latencies = sorted(latency for _, status, latency, _ in records if status and status < 400)
+    errors = sum(1 for _, status, _, _ in records if not status or status >= 400)
+    return {
+        'requests': len(records),
+        'errors': errors,
+        'requests_per_sec': len(records) / duration,
+        'bytes_per_sec': sum(size for _, _, _, size in records) / duration,
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'median': percentile(latencies, 0.50),
+        'max': latencies[-1] if latencies else 0.0,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.load',
+        description='Starts the media server under uvicorn and measures it under rising concurrent load.'
+    )
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64],
+                        help='simulated sessions, one run per level')
+    parser.add_argument('--duration', type=float, default=10, help='measured seconds per level')
+    parser.add_argument('--warmup', type=float, default=2, help='unmeasured seconds before each level')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'endpoint weights (default {DEFAULT_MIX})')
+    parser.add_argument('--page-size', type=int, default=50, help='media files per listed page')
+    parser.add_argument('--width', type=int, default=None, help='request renditions of this width (needs a --source of real images)')
+    parser.add_argument('--timeout', type=float, default=30, help='request timeout (seconds)')
+    parser.add_argument('--source', default=None,
+                        help='media source to load (default: a synthetic folder of --files files)')
+    parser.add_argument('--files', type=int, default=10000, help='files in the synthetic media folder')
+    parser.add_argument('--base-url', default=None, help='load an already running server instead of starting one')
+    parser.add_argument('--work-folder', default='./.benchmarks',
+                        help='where synthetic folders, server logs and results are kept')
+    parser.add_argument('--output', default=None, help='results file (JSON)')
+    parser.add_argument('--compare', default=None, help='baseline results file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='slowdown of a median over the baseline that counts as a regression')
+    args = parser.parse_args()
+
+    if httpx is None:
+        parser.error('the load generator needs httpx (pip install -r benchmarks/requirements.txt)')
+
+    work_folder = os.path.abspath(args.work_folder)
+    os.makedirs(work_folder, exist_ok=True)
+
+    source = args.source
+    if source is None:
+        source = 'BENCH'
+        media_folder = make_media_folder(os.path.join(work_folder, 'media'), args.files)
+        os.environ['MEDIA_SERVICE_SETTINGS'] = media_service_settings(
+            os.path.join(work_folder, f'media_service_{args.files}.toml'),
+            os.path.join(work_folder, f'run_{args.files}'), {source: media_folder}
+        )
+
+    proc = None
+    base_url = args.base_url
+    if base_url is None:
+        host, port = '127.0.0.1', free_port()
+        base_url = f'http://{host}:{port}'
+        proc = start_media_server(host, port, os.path.join(work_folder, 'media_server.log'))
+
+    results = BenchmarkResults(config={
+        'concurrency': args.concurrency, 'duration': args.duration, 'mix': args.mix,
+        'page_size': args.page_size, 'width': args.width, 'source': source, 'files': args.files,
+    })
+
+    try:
+        wait_for_server(base_url)
+        print(f"{'sessions':>8} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7} {'rss MB':>8}")
+        for concurrency in args.concurrency:
+            sampler = RssSampler(proc.pid) if proc else None
+            if sampler:
+                with sampler:
+                    records = asyncio.run(run_level(base_url, source, concurrency, args.duration, args.warmup, args))
+            else:
+                records = asyncio.run(run_level(base_url, source, concurrency, args.duration, args.warmup, args))
+            rss = max(sampler.samples) / (1024 * 1024) if sampler and sampler.samples else None
+
+            overall = summarize(records, args.duration)
+            print(
+                f"{concurrency:>8} {overall['requests_per_sec']:>9.1f} {overall['p50'] * 1000:>9.2f} "
+                f"{overall['p95'] * 1000:>9.2f} {overall['p99'] * 1000:>9.2f} {overall['errors']:>7} "
+                f"{rss if rss is not None else float('nan'):>8.1f}"
+            )
+
+            results.results.append({
+                'group': 'load', 'name': 'all', 'params': {'concurrency': concurrency},
+                **overall, 'server_rss_max_mb': rss,
+            })
+            for endpoint in ENDPOINTS:
+                endpoint_records = [record for record in records if record[0] == endpoint]
+                if endpoint_records:
+                    results.results.append({
+                        'group': 'load', 'name': endpoint, 'params': {'concurrency': concurrency},
+                        **summarize(endpoint_records, args.duration),
+                    })
+    finally:
+        if proc:
+            stop_media_server(proc)
+
+    output = args.output or os.path.join(work_folder, 'results', time.strftime('load_%Y%m%dT%H%M%S.json'))
+    results.write(output)
+
+    if args.compare:
+        regressions = compare(results.results, args.compare, args.tolerance)
+        for result, base in regressions:
+            print(
+                f"REGRESSION {result['name']} {result['params']}: "
+                f"p50 {base['median'] * 1000:.3f} ms -> {result['median'] * 1000:.3f} ms"
+            )
+        if regressions:
+            raise SystemExit(1)
+        print('No regressions against', args.compare)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import os
+import time
+import shutil
+import asyncio
+import argparse
+from urllib.parse import quote
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from .load import percentile
+from .bench_clients import free_port, wait_for_server, start_media_server, stop_media_server
+from .synthetic import make_media_folder, media_service_settings
+
+SLOW_SOURCE = 'SLOW'
+MEDIA_SOURCE = 'MEDIA'
+
+async def run_check(base_url: str, sessions: int, timeout: float):
+    """
+    Lists the slow source cold (a full catalog scan) while sessions clients keep fetching media from
+    the other source, returning the listing's duration and the latencies of the media requests that
+    started while it was in flight (a request stalled behind the listing only finishes after it).
+    """
+    limits = httpx.Limits(max_connections=sessions + 1, max_keepalive_connections=sessions + 1)
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        response = await client.get(f'{base_url}/media_list/{MEDIA_SOURCE}?limit=100')
+        response.raise_for_status()
+        media_files = response.json()['media_list']
+        # Warm the connections, so the latencies measured are only the server's
+        await asyncio.gather(*(client.get(f'{base_url}/media/{MEDIA_SOURCE}/{quote(media_files[0])}') for _ in range(sessions)))
+
+        listing_done = asyncio.Event()
+        listing_start = None
+        requests = []  # (sent, latency)
+
+        async def media_session(i):
+            n = i
+            while not listing_done.is_set():
+                start = time.perf_counter()
+                response = await client.get(f'{base_url}/media/{MEDIA_SOURCE}/{quote(media_files[n % len(media_files)])}')
+                response.raise_for_status()
+                requests.append((start, time.perf_counter() - start))
+                n += sessions
+
+        async def slow_listing():
+            nonlocal listing_start
+            # Give the media sessions a head start, so the listing lands among requests in flight
+            await asyncio.sleep(0.2)
+            listing_start = time.perf_counter()
+            try:
+                response = await client.get(f'{base_url}/media_list/{SLOW_SOURCE}?limit=100&sort_flag=true')
+                response.raise_for_status()
+                return time.perf_counter() - listing_start
+            finally:
+                listing_done.set()
+
+        listing_seconds, *_ = await asyncio.gather(slow_listing(), *(media_session(i) for i in range(sessions)))
+
+    return listing_seconds, sorted(latency for sent, latency in requests if sent >= listing_start)
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.responsiveness',
+        description=(
+            'Times the /media requests the media server serves while a slow /media_list (a cold scan of '
+            'a large source) is in flight.'
+        )
+    )
+    parser.add_argument('--files', type=int, default=200000, help='files in the slow source (more make a slower listing)')
+    parser.add_argument('--sessions', type=int, default=4, help='concurrent /media clients')
+    parser.add_argument('--timeout', type=float, default=120, help='request timeout (seconds)')
+    parser.add_argument('--work-folder', default='./.benchmarks', help='where synthetic folders and server logs are kept')
+    args = parser.parse_args()
+
+    if httpx is None:
+        parser.error('the responsiveness benchmark needs httpx (pip install -r benchmarks/requirements.txt)')
+
+    work_folder = os.path.abspath(args.work_folder)
+    os.makedirs(work_folder, exist_ok=True)
+
+    media_folder = make_media_folder(os.path.join(work_folder, 'media'), 1000)
+    slow_folder = make_media_folder(os.path.join(work_folder, 'media'), args.files)
+    # A fresh run folder, so the slow source has no catalog and its first listing scans every file
+    run_folder = os.path.join(work_folder, 'run_responsiveness')
+    shutil.rmtree(run_folder, ignore_errors=True)
+    os.environ['MEDIA_SERVICE_SETTINGS'] = media_service_settings(
+        os.path.join(work_folder, 'media_service_responsiveness.toml'), run_folder,
+        {MEDIA_SOURCE: media_folder, SLOW_SOURCE: slow_folder}
+    )
+
+    host, port = '127.0.0.1', free_port()
+    base_url = f'http://{host}:{port}'
+    proc = start_media_server(host, port, os.path.join(work_folder, 'media_server.log'))
+    try:
+        wait_for_server(base_url)
+        listing_seconds, latencies = asyncio.run(run_check(base_url, args.sessions, args.timeout))
+    finally:
+        stop_media_server(proc)
+
+    print(f'/media_list of {args.files} files (cold): {listing_seconds * 1000:.1f} ms')
+    if latencies:
+        print(
+            f'/media during the listing: {len(latencies)} requests, p50 {percentile(latencies, 0.5) * 1000:.2f} ms, '
+            f'p99 {percentile(latencies, 0.99) * 1000:.2f} ms, max {latencies[-1] * 1000:.2f} ms'
+        )
+    else:
+        print('/media during the listing: no requests completed')
+
+if __name__ == '__main__':
+    main()
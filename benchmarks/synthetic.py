@@ -0,0 +1,101 @@
+import os
+import json
+import time
+import random
+import shutil
+
+MEDIA_EXTENSIONS = ['jpg', 'jpeg', 'png', 'gif']
+# Files the catalog should skip, so filtering by type is part of what gets measured
+OTHER_EXTENSIONS = ['txt', 'json', 'mp4']
+
+NAME_PATTERNS = [
+    'IMG_{i:07d}',
+    'DSC{i:07d}',
+    'wallpaper{i:07d}',
+    '{word}-{i:07d}-unsplash',
+    'Holiday {word} {i:07d}',
+]
+WORDS = ['beach', 'city', 'forest', 'mountain', 'night', 'portrait', 'river', 'snow', 'street', 'sunset']
+
+# Enough of each format's signature that the files sniff as the type their extension claims
+FILE_HEADERS = {
+    'jpg': b'\xff\xd8\xff\xe0\x00\x10JFIF\x00',
+    'jpeg': b'\xff\xd8\xff\xe0\x00\x10JFIF\x00',
+    'png': b'\x89PNG\r\n\x1a\n',
+    'gif': b'GIF89a',
+}
+
+SYNTHETIC_SPEC_FILE = '.synthetic.json'
+
+def make_media_folder(
+    root: str, count: int, folders: int = 1, seed: int = 0,
+    media_ratio: float = 0.9, max_size: int = 8 * 1024 * 1024
+):
+    """
+    Creates a folder of count synthetic files (mostly media, some not) with realistic names, a
+    log-normal spread of sizes (median ~60KB, capped at max_size) and mtimes over the last five
+    years, spread over folders subfolders when folders > 1. Files are sparse, so a million of them
+    take little disk space. A folder already generated from the same spec is reused.
+    """
+    spec = {'count': count, 'folders': folders, 'seed': seed, 'media_ratio': media_ratio, 'max_size': max_size}
+    folder = os.path.abspath(os.path.join(root, f'media_{count}_{folders}_{seed}'))
+    spec_file = os.path.join(folder, SYNTHETIC_SPEC_FILE)
+    try:
+        with open(spec_file) as f:
+            if json.load(f) == spec:
+                return folder
+    except (FileNotFoundError, ValueError):
+        pass
+
+    print(f'Generating {count} synthetic files in {folder}...')
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+
+    rng = random.Random(seed)
+    now = time.time()
+    for i in range(count):
+        subfolder = os.path.join(folder, f'folder{i % folders:04d}') if folders > 1 else folder
+        if i < folders:
+            os.makedirs(subfolder, exist_ok=True)
+
+        if rng.random() < media_ratio:
+            extension = rng.choice(MEDIA_EXTENSIONS)
+        else:
+            extension = rng.choice(OTHER_EXTENSIONS)
+        name = rng.choice(NAME_PATTERNS).format(i=i, word=rng.choice(WORDS))
+        size = max(64, min(max_size, int(rng.lognormvariate(11, 1.2))))
+
+        path = os.path.join(subfolder, f'{name}.{extension}')
+        with open(path, 'wb') as f:
+            f.write(FILE_HEADERS.get(extension, b''))
+            f.truncate(size)
+        mtime = now - rng.random() * 5 * 365 * 24 * 3600
+        os.utime(path, (mtime, mtime))
+
+    with open(spec_file, 'w') as f:
+        json.dump(spec, f)
+
+    return folder
+
+def media_service_settings(settings_file: str, work_folder: str, sources: dict):
+    """
+    Writes a media service settings file serving sources ({source: media_folder}) recursively,
+    with its catalogs and renditions kept under work_folder. Returns settings_file.
+    """
+    lines = [
+        f'MEDIA_TYPES = {json.dumps(["image/" + extension for extension in MEDIA_EXTENSIONS])}',
+        f'CATALOG_FOLDER = {json.dumps(os.path.join(work_folder, "catalog"))}',
+        f'RENDITIONS_FOLDER = {json.dumps(os.path.join(work_folder, "renditions"))}',
+        '',
+    ]
+    for source, media_folder in sources.items():
+        lines += [
+            f'[MEDIA_SOURCES.{json.dumps(source)}]',
+            f'media_folder = {json.dumps(media_folder)}',
+            "media_filter = ''",
+            'recursive = true',
+            '',
+        ]
+    with open(settings_file, 'w') as f:
+        f.write('\n'.join(lines))
+    return settings_file
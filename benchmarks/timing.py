@@ -0,0 +1,94 @@
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+from statistics import mean, median
+
+def measure(fn, iterations: int = 20, warmup: int = 2, setup=None):
+    """
+    Times fn() over iterations runs (after warmup untimed runs), calling setup() untimed before
+    each one when given. Returns summary statistics in seconds.
+    """
+    for _ in range(warmup):
+        if setup:
+            setup()
+        fn()
+
+    samples = []
+    for _ in range(iterations):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+
+    samples.sort()
+    return {
+        'iterations': len(samples),
+        'min': samples[0],
+        'median': median(samples),
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'mean': mean(samples),
+        'max': samples[-1],
+        'ops_per_sec': (1 / median(samples)) if median(samples) > 0 else None,
+    }
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+class BenchmarkResults():
+
+    def __init__(self, config: dict):
+        """
+        Results of one benchmark run, with enough about the run's environment to compare runs.
+        """
+        self.metadata = {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'git_commit': _git_commit(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'config': config,
+        }
+        self.results = []
+
+    def add(self, group: str, name: str, params: dict, stats: dict):
+        result = {'group': group, 'name': name, 'params': params, **stats}
+        self.results.append(result)
+        print(
+            f"{group:<10} {name:<36} {json.dumps(params, sort_keys=True):<48} "
+            f"median {stats['median'] * 1000:10.3f} ms   p95 {stats['p95'] * 1000:10.3f} ms"
+        )
+        return result
+
+    def write(self, results_file: str):
+        os.makedirs(os.path.dirname(os.path.abspath(results_file)), exist_ok=True)
+        with open(results_file, 'w') as f:
+            json.dump({'metadata': self.metadata, 'results': self.results}, f, indent=2)
+        print('Results written to', results_file)
+
+def result_key(result: dict):
+    return (result['group'], result['name'], json.dumps(result['params'], sort_keys=True))
+
+def compare(results: list, baseline_file: str, tolerance: float = 0.25, min_delta: float = 0.0001):
+    """
+    Results whose median is more than tolerance (and min_delta seconds) slower than the same benchmark
+    in baseline_file, as (result, baseline result) pairs. min_delta keeps timer noise in sub-millisecond
+    benchmarks from counting as a regression.
+    """
+    with open(baseline_file) as f:
+        baseline = {result_key(result): result for result in json.load(f)['results']}
+
+    regressions = []
+    for result in results:
+        base = baseline.get(result_key(result), None)
+        if base and result['median'] > base['median'] * (1 + tolerance) and result['median'] - base['median'] > min_delta:
+            regressions.append((result, base))
+    return regressions
@@ -55,6 +55,16 @@ if 'PRESET_DEFAULT_INDEX' not in state:
 
 if 'PACKED_LAYOUT' not in state:
     state.PACKED_LAYOUT = False
+if 'CONTACT_SHEETS' not in state:
+    state.CONTACT_SHEETS = False
+if 'CONTACT_SHEET_ROWS' not in state:
+    state.CONTACT_SHEET_ROWS = int(st.secrets['DISPLAY_OPTIONS'].get('contact_sheet_rows', 10))
+if 'PAGED_GRID' not in state:
+    state.PAGED_GRID = False
+if 'GRID_PAGE_ROWS' not in state:
+    state.GRID_PAGE_ROWS = int(st.secrets['DISPLAY_OPTIONS'].get('grid_page_rows', 5))
+if 'GRID_PAGE' not in state:
+    state.GRID_PAGE = 0
 if 'SHOW_CAPTIONS' not in state:
     state.SHOW_CAPTIONS = False
 
@@ -103,7 +113,9 @@ def _recycle_media_service_cb():
 
     state.USE_PRESET = True
     state.PACKED_LAYOUT = False
+    state.CONTACT_SHEETS = False
     state.SHOW_CAPTIONS = False
+    state.GRID_PAGE = 0
 
 def _set_media_source_cb():
     mc.MEDIA_SOURCE = state['media_source']
@@ -112,17 +124,25 @@ def _set_media_source_cb():
     mc.MEDIA_LIST_SORT = True
     mc.MEDIA_LIST_DATE_SORT = True
     mc.MEDIA_LIST_SORT_ASC = False
-    mc.MEDIA_LIST, mc.MEDIA_FILTER = mc.get_media_list(
+    mc.MEDIA_LIST_SIZE_SORT = False
+    mc.MEDIA_FILTER_IGNORE_CASE = False
+    mc.MEDIA_LIST, mc.MEDIA_FILTER, _next_cursor = mc.get_media_list(
         media_source=mc.MEDIA_SOURCE, 
         media_filter=mc.MEDIA_FILTER, 
         sort_flag=mc.MEDIA_LIST_SORT,
         sort_by_date_flag=mc.MEDIA_LIST_DATE_SORT,
-        ascending=mc.MEDIA_LIST_SORT_ASC
+        ascending=mc.MEDIA_LIST_SORT_ASC,
+        list_version=mc.get_media_list_version(mc.MEDIA_SOURCE),
+        limit=int(mc.NUM_IMAGES),
+        sort_by_size_flag=mc.MEDIA_LIST_SIZE_SORT,
+        ignore_case=mc.MEDIA_FILTER_IGNORE_CASE
     )
 
     state.USE_PRESET = True
     state.PACKED_LAYOUT = False
+    state.CONTACT_SHEETS = False
     state.SHOW_CAPTIONS = False
+    state.GRID_PAGE = 0
 
 def _set_media_controls_cb():
     mc.MEDIA_SOURCE = state['media_source']
@@ -131,17 +151,26 @@ def _set_media_controls_cb():
     mc.MEDIA_LIST_SORT = state['media_list_sort']
     mc.MEDIA_LIST_DATE_SORT = state['media_list_date_sort']
     mc.MEDIA_LIST_SORT_ASC = state['media_list_sort_asc']
-    mc.MEDIA_LIST, mc.MEDIA_FILTER = mc.get_media_list(
+    mc.MEDIA_LIST_SIZE_SORT = state['media_list_size_sort']
+    mc.MEDIA_FILTER_IGNORE_CASE = state['media_filter_ignore_case']
+    mc.MEDIA_LIST, mc.MEDIA_FILTER, _next_cursor = mc.get_media_list(
         media_source=mc.MEDIA_SOURCE, 
         media_filter=mc.MEDIA_FILTER, 
         sort_flag=mc.MEDIA_LIST_SORT,
         sort_by_date_flag=mc.MEDIA_LIST_DATE_SORT,
-        ascending=mc.MEDIA_LIST_SORT_ASC
+        ascending=mc.MEDIA_LIST_SORT_ASC,
+        list_version=mc.get_media_list_version(mc.MEDIA_SOURCE),
+        limit=int(mc.NUM_IMAGES),
+        sort_by_size_flag=mc.MEDIA_LIST_SIZE_SORT,
+        ignore_case=mc.MEDIA_FILTER_IGNORE_CASE
     )
 
     state.USE_PRESET = state['use_preset']
     state.PACKED_LAYOUT = state['packed_layout']
+    state.CONTACT_SHEETS = state['contact_sheets']
+    state.PAGED_GRID = state['paged_grid']
     state.SHOW_CAPTIONS = state['show_captions']
+    state.GRID_PAGE = 0
     state.NUM_COLS = state['num_cols']
     state.IMG_W = state['img_w']
 
@@ -149,6 +178,19 @@ def _set_media_controls_cb():
 def _set_packed_layout_cb():
     state.PACKED_LAYOUT = state['packed_layout']
 
+def _set_contact_sheets_cb():
+    state.CONTACT_SHEETS = state['contact_sheets']
+
+def _set_paged_grid_cb():
+    state.PAGED_GRID = state['paged_grid']
+    state.GRID_PAGE = 0
+
+def _prev_grid_page_cb():
+    state.GRID_PAGE = max(0, state.GRID_PAGE - 1)
+
+def _next_grid_page_cb():
+    state.GRID_PAGE += 1
+
 def _set_use_preset_cb():
     state.USE_PRESET = state['use_preset']
 
@@ -201,12 +243,14 @@ def main():
 
         with st.expander('📅 Media settings', expanded=False):
             with st.form(key='media_controls_form', clear_on_submit=False):
-                mc.MEDIA_FILTER = st.text_input('🔎 Filter keyword', mc.MEDIA_FILTER, key='media_filter', help='Keyword will be used to match filenames')
+                mc.MEDIA_FILTER = st.text_input('🔎 Filter keyword', mc.MEDIA_FILTER, key='media_filter', help='Matches filenames containing the keyword (case-sensitive unless ignoring case), or use * ? [] wildcards to match whole names, e.g. IMG_*')
+                mc.MEDIA_FILTER_IGNORE_CASE = st.checkbox('Ignore case', mc.MEDIA_FILTER_IGNORE_CASE, key='media_filter_ignore_case')
                 c1, c2 = st.columns(2)
                 mc.MEDIA_LIST_SORT = c1.checkbox('Sort', mc.MEDIA_LIST_SORT, key='media_list_sort')
                 mc.MEDIA_LIST_SORT_ASC = c2.checkbox('Ascending', mc.MEDIA_LIST_SORT_ASC, disabled=(not mc.MEDIA_LIST_SORT), key='media_list_sort_asc')
                 mc.MEDIA_LIST_DATE_SORT = c1.checkbox('By date', mc.MEDIA_LIST_DATE_SORT, disabled=(not mc.MEDIA_LIST_SORT), key='media_list_date_sort')
-                st.caption('Sort by date and ascending only work if sort is enabled')
+                mc.MEDIA_LIST_SIZE_SORT = c2.checkbox('By size', mc.MEDIA_LIST_SIZE_SORT, disabled=(not mc.MEDIA_LIST_SORT), key='media_list_size_sort')
+                st.caption('Sort by date, by size and ascending only work if sort is enabled (by size wins over by date)')
                 if st.form_submit_button('Apply', on_click=_set_media_controls_cb):
                     st.experimental_rerun()
 
@@ -217,6 +261,18 @@ def main():
                 help='Pack images or display in a regular grid',
                 key='packed_layout'
             )
+            state.CONTACT_SHEETS = st.checkbox(
+                'Contact sheets', state.CONTACT_SHEETS,
+                on_change=_set_contact_sheets_cb,
+                help='Render each block of grid rows as one composited image (media folders only, no captions)',
+                key='contact_sheets'
+            )
+            state.PAGED_GRID = st.checkbox(
+                'Paged grid', state.PAGED_GRID,
+                on_change=_set_paged_grid_cb,
+                help=f'Render one page of {state.GRID_PAGE_ROWS} grid rows at a time, with Previous and Next buttons to move through the rest',
+                key='paged_grid'
+            )
             state.SHOW_CAPTIONS = st.checkbox('Show captions', state.SHOW_CAPTIONS, on_change=_set_captions_cb, key='show_captions')
             state.USE_PRESET = st.checkbox('Use presets', state.USE_PRESET, on_change=_set_use_preset_cb, key='use_preset')
             if state.USE_PRESET:
@@ -259,25 +315,75 @@ def main():
     num_cols = int(state.NUM_COLS)
     img_w = int(state.IMG_W)
 
-    media_list, _media_filter = mc.get_media_list(
+    # A limit of zero pulls the whole list, otherwise only the first page of num_images is transferred
+    working_media_list, _media_filter, _next_cursor = mc.get_media_list(
         media_source=mc.MEDIA_SOURCE,
         media_filter=mc.MEDIA_FILTER,
         sort_flag=mc.MEDIA_LIST_SORT,
         sort_by_date_flag=mc.MEDIA_LIST_DATE_SORT,
-        ascending=mc.MEDIA_LIST_SORT_ASC
+        ascending=mc.MEDIA_LIST_SORT_ASC,
+        list_version=mc.get_media_list_version(mc.MEDIA_SOURCE),
+        limit=num_images,
+        sort_by_size_flag=mc.MEDIA_LIST_SIZE_SORT,
+        ignore_case=mc.MEDIA_FILTER_IGNORE_CASE
+    )
+
+    media_source = mc.MEDIA_SOURCES[mc.MEDIA_SOURCE]
+    contact_sheets = state.CONTACT_SHEETS and (media_source.get('media_folder', None) or media_source.get('cache_links', False))
+    sheet_size = num_cols * int(state.CONTACT_SHEET_ROWS)
+
+    # Only the listing's names are held for the rest of the pages, so a rerun fetches and renders
+    # one page of images however large Max images is
+    first, last = 0, len(working_media_list)
+    if state.PAGED_GRID:
+        page_size = num_cols * int(state.GRID_PAGE_ROWS)
+        if contact_sheets:
+            # Whole sheets per page, as the server composites them from the start of the listing
+            page_size = -(-page_size // sheet_size) * sheet_size
+        num_pages = max(1, -(-len(working_media_list) // page_size))
+        state.GRID_PAGE = min(int(state.GRID_PAGE), num_pages - 1)
+        first, last = state.GRID_PAGE * page_size, min(len(working_media_list), (state.GRID_PAGE + 1) * page_size)
+
+        c1, c2, c3 = st.columns([1, 4, 1])
+        c1.button('◀ Previous', on_click=_prev_grid_page_cb, disabled=(state.GRID_PAGE == 0), key='grid_page_prev')
+        c2.caption(f'Page {state.GRID_PAGE + 1} of {num_pages} (images {first + 1 if last else 0} to {last} of {len(working_media_list)})')
+        c3.button('Next ▶', on_click=_next_grid_page_cb, disabled=(state.GRID_PAGE >= num_pages - 1), key='grid_page_next')
+
+    images = {media: media for media in working_media_list[first:last]}
+
+    if contact_sheets:
+        # One server-composited image per CONTACT_SHEET_ROWS grid rows, instead of an st.image per file
+        for sheet in range(first // sheet_size, -(-last // sheet_size)):
+            try:
+                sheet_bytes = mc.get_contact_sheet(
+                    source=mc.MEDIA_SOURCE, sheet=sheet, columns=num_cols, img_w=img_w,
+                    rows=int(state.CONTACT_SHEET_ROWS), limit=len(working_media_list),
+                    media_filter=mc.MEDIA_FILTER, sort_flag=mc.MEDIA_LIST_SORT,
+                    sort_by_date_flag=mc.MEDIA_LIST_DATE_SORT, ascending=mc.MEDIA_LIST_SORT_ASC,
+                    sort_by_size_flag=mc.MEDIA_LIST_SIZE_SORT, ignore_case=mc.MEDIA_FILTER_IGNORE_CASE
+                )
+                st.image(sheet_bytes, output_format='auto')
+            except Exception as ex:
+                print(f'Skipping contact sheet {sheet}\n', str(ex))
+        return
+
+    # Pull the grid's images concurrently up front, so the render loop only consumes ready bytes
+    # (renditions sized for display are requested rather than the full resolution originals)
+    prefetched = mc.prefetch_media(
+        source=mc.MEDIA_SOURCE,
+        media_list=[img for img in images if not 'http' in img],
+        width=img_w
     )
-    working_media_list = media_list[:num_images] if num_images > 0 else media_list
-    images = {media: media for media in working_media_list}
 
     cols = cycle(st.columns(num_cols))
     for i, (img, caption) in enumerate(images.items()):
-        if not 'http' in img:
-            image_bytes = mc.get_media(source=mc.MEDIA_SOURCE, media=img)
-            image = image_bytes
-        else:
-            image = img
-
         try:
+            if not 'http' in img:
+                image_bytes = prefetched[img] if img in prefetched else mc.get_media(source=mc.MEDIA_SOURCE, media=img, width=img_w)
+                image = image_bytes
+            else:
+                image = img
+
             if state.SHOW_CAPTIONS:
                 next(cols).image(image, width=img_w, output_format='auto', caption=caption)
             else:
@@ -1,14 +1,121 @@
 import os
 import sys
-import requests
-import json
+import re
 import time
 import base64
+import sqlite3
+from urllib.parse import quote, urlencode
+from concurrent.futures import ThreadPoolExecutor
 from abc import ABCMeta, abstractmethod
 
 import streamlit as st
 
 from media_server.media_service import MediaService
+from media_server.wire import BATCH_OK, iter_batch_records
+from media_server.media_cache import MediaCache
+from media_disk_cache import MediaDiskCache
+from media_transport import get_transport, MediaServerError
+
+class ValidatedResponseCache():
+    def __init__(self, cache, disk_cache=None):
+        """
+        Media server responses with their validators (ETag, Last-Modified), held in a byte-budgeted MediaCache.
+        Entries within the server's Cache-Control max-age are used as is, stale ones are revalidated
+        with a conditional GET so an unchanged image costs a 304 rather than its full body.
+        With a disk_cache (MediaDiskCache), responses are also kept on disk, and memory misses are
+        looked up there, so they outlive the process.
+        """
+        self._cache = cache  # url -> (content, etag, last_modified, expires)
+        self._disk_cache = disk_cache
+
+    def _get(self, url):
+        cached = self._cache.get(url)
+        if cached is not None:
+            if self._disk_cache:
+                self._disk_cache.touch(url)
+            return cached
+        if self._disk_cache:
+            cached = self._disk_cache.get(url)
+            if cached is not None:
+                self._cache.put(url, cached, len(cached[0]))
+        return cached
+
+    @staticmethod
+    def _expires(response):
+        cache_control = response.headers.get('Cache-Control', '')
+        if 'no-cache' in cache_control or 'no-store' in cache_control:
+            return 0
+        max_age = re.search(r'max-age=(\d+)', cache_control)
+        return time.time() + int(max_age.group(1)) if max_age else 0
+
+    def get(self, transport, url):
+        cached = self._get(url)
+
+        headers = {}
+        if cached:
+            content, etag, last_modified, expires = cached
+            if time.time() < expires:
+                return content
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        response = transport.get(url, headers=headers)
+        if response.status_code == 304 and cached:
+            expires = self._expires(response)
+            self._cache.put(url, (content, etag, last_modified, expires), len(content))
+            if self._disk_cache:
+                self._disk_cache.touch(url, expires=expires)
+            return content
+        if response.status_code == 200 and (response.headers.get('ETag') or response.headers.get('Last-Modified')):
+            self._put(url, (
+                response.content,
+                response.headers.get('ETag', None),
+                response.headers.get('Last-Modified', None),
+                self._expires(response)
+            ))
+        return response.content
+
+    def get_fresh(self, url):
+        cached = self._get(url)
+        if cached and time.time() < cached[3]:
+            return cached[0]
+        return None
+
+    def put(self, url, content, etag, response):
+        """
+        Stores content fetched for url by some other request (e.g. a batch), expiring per that response.
+        """
+        if etag:
+            self._put(url, (content, etag, None, self._expires(response)))
+
+    def _put(self, url, entry):
+        self._cache.put(url, entry, len(entry[0]))
+        if self._disk_cache:
+            try:
+                self._disk_cache.put(url, *entry)
+            except (OSError, sqlite3.Error) as e:
+                print('Media disk cache write failed:', str(e))
+
+# One process-wide, byte-budgeted copy of each image, shared by all sessions and client modes
+MEDIA_CACHE = MediaCache(int(float(st.secrets.get('MEDIA_CACHE_MB', 512)) * 1024 * 1024))
+
+# Optional persistent copy of media server responses, shared by every app process using the folder
+MEDIA_DISK_CACHE_MB = float(st.secrets.get('MEDIA_DISK_CACHE_MB', 0))
+MEDIA_DISK_CACHE = MediaDiskCache(
+    st.secrets.get('MEDIA_DISK_CACHE_FOLDER', './.media_client_cache'), int(MEDIA_DISK_CACHE_MB * 1024 * 1024)
+) if MEDIA_DISK_CACHE_MB > 0 else None
+
+MEDIA_RESPONSE_CACHE = ValidatedResponseCache(MEDIA_CACHE, MEDIA_DISK_CACHE)
+
+# Media files requested per /media_batch call (the server's MEDIA_BATCH_MAX_FILES must be at least this)
+MEDIA_BATCH_SIZE = 500
+
+# Bounded, process-wide pool used to prefetch grid images (shared by all sessions)
+PREFETCH_WORKERS = int(st.secrets.get('PREFETCH_WORKERS', 8))
+PREFETCH_MIN_BATCH = 8
+_PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix='Media Prefetch')
 
 class MediaClient(metaclass=ABCMeta):
     def __init__(self):
@@ -20,6 +127,8 @@ class MediaClient(metaclass=ABCMeta):
         self.MEDIA_LIST_SORT = True
         self.MEDIA_LIST_DATE_SORT = True
         self.MEDIA_LIST_SORT_ASC = False
+        self.MEDIA_LIST_SIZE_SORT = False
+        self.MEDIA_FILTER_IGNORE_CASE = False
         self.NUM_IMAGES = int(st.secrets['DEFAULT_NUM_IMAGES'])
 
     @abstractmethod
@@ -29,13 +138,28 @@ class MediaClient(metaclass=ABCMeta):
     def get_media_sources(self):
         pass
     @abstractmethod
-    def get_media_list(self, media_source, media_filter, sort_flag, sort_by_date_flag, ascending):
+    def get_media_list_version(self, media_source):
+        pass
+    @abstractmethod
+    def get_media_list(
+        self, media_source, media_filter, sort_flag, sort_by_date_flag, ascending, list_version, limit, cursor,
+        sort_by_size_flag, ignore_case
+    ):
         pass
     @abstractmethod
     def initialize_media_resources(self):
         pass
     @abstractmethod
-    def get_media(self, source, media):
+    def get_media(self, source, media, width, quality):
+        pass
+    @abstractmethod
+    def get_media_batch(self, source, media_list, width, quality):
+        pass
+    @abstractmethod
+    def get_contact_sheet(
+        self, source, sheet, columns, img_w, rows, limit, media_filter, sort_flag, sort_by_date_flag, ascending,
+        sort_by_size_flag, ignore_case
+    ):
         pass
     @abstractmethod
     def get_media_b64(self, source, media):
@@ -47,6 +171,33 @@ class MediaClient(metaclass=ABCMeta):
     def shutdown():
         pass
 
+    def get_media_cache_stats(self):
+        stats = MEDIA_CACHE.stats()
+        if MEDIA_DISK_CACHE:
+            stats['disk'] = MEDIA_DISK_CACHE.stats()
+        return stats
+
+    def prefetch_media(self, source, media_list, width=None, quality=None):
+        """
+        Fetches media_list as concurrent batches on the prefetch pool, returning {media: bytes}.
+        Results also land in the client's media cache, so later get_media calls are hits.
+        """
+        batch_size = max(PREFETCH_MIN_BATCH, -(-len(media_list) // PREFETCH_WORKERS))
+        batches = [media_list[i:i + batch_size] for i in range(0, len(media_list), batch_size)]
+
+        def _fetch(batch):
+            try:
+                return self.get_media_batch(source, batch, width=width, quality=quality)
+            except Exception as ex:
+                # Anything missed is fetched individually when it's rendered
+                print('Prefetch failed:', str(ex))
+                return {}
+
+        media_batch = {}
+        for fetched in _PREFETCH_EXECUTOR.map(_fetch, batches):
+            media_batch.update(fetched)
+        return media_batch
+
 class MediaServiceClient(MediaClient):
     def __init__(self):
         super().__init__()
@@ -59,14 +210,23 @@ class MediaServiceClient(MediaClient):
     def get_media_sources(_self):
         return _self.MEDIA_SERVICE.media_sources()['media_sources']
 
-    @st.experimental_memo(show_spinner=False)
+    def get_media_list_version(self, media_source='DEFAULT'):
+        return self.MEDIA_SERVICE.media_list_version(source=media_source)['media_list_version']
+
+    # list_version is part of the memo key, so a changed listing misses the memo
+    @st.experimental_memo(show_spinner=False, max_entries=64)
     def get_media_list(
         _self,
         media_source='DEFAULT', 
         media_filter=None, 
         sort_flag=False, 
         sort_by_date_flag=True, 
-        ascending=False
+        ascending=False,
+        list_version=None,
+        limit=None,
+        cursor=None,
+        sort_by_size_flag=False,
+        ignore_case=False
     ):
         filter_string = media_filter if media_filter else ''
         media_list_resp = _self.MEDIA_SERVICE.media_list(
@@ -74,32 +234,75 @@ class MediaServiceClient(MediaClient):
             filter_string=filter_string, 
             sort_flag=sort_flag, 
             sort_by_date_flag=sort_by_date_flag,
-            ascending=ascending
+            ascending=ascending,
+            limit=limit,
+            cursor=cursor,
+            sort_by_size_flag=sort_by_size_flag,
+            ignore_case=ignore_case
         )
         media_list = media_list_resp['media_list']
         media_filter = media_list_resp['media_filter']
-        return media_list, media_filter
+        next_cursor = media_list_resp['next_cursor']
+        return media_list, media_filter, next_cursor
 
     def initialize_media_resources(self):
         self.MEDIA_SOURCES = self.get_media_sources()
         if self.MEDIA_SOURCES:
             self.MEDIA_SOURCE = list(self.MEDIA_SOURCES.keys())[0]
-            self.MEDIA_LIST, self.MEDIA_FILTER = self.get_media_list(
+            self.MEDIA_LIST, self.MEDIA_FILTER, _next_cursor = self.get_media_list(
                 media_source=self.MEDIA_SOURCE,
                 media_filter=None, 
                 sort_flag=self.MEDIA_LIST_SORT,
                 sort_by_date_flag=self.MEDIA_LIST_DATE_SORT,
-                ascending=self.MEDIA_LIST_SORT_ASC
+                ascending=self.MEDIA_LIST_SORT_ASC,
+                list_version=self.get_media_list_version(self.MEDIA_SOURCE),
+                limit=int(self.NUM_IMAGES),
+                sort_by_size_flag=self.MEDIA_LIST_SIZE_SORT,
+                ignore_case=self.MEDIA_FILTER_IGNORE_CASE
             )
 
-    @st.experimental_memo(show_spinner=False, max_entries=10000, ttl=3600)
-    def get_media(_self, source, media):
-        media_bytes = _self.MEDIA_SERVICE.media(source=source, media_file=media, encode=False)
+    # Not memoized: cached once in the byte-budgeted media cache, keyed by the file's entity tag
+    def get_media(self, source, media, width=None, quality=None):
+        rendition = self.MEDIA_SERVICE.media_rendition(source=source, media_file=media, width=width, quality=quality)
+        key = ('media', source, media, rendition['etag'])
+        media_bytes = MEDIA_CACHE.get(key)
+        if media_bytes is None:
+            media_bytes = self.MEDIA_SERVICE.media(
+                source=source, media_file=media, encode=False, width=width, quality=quality, rendition=rendition
+            )
+            MEDIA_CACHE.put(key, media_bytes, len(media_bytes))
         return media_bytes
 
-    @st.experimental_memo(show_spinner=False, max_entries=10000, ttl=3600)
-    def get_media_b64(_self, source, media):
-        media_b64 = _self.MEDIA_SERVICE.media(source=source, media_file=media, encode=True)
+    def get_media_batch(self, source, media_list, width=None, quality=None):
+        media_batch = {}
+        for media in media_list:
+            try:
+                media_batch[media] = self.get_media(source, media, width=width, quality=quality)
+            except FileNotFoundError:
+                pass
+        return media_batch
+
+    def get_contact_sheet(
+        self, source, sheet, columns, img_w, rows=1, limit=None,
+        media_filter=None, sort_flag=False, sort_by_date_flag=True, ascending=False,
+        sort_by_size_flag=False, ignore_case=False
+    ):
+        contact_sheet = self.MEDIA_SERVICE.contact_sheet(
+            source=source, sheet=sheet, columns=columns, cell_width=img_w, rows=rows, limit=limit,
+            filter_string=media_filter, sort_flag=sort_flag, sort_by_date_flag=sort_by_date_flag, ascending=ascending,
+            sort_by_size_flag=sort_by_size_flag, ignore_case=ignore_case
+        )
+        key = ('contact_sheet', contact_sheet['etag'])
+        sheet_bytes = MEDIA_CACHE.get(key)
+        if sheet_bytes is None:
+            with open(contact_sheet['contact_sheet'], 'rb') as sheet_f:
+                sheet_bytes = sheet_f.read()
+            MEDIA_CACHE.put(key, sheet_bytes, len(sheet_bytes))
+        return sheet_bytes
+
+    # base64 is derived on demand from the single cached raw copy
+    def get_media_b64(self, source, media):
+        media_b64 = base64.b64encode(self.get_media(source, media)).decode('utf-8')
         return media_b64
 
     def get_media_full_path(self, source, media):
@@ -107,6 +310,7 @@ class MediaServiceClient(MediaClient):
         return media_path
 
     def shutdown(self):
+        self.MEDIA_SERVICE.close()
         self.MEDIA_SERVICE = MediaService()
 
 class RemoteMediaServerClient(MediaClient):
@@ -116,6 +320,7 @@ class RemoteMediaServerClient(MediaClient):
         self.MEDIA_SERVER_PORT = st.secrets['MEDIA_SERVER']['PORT']
         self.HTTP_PROTOCOL = st.secrets['MEDIA_SERVER']['HTTP_PROTOCOL']
         self.BASE_URL = f'{self.HTTP_PROTOCOL}://{self.MEDIA_SERVER_HOST}:{self.MEDIA_SERVER_PORT}'
+        self.TRANSPORT = get_transport(st.secrets['MEDIA_SERVER'])
 
     def initialize_media_backend(self):
          # as this is a remote server scenario, assume it has started
@@ -123,54 +328,129 @@ class RemoteMediaServerClient(MediaClient):
 
     @st.experimental_memo(show_spinner=False)
     def get_media_sources(_self):
-        return json.loads(requests.get(f'{_self.BASE_URL}/media_sources').text)['media_sources']
+        return _self.TRANSPORT.get_json(f'{_self.BASE_URL}/media_sources')['media_sources']
 
-    @st.experimental_memo(show_spinner=False)
+    def get_media_list_version(self, media_source='DEFAULT'):
+        return self.TRANSPORT.get_json(
+            f'{self.BASE_URL}/media_list_version/{media_source}'
+        )['media_list_version']
+
+    # list_version is part of the memo key, so a changed listing misses the memo
+    @st.experimental_memo(show_spinner=False, max_entries=64)
     def get_media_list(
         _self,
         media_source='DEFAULT', 
         media_filter=None, 
         sort_flag=False, 
         sort_by_date_flag=True, 
-        ascending=False
+        ascending=False,
+        list_version=None,
+        limit=None,
+        cursor=None,
+        sort_by_size_flag=False,
+        ignore_case=False
     ):
-        filter_param  = f'filter_string={media_filter}' if media_filter else ''
-        sort_param  = f'sort_flag={sort_flag}'
-        sort_by_date_param  = f'sort_by_date_flag={sort_by_date_flag}'
-        ascending_param  = f'ascending={ascending}'
-        params = f'{sort_param}&{sort_by_date_param}&{ascending_param}'
-        params = f'{filter_param}&{params}' if filter_param else params
-        media_list_resp = json.loads(requests.get(f'{_self.BASE_URL}/media_list/{media_source}?{params}').text)
+        media_list_resp = _self.TRANSPORT.get_media_list(_self._media_list_url(
+            media_source, media_filter, sort_flag, sort_by_date_flag, ascending, limit, cursor, sort_by_size_flag, ignore_case
+        ))
         media_list = media_list_resp['media_list']
         media_filter = media_list_resp['media_filter']
-        return media_list, media_filter
+        next_cursor = media_list_resp['next_cursor']
+        return media_list, media_filter, next_cursor
 
     def initialize_media_resources(self):
         self.MEDIA_SOURCES = self.get_media_sources()
         if self.MEDIA_SOURCES:
             self.MEDIA_SOURCE = list(self.MEDIA_SOURCES.keys())[0]
-            self.MEDIA_LIST, self.MEDIA_FILTER = self.get_media_list(
+            self.MEDIA_LIST, self.MEDIA_FILTER, _next_cursor = self.get_media_list(
                 media_source=self.MEDIA_SOURCE,
                 media_filter=None, 
                 sort_flag=self.MEDIA_LIST_SORT,
                 sort_by_date_flag=self.MEDIA_LIST_DATE_SORT,
-                ascending=self.MEDIA_LIST_SORT_ASC
+                ascending=self.MEDIA_LIST_SORT_ASC,
+                list_version=self.get_media_list_version(self.MEDIA_SOURCE),
+                limit=int(self.NUM_IMAGES),
+                sort_by_size_flag=self.MEDIA_LIST_SIZE_SORT,
+                ignore_case=self.MEDIA_FILTER_IGNORE_CASE
             )
 
-    @st.experimental_memo(show_spinner=False, max_entries=10000, ttl=3600)
-    def get_media(_self, source, media):
-        media_bytes = requests.get(f'{_self.BASE_URL}/media/{source}/{media}').content
+    def _query(self, **params):
+        # Filters are free text (e.g. 'a&b', '#1', '[ab]*'), so every value is escaped
+        return urlencode({name: value for name, value in params.items() if value not in (None, '')})
+
+    def _media_list_url(
+        self, media_source, media_filter=None, sort_flag=False, sort_by_date_flag=True, ascending=False,
+        limit=None, cursor=None, sort_by_size_flag=False, ignore_case=False
+    ):
+        params = self._query(
+            filter_string=media_filter, sort_flag=sort_flag, sort_by_date_flag=sort_by_date_flag, ascending=ascending,
+            limit=limit or None, cursor=cursor, sort_by_size_flag=sort_by_size_flag or None, ignore_case=ignore_case or None
+        )
+        return f'{self.BASE_URL}/media_list/{media_source}?{params}'
+
+    def _contact_sheet_url(
+        self, source, sheet, columns, img_w, rows=1, limit=None,
+        media_filter=None, sort_flag=False, sort_by_date_flag=True, ascending=False,
+        sort_by_size_flag=False, ignore_case=False
+    ):
+        params = self._query(
+            sheet=sheet, columns=columns, img_w=img_w, rows=rows,
+            sort_flag=sort_flag, sort_by_date_flag=sort_by_date_flag, ascending=ascending, limit=limit or None,
+            filter_string=media_filter, sort_by_size_flag=sort_by_size_flag or None, ignore_case=ignore_case or None
+        )
+        return f'{self.BASE_URL}/contact_sheet/{source}?{params}'
+
+    def _media_url(self, source, media, width=None, quality=None):
+        params = f'width={width}' if width else ''
+        params = f'{params}&quality={quality}' if quality else params
+        # Names in recursive sources are relative paths, whose slashes are kept
+        return f'{self.BASE_URL}/media/{source}/{quote(media, safe="/")}?{params}'
+
+    # Not memoized: the validated response cache serves fresh copies and revalidates stale ones
+    def get_media(self, source, media, width=None, quality=None):
+        media_bytes = MEDIA_RESPONSE_CACHE.get(self.TRANSPORT, self._media_url(source, media, width, quality))
         return media_bytes
+
+    def get_media_batch(self, source, media_list, width=None, quality=None):
+        media_batch = {}
+        for media in media_list:
+            media_bytes = MEDIA_RESPONSE_CACHE.get_fresh(self._media_url(source, media, width, quality))
+            if media_bytes is not None:
+                media_batch[media] = media_bytes
+
+        # Everything not already fresh in the cache comes back in a single framed response (per MEDIA_BATCH_SIZE)
+        wanted = [media for media in media_list if media not in media_batch]
+        for i in range(0, len(wanted), MEDIA_BATCH_SIZE):
+            response = self.TRANSPORT.post(
+                f'{self.BASE_URL}/media_batch/{source}',
+                json={'media_files': wanted[i:i + MEDIA_BATCH_SIZE], 'width': width, 'quality': quality}
+            )
+            for status, media, _content_type, etag, media_bytes in iter_batch_records(response.content):
+                if status == BATCH_OK:
+                    MEDIA_RESPONSE_CACHE.put(self._media_url(source, media, width, quality), media_bytes, etag, response)
+                    media_batch[media] = media_bytes
+
+        return media_batch
     
-    @st.experimental_memo(show_spinner=False, max_entries=10000, ttl=3600)
-    def get_media_b64(_self, source, media):
-        media_bytes = requests.get(f'{_self.BASE_URL}/media/{source}/{media}').content
+    def get_contact_sheet(
+        self, source, sheet, columns, img_w, rows=1, limit=None,
+        media_filter=None, sort_flag=False, sort_by_date_flag=True, ascending=False,
+        sort_by_size_flag=False, ignore_case=False
+    ):
+        return MEDIA_RESPONSE_CACHE.get(self.TRANSPORT, self._contact_sheet_url(
+            source, sheet, columns, img_w, rows=rows, limit=limit,
+            media_filter=media_filter, sort_flag=sort_flag, sort_by_date_flag=sort_by_date_flag, ascending=ascending,
+            sort_by_size_flag=sort_by_size_flag, ignore_case=ignore_case
+        ))
+
+    def get_media_b64(self, source, media):
+        media_bytes = self.get_media(source, media)
         media_b64 = base64.b64encode(media_bytes).decode('utf-8')
         return media_b64
 
     def get_media_full_path(self, source, media):
-        media_full_path = json.loads(
-            requests.get(f'{self.BASE_URL}/media_full_path/{source}/{media}').text
+        media_full_path = self.TRANSPORT.get_json(
+            f'{self.BASE_URL}/media_full_path/{source}/{quote(media, safe="/")}'
         )['media_full_path']
         return media_full_path
 
@@ -219,39 +499,67 @@ class EmbeddedMediaServerClient(RemoteMediaServerClient):
     def get_media_sources(_self):
         return super().get_media_sources()
 
-    @st.experimental_memo(show_spinner=False)
+    def get_media_list_version(self, media_source='DEFAULT'):
+        return super().get_media_list_version(media_source)
+
+    @st.experimental_memo(show_spinner=False, max_entries=64)
     def get_media_list(
         _self,
         media_source='DEFAULT', 
         media_filter=None, 
         sort_flag=False, 
         sort_by_date_flag=True, 
-        ascending=False
+        ascending=False,
+        list_version=None,
+        limit=None,
+        cursor=None,
+        sort_by_size_flag=False,
+        ignore_case=False
     ):
         return super().get_media_list(
             media_source=media_source, 
             media_filter=media_filter, 
             sort_flag=sort_flag, 
             sort_by_date_flag=sort_by_date_flag, 
-            ascending=ascending
+            ascending=ascending,
+            list_version=list_version,
+            limit=limit,
+            cursor=cursor,
+            sort_by_size_flag=sort_by_size_flag,
+            ignore_case=ignore_case
         )
 
     def initialize_media_resources(self):
         return super().initialize_media_resources()
 
-    @st.experimental_memo(show_spinner=False, max_entries=10000, ttl=3600)
-    def get_media(_self, source, media):
-        return super().get_media(source, media)
+    def get_media(self, source, media, width=None, quality=None):
+        return super().get_media(source, media, width=width, quality=quality)
     
-    @st.experimental_memo(show_spinner=False, max_entries=10000, ttl=3600)
-    def get_media_b64(_self, source, media):
+    def get_media_batch(self, source, media_list, width=None, quality=None):
+        return super().get_media_batch(source, media_list, width=width, quality=quality)
+
+    def get_contact_sheet(
+        self, source, sheet, columns, img_w, rows=1, limit=None,
+        media_filter=None, sort_flag=False, sort_by_date_flag=True, ascending=False,
+        sort_by_size_flag=False, ignore_case=False
+    ):
+        return super().get_contact_sheet(
+            source, sheet, columns, img_w, rows=rows, limit=limit,
+            media_filter=media_filter, sort_flag=sort_flag, sort_by_date_flag=sort_by_date_flag, ascending=ascending,
+            sort_by_size_flag=sort_by_size_flag, ignore_case=ignore_case
+        )
+
+    def get_media_b64(self, source, media):
         return super().get_media_b64(source, media)
 
     def get_media_full_path(self, source, media):
         return super().get_media_full_path(source, media)
 
     def shutdown(self):
-        requests.get(f'{self.BASE_URL}/shutdown')
+        try:
+            self.TRANSPORT.get(f'{self.BASE_URL}/shutdown')
+        except MediaServerError as e:
+            print('Media server shutdown request failed:', str(e))
         time.sleep(1)
 
 class MediaClientFactory:
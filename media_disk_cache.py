@@ -0,0 +1,222 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+
+# How stale an entry's last use time may get before it is written back (it only orders evictions)
+USED_WRITE_SECS = 60
+
+# Evictions make room down to this share of the budget, in batches of the least recently used bodies, so
+# that a full cache doesn't evict on every put
+EVICT_LOW_WATER = 0.9
+EVICT_BATCH = 256
+
+# Bumped when the index layout changes, an older index is dropped (its entries are fetched again)
+INDEX_VERSION = 2
+
+class MediaDiskCache():
+
+    def __init__(self, cache_folder: str, max_bytes: int):
+        """
+        Persistent, content-addressed disk cache of media server responses, kept with their validators
+        so a restarted client app revalidates what it already has instead of fetching it again.
+
+        Bodies are stored once per SHA-256 of their content (identical images fetched by different URLs
+        share a file) and written aside then moved into place, so readers never see part of a file.
+        The index is an SQLite file in WAL mode, so any number of sessions and app processes can share
+        the folder. It keeps a running total of the bodies' sizes, and the least recently used bodies are
+        evicted when it goes over max_bytes.
+        """
+        self.cache_folder = os.path.abspath(cache_folder)
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_bytes // 16
+
+        self._lock = threading.Lock()
+        self._used = {}  # key -> last use written to the index
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(self.cache_folder, exist_ok=True)
+        self.index_file = os.path.join(self.cache_folder, 'index.sqlite')
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            if conn.execute('PRAGMA user_version').fetchone()[0] < INDEX_VERSION:
+                conn.execute('DROP TABLE IF EXISTS entries')
+                conn.execute(f'PRAGMA user_version = {INDEX_VERSION}')
+            conn.execute('CREATE TABLE IF NOT EXISTS bodies (digest TEXT PRIMARY KEY, size INTEGER, used REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS bodies_used ON bodies (used)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, digest TEXT, '
+                'etag TEXT, last_modified TEXT, expires REAL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest)')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)')
+            conn.execute("INSERT OR IGNORE INTO meta VALUES ('bytes', 0)")
+
+    @contextmanager
+    def _connect(self, write: bool = False):
+        conn = sqlite3.connect(self.index_file, timeout=30)
+        # In WAL mode this still can't corrupt the index, a power loss only drops the last commits
+        conn.execute('PRAGMA synchronous=NORMAL')
+        try:
+            with conn:
+                if write:
+                    conn.execute('BEGIN IMMEDIATE')
+                yield conn
+        finally:
+            conn.close()
+
+    def _body_file(self, digest: str):
+        return os.path.join(self.cache_folder, digest[:2], digest)
+
+    def get(self, key: str):
+        """
+        (content, etag, last_modified, expires) cached for key, or None.
+        """
+        with self._connect() as conn:
+            row = conn.execute('SELECT digest, etag, last_modified, expires FROM entries WHERE key = ?', (key,)).fetchone()
+        content = None
+        if row:
+            try:
+                with open(self._body_file(row[0]), 'rb') as f:
+                    content = f.read()
+            except FileNotFoundError:
+                # Evicted by another process since the lookup, or lost: its rows are dropped so that the
+                # running total doesn't count it
+                with self._connect(write=True) as conn:
+                    if not os.path.isfile(self._body_file(row[0])):
+                        total = conn.execute("SELECT value FROM meta WHERE key = 'bytes'").fetchone()[0]
+                        total -= self._remove_bodies(conn, [row[0]])
+                        conn.execute("UPDATE meta SET value = ? WHERE key = 'bytes'", (total,))
+        if content is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.touch(key)
+        return content, row[1], row[2], row[3]
+
+    def touch(self, key: str, expires: float = None):
+        """
+        Records a use of key's body (written back at most every USED_WRITE_SECS), and key's new expiry time
+        after a revalidation when expires is given.
+        """
+        now = time.time()
+        with self._lock:
+            write = expires is not None or now - self._used.get(key, 0.0) > USED_WRITE_SECS
+            if write:
+                self._used[key] = now
+        if write:
+            with self._connect() as conn:
+                if expires is not None:
+                    conn.execute('UPDATE entries SET expires = ? WHERE key = ?', (expires, key))
+                conn.execute('UPDATE bodies SET used = ? WHERE digest = (SELECT digest FROM entries WHERE key = ?)', (now, key))
+
+    def put(self, key: str, content: bytes, etag: str, last_modified: str, expires: float):
+        if len(content) > self.max_item_bytes:
+            return False
+
+        digest = hashlib.sha256(content).hexdigest()
+        body_file = self._body_file(digest)
+        # Written before the index is locked, so other writers don't wait on it
+        if not os.path.isfile(body_file):
+            self._write_body(body_file, content)
+
+        now = time.time()
+        with self._connect(write=True) as conn:
+            # Evictions only happen under the write lock, so one since the write above is caught here
+            if not os.path.isfile(body_file):
+                self._write_body(body_file, content)
+            total = conn.execute("SELECT value FROM meta WHERE key = 'bytes'").fetchone()[0]
+            previous = conn.execute('SELECT digest FROM entries WHERE key = ?', (key,)).fetchone()
+
+            if conn.execute('SELECT 1 FROM bodies WHERE digest = ?', (digest,)).fetchone():
+                conn.execute('UPDATE bodies SET used = ? WHERE digest = ?', (now, digest))
+            else:
+                conn.execute('INSERT INTO bodies VALUES (?, ?, ?)', (digest, len(content), now))
+                total += len(content)
+            conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)', (key, digest, etag, last_modified, expires))
+
+            # The body key had before is removed once no other key refers to it
+            if previous and previous[0] != digest and not conn.execute(
+                'SELECT 1 FROM entries WHERE digest = ? LIMIT 1', previous
+            ).fetchone():
+                total -= self._remove_bodies(conn, [previous[0]])
+
+            if total > self.max_bytes:
+                total = self._evict(conn, total, keep=digest)
+            conn.execute("UPDATE meta SET value = ? WHERE key = 'bytes'", (total,))
+        with self._lock:
+            self._used[key] = now
+        return True
+
+    def _write_body(self, body_file: str, content: bytes):
+        os.makedirs(os.path.dirname(body_file), exist_ok=True)
+        partial_file = f'{body_file}.{os.getpid()}.{threading.get_ident()}.part'
+        try:
+            with open(partial_file, 'wb') as f:
+                f.write(content)
+            os.replace(partial_file, body_file)
+        finally:
+            if os.path.exists(partial_file):
+                os.remove(partial_file)
+
+    def _remove_bodies(self, conn, digests: list):
+        """
+        Removes bodies, with every key that refers to them, returning the bytes they took.
+        """
+        size = 0
+        for digest in digests:
+            row = conn.execute('SELECT size FROM bodies WHERE digest = ?', (digest,)).fetchone()
+            keys = [key for key, in conn.execute('SELECT key FROM entries WHERE digest = ?', (digest,))]
+            conn.execute('DELETE FROM entries WHERE digest = ?', (digest,))
+            conn.execute('DELETE FROM bodies WHERE digest = ?', (digest,))
+            try:
+                os.remove(self._body_file(digest))
+            except FileNotFoundError:
+                pass
+            with self._lock:
+                for key in keys:
+                    self._used.pop(key, None)
+            size += row[0] if row else 0
+        return size
+
+    def _evict(self, conn, total: int, keep: str):
+        """
+        Removes the least recently used bodies (other than keep), a batch at a time, until the cache is
+        within EVICT_LOW_WATER of its budget. Returns the new total.
+        """
+        low_water = int(self.max_bytes * EVICT_LOW_WATER)
+        while total > low_water:
+            rows = conn.execute(
+                'SELECT digest, size FROM bodies WHERE digest != ? ORDER BY used LIMIT ?', (keep, EVICT_BATCH)
+            ).fetchall()
+            if not rows:
+                break
+            evicted = []
+            for digest, size in rows:
+                if total <= low_water:
+                    break
+                evicted.append(digest)
+                total -= size
+            self._remove_bodies(conn, evicted)
+            self.evictions += len(evicted)
+        return total
+
+    def stats(self):
+        with self._connect() as conn:
+            entries = conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+            size = conn.execute("SELECT value FROM meta WHERE key = 'bytes'").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            'entries': entries,
+            'bytes': size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': (self.hits / lookups) if lookups else 0.0,
+        }
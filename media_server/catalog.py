@@ -0,0 +1,372 @@
+import os
+import re
+import json
+import glob
+import time
+import sqlite3
+import threading
+from stat import S_ISREG
+from collections.abc import Mapping
+from contextlib import contextmanager
+from mimetypes import guess_type
+
+try:
+    from .scanner import MediaScanner
+    from .sort_index import MediaSortIndex, write_sort_index
+except ImportError:
+    from scanner import MediaScanner
+    from sort_index import MediaSortIndex, write_sort_index
+
+class CatalogEntries(Mapping):
+
+    def __init__(self, conn):
+        """
+        Read-only mapping of name: (size, mtime, content_type) over the media table of a catalog file,
+        read from it on demand. items() reads every entry in one statement, so it sees a single version.
+        """
+        self._conn = conn
+
+    def __getitem__(self, name: str):
+        row = self._conn.execute('SELECT size, mtime, content_type FROM media WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return tuple(row)
+
+    def __iter__(self):
+        return (name for name, in self._conn.execute('SELECT name FROM media'))
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM media').fetchone()[0]
+
+    def items(self):
+        return (
+            (name, (size, mtime, content_type))
+            for name, size, mtime, content_type in self._conn.execute('SELECT name, size, mtime, content_type FROM media')
+        )
+
+class MediaCatalog():
+
+    def __init__(
+        self, catalog_file: str, media_folder: str, media_extensions: list, refresh_interval: float = 5.0,
+        recursive: bool = False, scan_workers: int = 8
+    ):
+        """
+        Persistent (SQLite) catalog of the media files in a single media folder (and its subfolders
+        when recursive, in which case names are relative paths such as 'trips/2021/beach.jpg').
+
+        Entries (name, size, mtime, content_type) are kept in the catalog file and read from it when they
+        are needed (see entries() and entry()), rather than held in memory by every worker process. They
+        are refreshed incrementally: the folder is only rescanned when the mtime of one of its folders
+        changes, and only files whose stat results differ are rewritten to the catalog file. Files edited
+        in place leave folder mtimes alone, so they are caught when they are next served (see entry())
+        rather than by polling.
+
+        The catalog file is shared by every server worker process cataloging the same folder. It holds
+        the listing version, so a process that finds the folder changed first takes up what others
+        already wrote (only scanning if nobody has), and all processes agree on versions. Scans and
+        writes are serialized across processes by the file's write lock.
+        """
+        self.catalog_file = catalog_file
+        self.media_folder = os.path.abspath(media_folder)
+        self.media_extensions = media_extensions
+        self.refresh_interval = refresh_interval
+        self.recursive = recursive
+
+        self._scanner = MediaScanner(media_extensions, recursive=recursive, workers=scan_workers)
+
+        self._lock = threading.RLock()
+        self._readers = threading.local()
+        self._reader_conns = []
+        self._folder_mtimes = {}
+        self._last_checked = 0.0
+        self._version = 0
+        self._sort_index = None
+        self._sort_index_deferred = None
+
+        # Set when a watcher keeps the listing current, in which case polling is skipped
+        self.watched = False
+
+        os.makedirs(os.path.dirname(os.path.abspath(catalog_file)), exist_ok=True)
+        self._create()
+        self._load()
+
+    @staticmethod
+    def catalog_file_name(source: str):
+        return re.sub(r'[^A-Za-z0-9_.-]+', '_', source).strip('_') + '.sqlite'
+
+    @contextmanager
+    def _connect(self, write: bool = False):
+        # A scan can hold the write lock for a while, so writers wait for it rather than time out
+        conn = sqlite3.connect(self.catalog_file, timeout=600 if write else 30)
+        try:
+            with conn:
+                if write:
+                    conn.execute('BEGIN IMMEDIATE')
+                yield conn
+        finally:
+            conn.close()
+
+    def _create(self):
+        with self._connect() as conn:
+            # Readers in other processes don't block on (or block) a writer
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS folders (path TEXT PRIMARY KEY, mtime REAL)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS media '
+                '(name TEXT PRIMARY KEY, size INTEGER, mtime REAL, content_type TEXT)'
+            )
+            conn.execute('CREATE TABLE IF NOT EXISTS options (key TEXT PRIMARY KEY, value TEXT)')
+            # Change logs replayed into in-memory entries by earlier versions
+            conn.execute('DROP TABLE IF EXISTS changes')
+
+    def _load(self):
+        scan_options = json.dumps({
+            'media_folder': self.media_folder,
+            'recursive': self.recursive,
+            'media_extensions': sorted(self._scanner.media_extensions),
+        })
+        with self._connect(write=True) as conn:
+            row = conn.execute("SELECT value FROM options WHERE key = 'scan'").fetchone()
+            if row is None or row[0] != scan_options:
+                # New catalog, or the source now points at a different folder or is scanned differently
+                conn.execute('DELETE FROM folders')
+                conn.execute('DELETE FROM media')
+                conn.execute("INSERT OR REPLACE INTO options VALUES ('scan', ?)", (scan_options,))
+                # Seeded from the clock so versions keep increasing when a catalog is started afresh
+                conn.execute("INSERT OR REPLACE INTO options VALUES ('version', ?)", (time.time_ns() // 1000,))
+            self._sync(conn)
+
+    def _stored_version(self, conn):
+        row = conn.execute("SELECT value FROM options WHERE key = 'version'").fetchone()
+        return int(row[0]) if row else 0
+
+    def _sync(self, conn):
+        """
+        Takes up the version and folder mtimes other processes have written to the catalog file since this
+        one last read or wrote it (their entries are read from it as they are needed). Returns True if the
+        entries changed. Called holding the lock.
+        """
+        self._folder_mtimes = dict(conn.execute('SELECT path, mtime FROM folders'))
+        version = self._stored_version(conn)
+        changed = version != self._version
+        self._version = version
+        return changed
+
+    def _reader(self):
+        """
+        This thread's connection to the catalog file for reading entries, opened on first use.
+        """
+        conn = getattr(self._readers, 'conn', None)
+        if conn is None:
+            # Only used by this thread, but closed by close()
+            conn = sqlite3.connect(self.catalog_file, timeout=30, check_same_thread=False)
+            self._readers.conn = conn
+            with self._lock:
+                self._reader_conns.append(conn)
+        return conn
+
+    def close(self):
+        self._scanner.close()
+        with self._lock:
+            for conn in self._reader_conns:
+                conn.close()
+            self._reader_conns = []
+        self._readers = threading.local()
+
+    def _write(self, conn, upserts: list, deletes: list, folder_mtimes: dict):
+        if upserts or deletes:
+            version = self._version + 1
+            if upserts:
+                conn.executemany('INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?)', upserts)
+            if deletes:
+                conn.executemany('DELETE FROM media WHERE name = ?', deletes)
+            conn.execute("UPDATE options SET value = ? WHERE key = 'version'", (version,))
+            self._version = version
+        if folder_mtimes != self._folder_mtimes:
+            conn.execute('DELETE FROM folders')
+            conn.executemany('INSERT INTO folders VALUES (?, ?)', folder_mtimes.items())
+
+    def _stat_entry(self, name: str):
+        try:
+            stat = os.stat(os.path.join(self.media_folder, name))
+        except FileNotFoundError:
+            return None
+        if not S_ISREG(stat.st_mode):
+            return None
+        content_type, _ = guess_type(name)
+        return (stat.st_size, stat.st_mtime, content_type)
+
+    def refresh(self, force: bool = False):
+        """
+        Brings the catalog up to date with the media folder. Returns True if anything changed.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not force and self.watched:
+                return False
+            if not force and (now - self._last_checked) < self.refresh_interval:
+                return False
+            self._last_checked = now
+
+            # A stat per known folder is far cheaper than a rescan, and adding, removing or
+            # renaming a file (or subfolder) changes the mtime of the folder that holds it
+            folder_mtimes = self._scanner.folder_mtimes(self.media_folder, self._folder_mtimes)
+            if not force and folder_mtimes == self._folder_mtimes:
+                return False
+
+            with self._connect(write=True) as conn:
+                # Another worker process may have already scanned the change
+                synced = self._sync(conn)
+                if not force and self._scanner.folder_mtimes(self.media_folder, self._folder_mtimes) == self._folder_mtimes:
+                    return synced
+
+                scanned, folder_mtimes = self._scanner.scan(self.media_folder)
+                # Compared with the stored entries as they are read, so they are never all held at once
+                deletes, unchanged = [], set()
+                for name, values in CatalogEntries(conn).items():
+                    scanned_values = scanned.get(name, None)
+                    if scanned_values is None:
+                        deletes.append((name,))
+                    elif scanned_values == values:
+                        unchanged.add(name)
+                upserts = [(name, *values) for name, values in scanned.items() if name not in unchanged]
+
+                self._write(conn, upserts, deletes, folder_mtimes)
+                self._folder_mtimes = folder_mtimes
+
+            if upserts or deletes:
+                print(f'Catalog refreshed: {self.media_folder} ({len(upserts)} updated, {len(deletes)} removed)')
+
+            return bool(synced or upserts or deletes)
+
+    def apply_events(self, names: list):
+        """
+        Applies a batch of watcher events (names of created, changed, deleted or renamed files)
+        to the listing without rescanning the folder. Returns True if anything changed.
+        """
+        with self._lock, self._connect(write=True) as conn:
+            # Every worker process's watcher sees the same events, and the first to apply them writes them
+            synced = self._sync(conn)
+
+            entries = CatalogEntries(conn)
+            upserts, deletes = [], []
+            for name in set(names):
+                values = self._stat_entry(name) if self._scanner.is_media_file(os.path.basename(name)) else None
+                if values is None:
+                    if name in entries:
+                        deletes.append((name,))
+                elif entries.get(name) != values:
+                    upserts.append((name, *values))
+
+            if not (upserts or deletes):
+                return synced
+
+            folder_mtimes = dict(self._folder_mtimes)
+            folder_mtimes.update(self._scanner.folder_mtimes(self.media_folder, [self.media_folder]))
+
+            self._write(conn, upserts, deletes, folder_mtimes)
+            self._folder_mtimes = folder_mtimes
+
+            return True
+
+    @property
+    def version(self):
+        return self._version
+
+    def entries(self):
+        """
+        The entries (a CatalogEntries mapping of name: (size, mtime, content_type)), read from the catalog file.
+        """
+        self.refresh()
+        return CatalogEntries(self._reader())
+
+    def _sort_index_file(self, version: int):
+        return f'{os.path.splitext(self.catalog_file)[0]}.{version}.sortindex'
+
+    @contextmanager
+    def _snapshot(self):
+        """
+        (connection, version) to read one version of the entries with, in a single read transaction.
+        """
+        with self._connect() as conn:
+            conn.execute('BEGIN')
+            yield conn, self._stored_version(conn)
+
+    def _shared_sort_index(self, version: int):
+        """
+        The sort index of a version (or of a later one another process has written since), from its file
+        beside the catalog file, which the first process to need it writes. Every worker process maps the
+        same file, so one copy of the index (and of the name index beside it) is held in memory however
+        many workers there are. Files of older versions are removed (see _remove_sort_indexes).
+        """
+        index_file = self._sort_index_file(version)
+        try:
+            if not os.path.isfile(index_file):
+                with self._snapshot() as (conn, version):
+                    index_file = self._sort_index_file(version)
+                    if not os.path.isfile(index_file):
+                        write_sort_index(index_file, CatalogEntries(conn), version)
+            index = MediaSortIndex.mapped(index_file)
+        except (OSError, ValueError) as e:
+            print('Sort index file unavailable, building it in memory:', index_file, str(e))
+            with self._snapshot() as (conn, version):
+                index = MediaSortIndex(CatalogEntries(conn), version)
+        self._remove_sort_indexes(index.version)
+        return index
+
+    def _remove_sort_indexes(self, version: int):
+        """
+        Removes the sort and name index files of versions older than version. On POSIX a process still
+        mapping one keeps it until it lets go of it. Windows refuses to remove a mapped file (PermissionError),
+        so those are left for the next build, in whichever process, to try again.
+        """
+        prefix = glob.escape(os.path.splitext(self.catalog_file)[0])
+        for old_file in glob.glob(f'{prefix}.*.sortindex') + glob.glob(f'{prefix}.*.nameindex'):
+            old_version = old_file.rsplit('.', 2)[-2]
+            if old_version.isdigit() and int(old_version) < version:
+                try:
+                    os.remove(old_file)
+                except FileNotFoundError:
+                    # Removed by another process
+                    pass
+                except PermissionError as e:
+                    print('Sort index file still in use, removing it later:', old_file, str(e))
+                except OSError as e:
+                    print('Sort index file not removed:', old_file, str(e))
+
+    def sort_index(self, build: bool = True):
+        """
+        MediaSortIndex over the current entries, rebuilt after they change. With build=False the first
+        request for a new version returns None instead (a one-off query is cheaper to answer by top-k
+        selection than by sorting everything), and the next request builds the index.
+        """
+        self.refresh()
+        with self._lock:
+            version, index = self._version, self._sort_index
+            if index is not None and index.version >= version:
+                return index
+            if not build and self._sort_index_deferred != version:
+                self._sort_index_deferred = version
+                return None
+
+        index = self._shared_sort_index(version)
+        with self._lock:
+            if self._sort_index is None or self._sort_index.version < index.version:
+                self._sort_index = index
+        return self._sort_index
+
+    def entry(self, name: str):
+        """
+        The entry of name, or None. Editing a file in place doesn't change its folder's mtime, so polling
+        doesn't see it: unless the catalog is watched, the file is stat'ed again here, and a changed entry
+        is applied (as a watcher event would be) before it is served, moving the listing version on.
+        """
+        entries = CatalogEntries(self._reader())
+        entry = entries.get(name)
+        if entry is None:
+            if self.refresh():
+                entry = entries.get(name)
+        elif not self.watched and self._stat_entry(name) != entry:
+            self.apply_events([name])
+            entry = entries.get(name)
+        return entry
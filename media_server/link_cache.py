@@ -0,0 +1,301 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+from mimetypes import guess_type
+from urllib.parse import urlsplit
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+FETCH_CHUNK_SIZE = 64 * 1024
+
+# How stale a cached link's last use time may get before it is written back (it only orders evictions)
+USED_WRITE_SECS = 60
+
+# Evictions make room down to this share of the budget, in batches of the least recently used copies
+EVICT_LOW_WATER = 0.9
+EVICT_BATCH = 64
+
+class MediaLinkCache():
+
+    def __init__(
+        self, cache_folder: str, max_bytes: int, workers: int = 4,
+        revalidate_secs: float = 3600, timeout: float = 30
+    ):
+        """
+        Fetch-through disk cache of remote media links, so link sources can be served (and resized) by the
+        media server like files in a media folder.
+
+        Links are fetched on a pool of workers threads, each link once however many requests wait for
+        it. Cached copies older than revalidate_secs are served as they are while a conditional request
+        revalidates them in the background. The index (an SQLite file in cache_folder) is shared by server
+        worker processes, and keeps a running total of the copies' sizes: the least recently used copies are
+        evicted when it goes over max_bytes.
+        """
+        self.cache_folder = os.path.abspath(cache_folder)
+        self.max_bytes = max_bytes
+        self.workers = max(1, int(workers))
+        self.revalidate_secs = revalidate_secs
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._executor = None
+        self._session = None
+        self._fetching = {}  # url -> Future of its fetch (or revalidation)
+        self._entries = {}   # url -> (file, size, mtime, content_type, etag, last_modified, fetched)
+        self._used = {}      # url -> last use written to the index
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(self.cache_folder, exist_ok=True)
+        self.index_file = os.path.join(self.cache_folder, 'links.sqlite')
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS links (url TEXT PRIMARY KEY, file TEXT, size INTEGER, mtime REAL, '
+                'content_type TEXT, etag TEXT, last_modified TEXT, fetched REAL, used REAL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS links_used ON links (used)')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)')
+            # Summed once, when an index from before the running total is first opened
+            conn.execute("INSERT OR IGNORE INTO meta SELECT 'bytes', COALESCE(SUM(size), 0) FROM links")
+
+    @staticmethod
+    def link_name(url: str):
+        """
+        The media file name a link is listed and served as: a digest of the URL, with the extension of its
+        path when it has one (links like '.../photos/<id>/download' don't).
+        """
+        ext = os.path.splitext(urlsplit(url).path)[1].lower()
+        ext = ext if guess_type(f'file{ext}')[0] else ''
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()[:20] + ext
+
+    @contextmanager
+    def _connect(self, write: bool = False):
+        conn = sqlite3.connect(self.index_file, timeout=30)
+        try:
+            with conn:
+                if write:
+                    conn.execute('BEGIN IMMEDIATE')
+                yield conn
+        finally:
+            conn.close()
+
+    def close(self):
+        with self._lock:
+            if self._executor:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+            if self._session:
+                self._session.close()
+                self._session = None
+
+    def _entry(self, url: str):
+        entry = self._entries.get(url, None)
+        if entry is None or not os.path.isfile(entry[0]):
+            # Another server process may have fetched it (or evicted it)
+            with self._connect() as conn:
+                row = conn.execute(
+                    'SELECT file, size, mtime, content_type, etag, last_modified, fetched FROM links WHERE url = ?', (url,)
+                ).fetchone()
+            entry = tuple(row) if row and os.path.isfile(row[0]) else None
+            with self._lock:
+                if entry:
+                    self._entries[url] = entry
+                else:
+                    self._entries.pop(url, None)
+        return entry
+
+    def _submit(self, url: str, entry):
+        with self._lock:
+            future = self._fetching.get(url, None)
+            if future is None:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='media-link-fetch')
+                    self._session = requests.Session()
+                future = self._executor.submit(self._fetch, url, entry)
+                self._fetching[url] = future
+                future.add_done_callback(lambda _future: self._fetched(url, _future))
+        return future
+
+    def _fetched(self, url: str, future):
+        with self._lock:
+            if self._fetching.get(url, None) is future:
+                del self._fetching[url]
+
+    def prefetch(self, urls: list):
+        """
+        Starts fetching the links in urls that aren't cached (or are due for revalidation) in the background.
+        """
+        for url in urls:
+            entry = self._entry(url)
+            if entry is None or time.time() - entry[6] > self.revalidate_secs:
+                self._submit(url, entry)
+
+    def entry(self, url: str):
+        """
+        (file, size, mtime, content_type) of the cached copy of url, fetching it first if it isn't cached.
+        Raises FileNotFoundError when the origin doesn't have it.
+        """
+        entry = self._entry(url)
+        if entry is None:
+            self.misses += 1
+            entry = self._submit(url, None).result()
+        else:
+            self.hits += 1
+            if time.time() - entry[6] > self.revalidate_secs:
+                self._submit(url, entry)
+
+        now = time.time()
+        with self._lock:
+            write = now - self._used.get(url, 0.0) > USED_WRITE_SECS
+            if write:
+                self._used[url] = now
+        if write:
+            with self._connect() as conn:
+                conn.execute('UPDATE links SET used = ? WHERE url = ?', (now, url))
+
+        return entry[:4]
+
+    def _fetch(self, url: str, entry):
+        """
+        Fetches url into the cache (conditionally when entry, its cached copy, is given), returning its entry.
+        A failed revalidation leaves the cached copy to be served.
+        """
+        headers = {}
+        if entry:
+            if entry[4]:
+                headers['If-None-Match'] = entry[4]
+            if entry[5]:
+                headers['If-Modified-Since'] = entry[5]
+
+        try:
+            response = self._session.get(url, headers=headers, stream=True, timeout=self.timeout)
+        except requests.RequestException as e:
+            if entry:
+                print('Link revalidation failed, serving the cached copy:', url, str(e))
+                return entry
+            raise
+
+        with response:
+            now = time.time()
+            if entry and response.status_code == 304:
+                entry = entry[:6] + (now,)
+                with self._connect() as conn:
+                    conn.execute('UPDATE links SET fetched = ? WHERE url = ?', (now, url))
+                with self._lock:
+                    self._entries[url] = entry
+                return entry
+
+            if response.status_code in (404, 410):
+                self._remove(url)
+                raise FileNotFoundError(url)
+            if not response.ok:
+                if entry:
+                    print('Link revalidation failed, serving the cached copy:', url, response.status_code)
+                    return entry
+                response.raise_for_status()
+
+            key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+            cache_file = os.path.join(self.cache_folder, key[:2], key)
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            # Written aside and moved into place, so readers never see part of a file
+            partial_file = f'{cache_file}.{os.getpid()}.{threading.get_ident()}.part'
+            try:
+                with open(partial_file, 'wb') as f:
+                    for chunk in response.iter_content(FETCH_CHUNK_SIZE):
+                        f.write(chunk)
+                os.replace(partial_file, cache_file)
+            finally:
+                if os.path.exists(partial_file):
+                    os.remove(partial_file)
+
+            # Guessed from the link's path when the origin doesn't say, and served as bytes when that fails too
+            content_type = (
+                response.headers.get('Content-Type', '').split(';')[0].strip()
+                or guess_type(urlsplit(url).path)[0] or 'application/octet-stream'
+            )
+            last_modified = response.headers.get('Last-Modified', None)
+            try:
+                # The origin's modification time when it gives one, so an unchanged link keeps its validators
+                mtime = parsedate_to_datetime(last_modified).timestamp() if last_modified else now
+            except (TypeError, ValueError):
+                mtime = now
+            entry = (
+                cache_file, os.path.getsize(cache_file), mtime, content_type,
+                response.headers.get('ETag', None), last_modified, now
+            )
+
+        with self._connect(write=True) as conn:
+            total = conn.execute("SELECT value FROM meta WHERE key = 'bytes'").fetchone()[0]
+            previous = conn.execute('SELECT size FROM links WHERE url = ?', (url,)).fetchone()
+            total += entry[1] - (previous[0] if previous else 0)
+            conn.execute('INSERT OR REPLACE INTO links VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (url, *entry, now))
+            if total > self.max_bytes:
+                total = self._evict(conn, total, keep=url)
+            conn.execute("UPDATE meta SET value = ? WHERE key = 'bytes'", (total,))
+        with self._lock:
+            self._entries[url] = entry
+            self._used[url] = now
+        return entry
+
+    def _remove(self, url: str):
+        with self._connect(write=True) as conn:
+            row = conn.execute('SELECT file, size FROM links WHERE url = ?', (url,)).fetchone()
+            if row:
+                conn.execute('DELETE FROM links WHERE url = ?', (url,))
+                conn.execute("UPDATE meta SET value = value - ? WHERE key = 'bytes'", (row[1],))
+        with self._lock:
+            self._entries.pop(url, None)
+            self._used.pop(url, None)
+        if row:
+            try:
+                os.remove(row[0])
+            except FileNotFoundError:
+                pass
+
+    def _evict(self, conn, total: int, keep: str):
+        """
+        Removes the least recently used copies (other than keep's), a batch at a time, until the cache is
+        within EVICT_LOW_WATER of its budget. Returns the new total.
+        """
+        low_water = int(self.max_bytes * EVICT_LOW_WATER)
+        while total > low_water:
+            rows = conn.execute(
+                'SELECT url, file, size FROM links WHERE url != ? ORDER BY used LIMIT ?', (keep, EVICT_BATCH)
+            ).fetchall()
+            if not rows:
+                break
+            evicted = []
+            for url, cache_file, size in rows:
+                if total <= low_water:
+                    break
+                try:
+                    os.remove(cache_file)
+                except FileNotFoundError:
+                    pass
+                evicted.append((url,))
+                total -= size
+
+            conn.executemany('DELETE FROM links WHERE url = ?', evicted)
+            with self._lock:
+                for url, in evicted:
+                    self._entries.pop(url, None)
+                    self._used.pop(url, None)
+            self.evictions += len(evicted)
+        return total
+
+    def stats(self):
+        with self._connect() as conn:
+            entries = conn.execute('SELECT COUNT(*) FROM links').fetchone()[0]
+            size = conn.execute("SELECT value FROM meta WHERE key = 'bytes'").fetchone()[0]
+        return {
+            'entries': entries, 'bytes': size, 'max_bytes': self.max_bytes,
+            'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+        }
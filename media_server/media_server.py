@@ -1,12 +1,39 @@
 import os
 import sys
-from typing import Union
-from fastapi import FastAPI
+import gzip
+import zlib
+import json
+import signal
+import asyncio
+import multiprocessing
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union, List
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi import FastAPI, Request
 from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, RedirectResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel
 import toml
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 from media_service import MediaService
+from media_cache import MediaCache
+from renditions import accepted_types
+from wire import MEDIA_BATCH_CONTENT_TYPE, BATCH_NOT_FOUND, batch_record_header, MEDIA_LIST_CONTENT_TYPE, encode_media_list
+from metrics import ServerMetrics, MetricsMiddleware, METRICS_CONTENT_TYPE
+from profiling import ProfilingMiddleware, profiled
 
 dir = os.path.abspath(os.path.dirname(__file__))
 
@@ -14,9 +41,98 @@ dir = os.path.abspath(os.path.dirname(__file__))
 server_settings = toml.load(os.path.join(dir, 'media_server.toml'))
 HOST = server_settings['HOST']
 PORT = server_settings['PORT']
+MEDIA_CACHE_CONTROL = server_settings.get('MEDIA_CACHE_CONTROL', 'public, max-age=3600')
+MEDIA_LIST_CACHE_CONTROL = server_settings.get('MEDIA_LIST_CACHE_CONTROL', 'no-cache')
+# Content codings are only offered when they can be produced
+MEDIA_LIST_ENCODINGS = [
+    encoding for encoding in server_settings.get('MEDIA_LIST_ENCODINGS', ['br', 'gzip'])
+    if encoding == 'gzip' or (encoding == 'br' and brotli is not None)
+]
+MEDIA_LIST_COMPRESS_MIN_BYTES = int(server_settings.get('MEDIA_LIST_COMPRESS_MIN_BYTES', 1024))
+MEDIA_LIST_CACHE_MB = float(server_settings.get('MEDIA_LIST_CACHE_MB', 64))
+MEDIA_BATCH_MAX_FILES = int(server_settings.get('MEDIA_BATCH_MAX_FILES', 1000))
+METRICS_ENABLED = bool(server_settings.get('METRICS_ENABLED', True))
+PROFILE_TOKEN = str(server_settings.get('PROFILE_TOKEN', ''))
+PROFILE_FOLDER = server_settings.get('PROFILE_FOLDER', './.media_profiles')
+PROFILE_SAMPLE_RATE = float(server_settings.get('PROFILE_SAMPLE_RATE', 0.0))
+IO_WORKERS = int(server_settings.get('IO_WORKERS', 16))
+WORKERS = int(server_settings.get('WORKERS', 1))
+SHUTDOWN_TIMEOUT = float(server_settings.get('SHUTDOWN_TIMEOUT', 30))
+
+# Each worker process would count only the requests it served, and a scrape reaches whichever worker accepts
+# it, so metrics are only kept by a single process server
+if METRICS_ENABLED and WORKERS > 1:
+    print('Metrics are disabled with WORKERS > 1 (each worker would only report its own requests)')
+    METRICS_ENABLED = False
+
+MEDIA_BATCH_CHUNK_SIZE = 64 * 1024
+
+# Fast enough to keep up with the network for multi-MB listings, at most of the best levels' size
+MEDIA_LIST_GZIP_LEVEL = 6
+MEDIA_LIST_BROTLI_QUALITY = 5
 
 CORS_ALLOW_ORIGINS = ['http://{HOST}, https://{HOST}, http://localhost, http://localhost:4010, http://localhost:8765']
 
+def _cache_headers(etag: str, cache_control: str, last_modified: Union[float, None] = None):
+    headers = {'ETag': etag, 'Cache-Control': cache_control}
+    if last_modified is not None:
+        headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+    return headers
+
+def _not_modified(request: Request, etag: str, last_modified: Union[float, None] = None):
+    """
+    True if the request's validators show the client already has the current representation.
+    If-None-Match takes precedence over If-Modified-Since (RFC 9110, 13.2.2).
+    """
+    if_none_match = request.headers.get('if-none-match', None)
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        return '*' in tags or etag.removeprefix('W/') in tags
+
+    if_modified_since = request.headers.get('if-modified-since', None)
+    if if_modified_since and last_modified is not None:
+        try:
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+def _media_list_representation(request: Request):
+    """
+    (media type, content coding or None) of the /media_list response for the request's Accept and
+    Accept-Encoding headers. The compact encoding is sent when it's accepted at least as readily as JSON.
+    """
+    accepted = accepted_types(request.headers.get('accept', ''))
+    compact = accepted.get(MEDIA_LIST_CONTENT_TYPE, 0.0)
+    media_type = MEDIA_LIST_CONTENT_TYPE if compact > 0 and compact >= accepted.get('application/json', 0.0) else 'application/json'
+
+    codings = accepted_types(request.headers.get('accept-encoding', ''))
+    encoding = next((encoding for encoding in MEDIA_LIST_ENCODINGS if codings.get(encoding, 0.0) > 0), None)
+    return media_type, encoding
+
+def _media_list_body(listing: dict, media_type: str, encoding: Union[str, None]):
+    """
+    (body, content coding or None) of a /media_list response. Small bodies are sent uncompressed.
+    """
+    if media_type == MEDIA_LIST_CONTENT_TYPE:
+        body = encode_media_list(listing)
+    elif orjson is not None:
+        body = orjson.dumps(listing)
+    else:
+        body = json.dumps(listing, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    if encoding is None or len(body) < MEDIA_LIST_COMPRESS_MIN_BYTES:
+        return body, None
+    if encoding == 'br':
+        return brotli.compress(body, quality=MEDIA_LIST_BROTLI_QUALITY), encoding
+    return gzip.compress(body, compresslevel=MEDIA_LIST_GZIP_LEVEL, mtime=0), encoding
+
+class MediaBatchRequest(BaseModel):
+    media_files: List[str]
+    width: Union[int, None] = None
+    quality: Union[int, None] = None
+
 class MediaServerAPI_Wrapper(FastAPI):
 
     def __init__(self):
@@ -28,6 +144,24 @@ class MediaServerAPI_Wrapper(FastAPI):
         super().__init__()
 
         MS = MediaService()
+        media_encodings = MS.media_encodings()
+
+        # MediaService calls block on the filesystem (catalog scans, stats, reads), so async routes
+        # run them on this pool and the event loop keeps serving other requests meanwhile
+        self.io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='media_io')
+
+        # Encoded (and compressed) /media_list bodies, keyed by query and representation ETag
+        media_list_bodies = MediaCache(int(MEDIA_LIST_CACHE_MB * 1024 * 1024))
+
+        async def offload(fn, *args, **kwargs):
+            return await asyncio.get_running_loop().run_in_executor(self.io_executor, profiled(partial(fn, *args, **kwargs)))
+
+        def close():
+            self.io_executor.shutdown(wait=False, cancel_futures=True)
+            MS.close()
+
+        # Runs once uvicorn has drained in-flight requests, so nothing is cut off by closing the service
+        self.router.on_shutdown.append(close)
 
         origins = CORS_ALLOW_ORIGINS
 
@@ -39,6 +173,20 @@ class MediaServerAPI_Wrapper(FastAPI):
             allow_headers=["*"],
         )
 
+        # Only installed when profiling can be triggered, so requests otherwise pay nothing for it
+        if PROFILE_TOKEN or PROFILE_SAMPLE_RATE:
+            self.add_middleware(
+                ProfilingMiddleware,
+                profile_folder=PROFILE_FOLDER,
+                token=PROFILE_TOKEN,
+                sample_rate=PROFILE_SAMPLE_RATE,
+            )
+
+        # Added last, so it is the outermost middleware and times everything else
+        self.metrics = ServerMetrics()
+        if METRICS_ENABLED:
+            self.add_middleware(MetricsMiddleware, metrics=self.metrics)
+
         def custom_openapi():
             from fastapi.openapi.utils import get_openapi
 
@@ -65,39 +213,131 @@ class MediaServerAPI_Wrapper(FastAPI):
         async def home():
             return RedirectResponse(url='/docs', status_code=307)
 
-        @self.get("/media_full_path/{source}/{media_file}")
+        @self.get("/media_full_path/{source}/{media_file:path}")
         async def media_full_path(source: str, media_file: str):
             try:
                 return JSONResponse(
-                    MS.media_full_path(source=source, media_file=media_file),
+                    await offload(MS.media_full_path, source=source, media_file=media_file),
                     status_code=200
                 )
             except Exception as e:
                 return Response(str(e), status_code=404)
 
-        @self.get("/media/{source}/{media_file}")
-        async def media(source: str, media_file: str, encode: bool = False):
+        # Names in recursive sources are relative paths (e.g. trips/beach.jpg), so media_file matches across slashes
+        @self.get("/media/{source}/{media_file:path}")
+        async def media(
+            request: Request,
+            source: str, media_file: str, encode: bool = False,
+            width: Union[int, None] = None, quality: Union[int, None] = None
+        ):
             try:
-                content = MS.media(source=source, media_file=media_file, encode=encode)
-                content_type = MS.content_type(source=source, media_file=media_file)
-                return Response(content, media_type=content_type, status_code=200)
+                # Browsers that accept a modern format (e.g. AVIF or WebP) are sent media transcoded to it
+                accept = request.headers.get('accept', None) if media_encodings else None
+                # The file served, its type and validators, rendering a rendition if it isn't cached
+                rendition = await offload(
+                    MS.media_rendition, source=source, media_file=media_file, width=width, quality=quality, accept=accept
+                )
+                etag = rendition['etag'][:-1] + '-b64"' if encode else rendition['etag']
+                headers = _cache_headers(etag, MEDIA_CACHE_CONTROL, rendition['last_modified'])
+                if media_encodings:
+                    # So shared caches don't hand one client's format to another
+                    headers['Vary'] = 'Accept'
+                if _not_modified(request, etag, rendition['last_modified']):
+                    return Response(status_code=304, headers=headers)
+
+                if encode:
+                    content = await offload(
+                        MS.media, source=source, media_file=media_file, encode=encode,
+                        width=width, quality=quality, accept=accept, rendition=rendition
+                    )
+                    return Response(content, media_type=rendition['content_type'], status_code=200, headers=headers)
+                # Raw media is streamed from disk in chunks (with Range / 206 support), never read into memory whole
+                return FileResponse(rendition['media_file_path'], media_type=rendition['content_type'], headers=headers)
             except Exception as e:
                 return Response(str(e), status_code=404)
 
-        @self.get("/delete_media/{source}/{media_file}")
+        @self.post("/media_batch/{source}")
+        async def media_batch(source: str, batch: MediaBatchRequest):
+            if len(batch.media_files) > MEDIA_BATCH_MAX_FILES:
+                return Response(f'At most {MEDIA_BATCH_MAX_FILES} media files per batch', status_code=413)
+            if source not in MS.MEDIA_SOURCES:
+                return Response(f'Unknown media source: {source}', status_code=404)
+
+            # A sync generator, so Starlette iterates it (and its file reads) in a worker thread
+            def records():
+                for media_file in batch.media_files:
+                    try:
+                        rendition = MS.media_rendition(source=source, media_file=media_file, width=batch.width, quality=batch.quality)
+                        etag, content_type = rendition['etag'], rendition['content_type']
+                        media_f = open(rendition['media_file_path'], 'rb')
+                    except Exception:
+                        yield batch_record_header(media_file, None, None, 0, status=BATCH_NOT_FOUND)
+                        continue
+
+                    with media_f:
+                        length = os.fstat(media_f.fileno()).st_size
+                        yield batch_record_header(media_file, content_type, etag, length)
+                        remaining = length
+                        while remaining > 0:
+                            chunk = media_f.read(min(MEDIA_BATCH_CHUNK_SIZE, remaining))
+                            if not chunk:
+                                # The file shrank after it was opened; pad to keep the framing intact
+                                chunk = bytes(remaining)
+                            remaining -= len(chunk)
+                            yield chunk
+
+            return StreamingResponse(
+                records(),
+                media_type=MEDIA_BATCH_CONTENT_TYPE,
+                headers={'Cache-Control': MEDIA_CACHE_CONTROL}
+            )
+
+        @self.get("/contact_sheet/{source}")
+        async def contact_sheet(
+            request: Request,
+            source: str,
+            sheet: int = 0,
+            columns: int = 5,
+            img_w: int = 256,
+            rows: int = 1,
+            limit: Union[int, None] = None,
+            filter_string: Union[str, None] = None,
+            sort_flag: bool = False,
+            sort_by_date_flag: bool = True,
+            ascending: bool = False,
+            quality: Union[int, None] = None,
+            sort_by_size_flag: bool = False,
+            ignore_case: bool = False
+        ):
+            try:
+                contact_sheet = await offload(
+                    MS.contact_sheet, source=source, sheet=sheet, columns=columns, cell_width=img_w, rows=rows, limit=limit,
+                    filter_string=filter_string, sort_flag=sort_flag, sort_by_date_flag=sort_by_date_flag,
+                    ascending=ascending, quality=quality, sort_by_size_flag=sort_by_size_flag, ignore_case=ignore_case
+                )
+                headers = _cache_headers(contact_sheet['etag'], MEDIA_LIST_CACHE_CONTROL)
+                if _not_modified(request, contact_sheet['etag']):
+                    return Response(status_code=304, headers=headers)
+                return FileResponse(contact_sheet['contact_sheet'], media_type='image/jpeg', headers=headers)
+            except ValueError as e:
+                return Response(str(e), status_code=400)
+            except Exception as e:
+                return Response(str(e), status_code=404)
+
+        @self.get("/delete_media/{source}/{media_file:path}")
         def delete_media(source: str, media_file: str):
             try:
-                return Response(
+                return JSONResponse(
                     MS._rename_file_with_prefix(source, media_file, 'DEL'),
                     status_code=200
                 )
             except Exception as e:
                 return Response(str(e), status_code=404)
 
-        @self.get("/favorite_media/{source}/{media_file}")
+        @self.get("/favorite_media/{source}/{media_file:path}")
         def favorite_media(source: str, media_file: str):
             try:
-                return Response(
+                return JSONResponse(
                     MS._rename_file_with_prefix(source, media_file, 'FAV'),
                     status_code=200
                 )
@@ -105,63 +345,129 @@ class MediaServerAPI_Wrapper(FastAPI):
                 return Response(str(e), status_code=404)
 
         @self.get("/media_sources")
-        async def media_sources():
-            return JSONResponse(MS.media_sources(), status_code=200)
+        async def media_sources(request: Request):
+            media_sources = MS.media_sources()
+            etag = f'"{zlib.crc32(json.dumps(media_sources, sort_keys=True).encode("utf-8")):x}"'
+            headers = _cache_headers(etag, MEDIA_LIST_CACHE_CONTROL)
+            if _not_modified(request, etag):
+                return Response(status_code=304, headers=headers)
+            return JSONResponse(media_sources, status_code=200, headers=headers)
+
+        @self.get("/media_list_version/{source}")
+        async def media_list_version(source: str):
+            try:
+                return JSONResponse(
+                    await offload(MS.media_list_version, source=source),
+                    status_code=200,
+                    headers={'Cache-Control': 'no-store'}
+                )
+            except Exception as e:
+                return Response(str(e), status_code=404)
 
         @self.get("/media_list/{source}")
         async def media_list(
+            request: Request,
             source: str, 
             filter_string: Union[str, None] = None, 
             sort_flag: bool = False,
             sort_by_date_flag: bool = True,
-            ascending: bool = False
+            ascending: bool = False,
+            limit: Union[int, None] = None,
+            cursor: Union[str, None] = None,
+            sort_by_size_flag: bool = False,
+            ignore_case: bool = False
         ):
             try:
-                return JSONResponse(
-                    MS.media_list(
-                        source=source, 
-                        filter_string=filter_string, 
-                        sort_flag=sort_flag, 
-                        sort_by_date_flag=sort_by_date_flag, 
-                        ascending=ascending
-                    ),
-                    status_code=200
-                )
+                # The list for a given query (URL) only changes when the listing version does
+                version = (await offload(MS.media_list_version, source=source))['media_list_version']
+                # Each representation (format and compression) of the list has its own tag
+                media_type, encoding = _media_list_representation(request)
+                representation = f'{"-c" if media_type == MEDIA_LIST_CONTENT_TYPE else ""}{"-" + encoding if encoding else ""}'
+                etag = f'"{version:x}{representation}"'
+                headers = _cache_headers(etag, MEDIA_LIST_CACHE_CONTROL)
+                headers['Vary'] = 'Accept, Accept-Encoding'
+                if _not_modified(request, etag):
+                    return Response(status_code=304, headers=headers)
+
+                key = (source, request.url.query, etag)
+                body = media_list_bodies.get(key)
+                if body is None:
+                    # Listing, encoding and compressing a large source all take a while, so none runs on the loop
+                    def media_list_body():
+                        return _media_list_body(
+                            MS.media_list(
+                                source=source, 
+                                filter_string=filter_string, 
+                                sort_flag=sort_flag, 
+                                sort_by_date_flag=sort_by_date_flag, 
+                                ascending=ascending,
+                                limit=limit,
+                                cursor=cursor,
+                                sort_by_size_flag=sort_by_size_flag,
+                                ignore_case=ignore_case
+                            ),
+                            media_type,
+                            encoding
+                        )
+
+                    body = await offload(media_list_body)
+                    media_list_bodies.put(key, body, len(body[0]))
+
+                content, content_encoding = body
+                if content_encoding:
+                    headers['Content-Encoding'] = content_encoding
+                return Response(content, status_code=200, media_type=media_type, headers=headers)
+            except ValueError as e:
+                return Response(str(e), status_code=400)
             except Exception as e:
                 return Response(str(e), status_code=500)
 
+        @self.get("/metrics")
+        async def metrics():
+            if not METRICS_ENABLED:
+                return Response('Metrics are disabled (METRICS_ENABLED = false, or WORKERS > 1)', status_code=404)
+            return Response(self.metrics.render(MS.cache_stats()), media_type=METRICS_CONTENT_TYPE)
+
         # Add shutdown event (would only be of any use in a multi-process, not multi-thread situation)
         @self.get("/shutdown")
         async def shutdown():
-            import time
-            import psutil
-            import threading
-
-            def suicide():
-                time.sleep(1)
-                myself = psutil.Process(os.getpid())
-                myself.kill()
+            def drain_and_exit():
+                # uvicorn stops accepting connections on SIGTERM, then lets in-flight requests finish (for up to
+                # SHUTDOWN_TIMEOUT) before exiting. With several workers, the supervisor process is signalled
+                # and it stops every worker the same way.
+                parent = multiprocessing.parent_process()
+                os.kill(parent.pid if parent and WORKERS > 1 else os.getpid(), signal.SIGTERM)
 
             try:
-                threading.Thread(target=suicide, daemon=True).start()
-                msg = '>>> Successfully killed API <<<'
+                msg = '>>> Shutting down API (draining requests in flight) <<<'
                 print(msg)
-                return Response(msg, status_code=200)
+                # Sent after this response, so the caller gets it before the server stops
+                return Response(msg, status_code=200, background=BackgroundTask(drain_and_exit))
             except Exception as e:
                 return Response(str(e), status_code=500)
 
 """
 Simple bootstrapper intended to be used used to start the API as a daemon process
 """
-app = MediaServerAPI_Wrapper()
+# Run as a script (or re-run as __mp_main__ in spawned worker processes), uvicorn imports this module again by
+# name to get the app, so building one here too would only start an unused media service in every process
+if __name__ not in ('__main__', '__mp_main__'):
+    app = MediaServerAPI_Wrapper()
 
 # Wrapping uvicorn import in try/except as have issues in Streamlit cloud
 # The test client application runs uvicorn directly with media_server:app
 def start(host=HOST, port=PORT):
     try:
         import uvicorn
+        import inspect
         from pathlib import Path
-        uvicorn.run(f'{Path(__file__).stem}:app', host=host, port=port) # reload=True, workers=2
+        options = dict(host=host, port=port, workers=WORKERS)
+        # Older uvicorn releases (before 0.22) wait for in-flight requests without a time limit
+        if 'timeout_graceful_shutdown' in inspect.signature(uvicorn.Config).parameters:
+            options['timeout_graceful_shutdown'] = SHUTDOWN_TIMEOUT
+        else:
+            print('This uvicorn release has no graceful shutdown timeout, SHUTDOWN_TIMEOUT is ignored')
+        uvicorn.run(f'{Path(__file__).stem}:app', **options)
     except Exception as msg:
         print('EXCEPTION ecountered running uvicorn!')
         print(str(msg))
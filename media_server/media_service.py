@@ -2,24 +2,156 @@ import os
 from typing import Union
 from mimetypes import guess_type
 import toml
-import glob
+import json
+import zlib
 import base64
+import threading
+from collections import OrderedDict
+
+try:
+    from .catalog import MediaCatalog
+    from .watcher import MediaFolderWatcher
+    from .renditions import MediaRenditions, RENDITION_ENCODINGS
+    from .media_cache import MediaCache
+    from .link_cache import MediaLinkCache
+    from .sort_index import LinkListing, top_k
+    from .name_index import MediaFilter
+except ImportError:
+    from catalog import MediaCatalog
+    from watcher import MediaFolderWatcher
+    from renditions import MediaRenditions, RENDITION_ENCODINGS
+    from media_cache import MediaCache
+    from link_cache import MediaLinkCache
+    from sort_index import LinkListing, top_k
+    from name_index import MediaFilter
+
+MEDIA_LIST_CACHE_SIZE = 64
 
 class MediaService():
 
-    def __init__(self):
+    def __init__(self, settings_file: Union[str, None] = None):
         """
         Initializes instance to serve media (image) files.
+        Settings come from settings_file, else the file named by the MEDIA_SERVICE_SETTINGS environment
+        variable, else media_service.toml (or media_service.example.toml) beside this module.
         """
         print('Initializing MediaService...')
         
         dir = os.path.abspath(os.path.dirname(__file__))
-        if os.path.isfile(os.path.join(dir, 'media_service.toml')):
+        settings_file = settings_file or os.environ.get('MEDIA_SERVICE_SETTINGS', None)
+        if settings_file:
+            service_settings = toml.load(settings_file)
+        elif os.path.isfile(os.path.join(dir, 'media_service.toml')):
             service_settings = toml.load(os.path.join(dir, 'media_service.toml'))
         else:
             service_settings = toml.load(os.path.join(dir, 'media_service.example.toml'))
 
         self.MEDIA_SOURCES, self.MEDIA_TYPES = service_settings['MEDIA_SOURCES'], service_settings['MEDIA_TYPES']
+        self.CATALOG_FOLDER = service_settings.get('CATALOG_FOLDER', './.media_catalog')
+        self.CATALOG_REFRESH_SECS = float(service_settings.get('CATALOG_REFRESH_SECS', 5))
+        self.WATCH_MEDIA_FOLDERS = bool(service_settings.get('WATCH_MEDIA_FOLDERS', True))
+        self.SCAN_WORKERS = int(service_settings.get('SCAN_WORKERS', 8))
+        self.RENDITIONS_FOLDER = service_settings.get('RENDITIONS_FOLDER', './.media_renditions')
+        self.RENDITION_WIDTHS = service_settings.get('RENDITION_WIDTHS', [64, 128, 256, 384, 512, 768, 1024, 1536, 2048])
+        self.RENDITION_QUALITY = int(service_settings.get('RENDITION_QUALITY', 85))
+        self.RENDITION_WORKERS = int(service_settings.get('RENDITION_WORKERS', 2))
+        self.RENDITION_ENCODINGS = service_settings.get('RENDITION_ENCODINGS', ['image/avif', 'image/webp'])
+        self.MEDIA_CACHE_MB = float(service_settings.get('MEDIA_CACHE_MB', 0))
+        self.LINK_CACHE_FOLDER = service_settings.get('LINK_CACHE_FOLDER', './.media_links')
+        self.LINK_CACHE_MB = float(service_settings.get('LINK_CACHE_MB', 512))
+        self.LINK_FETCH_WORKERS = int(service_settings.get('LINK_FETCH_WORKERS', 4))
+        self.LINK_REVALIDATE_SECS = float(service_settings.get('LINK_REVALIDATE_SECS', 3600))
+
+        self._catalogs = {}
+        self._catalogs_lock = threading.Lock()
+
+        # Built media lists, invalidated by listing version rather than by time
+        self._media_list_cache = OrderedDict()
+        self._media_list_cache_lock = threading.Lock()
+        self._media_list_cache_hits = 0
+        self._media_list_cache_misses = 0
+
+        self._watcher = None
+        if self.WATCH_MEDIA_FOLDERS and MediaFolderWatcher.available():
+            try:
+                self._watcher = MediaFolderWatcher()
+            except Exception as e:
+                print('Media folder watching unavailable, falling back to polling:', str(e))
+
+        self._renditions = MediaRenditions(
+            renditions_folder=self.RENDITIONS_FOLDER,
+            widths=self.RENDITION_WIDTHS,
+            quality=self.RENDITION_QUALITY,
+            workers=self.RENDITION_WORKERS,
+            encodings=self.RENDITION_ENCODINGS,
+        )
+
+        # Optional byte-budgeted cache of media file bytes (off by default, the OS page cache usually suffices)
+        self._media_cache = MediaCache(int(self.MEDIA_CACHE_MB * 1024 * 1024)) if self.MEDIA_CACHE_MB > 0 else None
+
+        # Link sources with cache_links = true are listed by cache file name ({source: {name: link}}) and served
+        # from the link cache, instead of handing clients the links themselves
+        self._link_names = {
+            source: {MediaLinkCache.link_name(link): link for link in media_source.get('media_links', None) or []}
+            for source, media_source in self.MEDIA_SOURCES.items()
+            if media_source.get('cache_links', False) and not media_source.get('media_folder', None)
+        }
+        self._link_cache = MediaLinkCache(
+            cache_folder=self.LINK_CACHE_FOLDER,
+            max_bytes=int(self.LINK_CACHE_MB * 1024 * 1024),
+            workers=self.LINK_FETCH_WORKERS,
+            revalidate_secs=self.LINK_REVALIDATE_SECS,
+        ) if self._link_names else None
+
+    def close(self):
+        if self._watcher:
+            self._watcher.close()
+            self._watcher = None
+        for catalog in self._catalogs.values():
+            catalog.close()
+        self._renditions.close()
+        if self._link_cache:
+            self._link_cache.close()
+
+    def _catalog(self, source: str):
+        catalog = self._catalogs.get(source, None)
+        if catalog is None:
+            with self._catalogs_lock:
+                catalog = self._catalogs.get(source, None)
+                if catalog is None:
+                    media_source = self.MEDIA_SOURCES[source]
+                    catalog = MediaCatalog(
+                        catalog_file=os.path.join(self.CATALOG_FOLDER, MediaCatalog.catalog_file_name(source)),
+                        media_folder=media_source['media_folder'],
+                        media_extensions=[media_type.split('/')[-1] for media_type in self.MEDIA_TYPES],
+                        refresh_interval=self.CATALOG_REFRESH_SECS,
+                        recursive=bool(media_source.get('recursive', False)),
+                        scan_workers=self.SCAN_WORKERS,
+                    )
+                    # The watcher only sees a folder's immediate children, so recursive sources are polled
+                    if self._watcher and not catalog.recursive:
+                        self._watcher.watch(catalog)
+                    self._catalogs[source] = catalog
+        return catalog
+
+    def _media_entry(self, source: str, media_file: str):
+        if source in self._link_names:
+            link = self._link_names[source].get(media_file, None)
+            if link is None:
+                raise FileNotFoundError(media_file)
+            filename, *entry = self._link_cache.entry(link)
+            return filename, tuple(entry)
+
+        media_source = self.MEDIA_SOURCES[source]
+        media_folder = media_source['media_folder']
+
+        filename = os.path.join(media_folder, media_file)
+
+        entry = self._catalog(source).entry(media_file)
+        if entry is None:
+            raise FileNotFoundError(filename)
+
+        return filename, entry
 
     def _image_bytes(self, image):
         with open(image, 'rb') as image_f:
@@ -35,8 +167,10 @@ class MediaService():
         media_source = self.MEDIA_SOURCES[source]
         media_folder = media_source['media_folder']
 
-        src = os.path.join(media_folder, media_file)
-        dest = os.path.join(media_folder, f'{prefix}_{media_file}')
+        # Only cataloged files are renamed, so a name can't reach outside the media folder (e.g. with '../')
+        src, _entry = self._media_entry(source, media_file)
+        media_dir, media_name = os.path.split(media_file)
+        dest = os.path.join(media_folder, media_dir, f'{prefix}_{media_name}')
 
         if not os.path.isfile(src):
             raise FileNotFoundError(src)
@@ -46,40 +180,125 @@ class MediaService():
             print("Renamed:", src, 'to', dest)
         except Exception as e:
             raise e
+
+        self._catalog(source).refresh(force=True)
         
         return True
 
     def media_full_path(self, source: str, media_file: str):
-        media_source = self.MEDIA_SOURCES[source]
-        media_folder = media_source['media_folder']
+        filename, _entry = self._media_entry(source, media_file)
 
-        filename = os.path.join(media_folder, media_file)
+        return {'media_full_path': filename}
 
-        if not os.path.isfile(filename):
-            raise FileNotFoundError(filename)
+    def media_encodings(self):
+        """
+        Media types (in order of preference) that media is transcoded to for clients whose Accept header
+        lists them. /media responses vary by Accept when there are any.
+        """
+        return list(self._renditions.encodings)
 
-        return {'media_full_path': filename}
+    def media_rendition(
+        self, source: str, media_file: str,
+        width: Union[int, None] = None, quality: Union[int, None] = None, accept: Union[str, None] = None
+    ):
+        """
+        What a request for media_file is served as: the path of the original or a rendition (when a width is
+        given or accept, an Accept header, takes one of the media encodings) with its rendition variant (None
+        for the original), content type, strong entity tag and last modified time. Renditions are rendered if
+        they aren't cached, so a request needs only this one call.
+        """
+        filename, (size, mtime, content_type) = self._media_entry(source, media_file)
+        variant = None
+        if width or accept:
+            filename, variant = self._renditions.rendition(
+                source, media_file, filename,
+                mtime=mtime, size=size, content_type=content_type,
+                width=width, quality=quality, accept=accept
+            )
+
+        etag = f'{size:x}-{int(mtime * 1000000):x}'
+        if variant:
+            content_type = variant[2]
+            etag = f'{etag}-w{variant[0] or 0}q{variant[1]}'
+            if variant[2] in RENDITION_ENCODINGS:
+                etag = f'{etag}-{RENDITION_ENCODINGS[variant[2]][1]}'
+        elif not content_type:
+            content_type, _ = guess_type(filename)
+
+        return {
+            'media_file_path': filename,
+            'variant': variant,
+            'content_type': content_type,
+            'etag': f'"{etag}"',
+            'last_modified': mtime,
+        }
+
+    def content_type(
+        self, source: str, media_file: str,
+        width: Union[int, None] = None, quality: Union[int, None] = None, accept: Union[str, None] = None
+    ):
+        return self.media_rendition(source, media_file, width=width, quality=quality, accept=accept)['content_type']
 
-    def content_type(self, source: str, media_file: str):
-        media_source = self.MEDIA_SOURCES[source]
-        media_folder = media_source['media_folder']
+    def media_file_path(
+        self, source: str, media_file: str,
+        width: Union[int, None] = None, quality: Union[int, None] = None, accept: Union[str, None] = None
+    ):
+        """
+        Path of the file to serve for media_file: the original, or a rendition when a width is given or
+        accept (an Accept header) takes one of the media encodings.
+        """
+        return self.media_rendition(source, media_file, width=width, quality=quality, accept=accept)['media_file_path']
 
-        filename = os.path.join(media_folder, media_file)
+    def media_validators(
+        self, source: str, media_file: str,
+        width: Union[int, None] = None, quality: Union[int, None] = None, accept: Union[str, None] = None
+    ):
+        """
+        Strong entity tag and last modified time of the file media_file (or its rendition) is served as.
+        """
+        rendition = self.media_rendition(source, media_file, width=width, quality=quality, accept=accept)
+        return {'etag': rendition['etag'], 'last_modified': rendition['last_modified']}
 
-        content_type, _ = guess_type(filename)
+    def media(
+        self, source: str, media_file: str, encode: bool = False,
+        width: Union[int, None] = None, quality: Union[int, None] = None, accept: Union[str, None] = None,
+        rendition: Union[dict, None] = None
+    ):
+        """
+        Bytes (or base64) of what media_file is served as. rendition is what media_rendition returned for the
+        same arguments, when the caller already has it.
+        """
+        if rendition is None:
+            rendition = self.media_rendition(source, media_file, width=width, quality=quality, accept=accept)
+        filename = rendition['media_file_path']
 
-        return content_type
+        if self._media_cache is None:
+            return self._image_base64(filename) if encode else self._image_bytes(filename)
 
-    def media(self, source: str, media_file: str, encode: bool = False):
-        media_source = self.MEDIA_SOURCES[source]
-        media_folder = media_source['media_folder']
+        # One raw copy is cached; base64 is derived on demand
+        key = (source, media_file, rendition['etag'])
+        media_bytes = self._media_cache.get(key)
+        if media_bytes is None:
+            media_bytes = self._image_bytes(filename)
+            self._media_cache.put(key, media_bytes, len(media_bytes))
 
-        filename = os.path.join(media_folder, media_file)
+        return base64.b64encode(media_bytes).decode('utf-8') if encode else media_bytes
 
-        if not os.path.isfile(filename):
-            raise FileNotFoundError(filename)
-        
-        return self._image_base64(filename) if encode else self._image_bytes(filename)
+    def cache_stats(self):
+        """
+        Hit and miss counts of the service's caches: built listings, renditions and (if enabled) cached links
+        and media bytes. Those bounded by size (links and media) also report their entries, bytes, max_bytes
+        and evictions.
+        """
+        stats = {
+            'media_list': {'hits': self._media_list_cache_hits, 'misses': self._media_list_cache_misses},
+            'renditions': {'hits': self._renditions.hits, 'misses': self._renditions.misses},
+        }
+        if self._link_cache:
+            stats['links'] = self._link_cache.stats()
+        if self._media_cache:
+            stats['media'] = self._media_cache.stats()
+        return stats
 
     def delete_media(self, source: str, media_file: str):
         return self._rename_file_with_prefix(source, media_file, 'DEL')
@@ -90,54 +309,190 @@ class MediaService():
     def media_sources(self):
         return {'media_sources': self.MEDIA_SOURCES}
 
-    def media_list(
-        self, source: str, 
-        filter_string: Union[str, None] = None,
-        sort_flag: bool = False, 
-        sort_by_date_flag: bool = True,
-        ascending: bool = False
-    ):
+    def media_list_version(self, source: str):
+        """
+        Version of a source's listing, which changes whenever the listing does (increasing for media folders).
+        """
         source = source.replace('(', '').replace(')', '').replace('"', '').strip()
+        media_source = self.MEDIA_SOURCES[source]
+        if media_source.get('media_folder', None):
+            catalog = self._catalog(source)
+            catalog.refresh()
+            version = catalog.version
+        else:
+            # Links only change with the service configuration, so their version is a fingerprint of it
+            version = zlib.crc32(json.dumps(media_source, sort_keys=True).encode('utf-8'))
+        return {'media_list_version': version}
 
-        # https://thispointer.com/python-get-list-of-files-in-directory-sorted-by-date-and-time/
-        def _get_sorted(media_files):
-            
-            # sorted() sorts alphabetical + ascending by default
-            # With a date key it does an ascending date sort
-            # For descending (not ascending) we just reverse the list
-
-            def _media_file_date(x):
-                # Getting the last modified time of the file.
-                return os.path.getmtime(x)
-
-            if sort_flag and sort_by_date_flag:
-                media_files = sorted(media_files, key=_media_file_date, reverse=(not ascending))
-            elif sort_flag:
-                media_files = sorted(media_files, reverse=(not ascending))
+    def _encode_cursor(self, mode: str, key):
+        cursor = json.dumps([mode, key], separators=(',', ':')).encode('utf-8')
+        return base64.urlsafe_b64encode(cursor).decode('ascii').rstrip('=')
 
-            return media_files
+    def _decode_cursor(self, mode: str, cursor: str):
+        try:
+            cursor_mode, key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        except Exception:
+            raise ValueError(f'Invalid media list cursor: {cursor}')
+        if cursor_mode != mode:
+            raise ValueError(f'Media list cursor does not match the requested sort order: {cursor}')
+        return tuple(key) if isinstance(key, list) else key
+
+    def _sort_mode(self, source: str, sort_flag: bool, sort_by_date_flag: bool, sort_by_size_flag: bool):
+        if not self.MEDIA_SOURCES[source].get('media_folder', None):
+            return 'links'
+        if sort_flag and sort_by_size_flag:
+            return 'size'
+        if sort_flag and sort_by_date_flag:
+            return 'date'
+        # Unsorted folder listings come in name order, which keeps their pages stable
+        return 'name'
+
+    def _media_listing(
+        self, source: str, filter_string: Union[str, None], mode: str, defer: bool = False, ignore_case: bool = False
+    ):
+        """
+        A source's filtered listing in a sort order, ascending by its sort key, built once per listing version.
+        With defer=True the listing is None when building it would mean building a new sort index first.
+        """
 
         def _get_media_list():
             media_source = self.MEDIA_SOURCES[source]
-            media_files = []
             media_filter = filter_string if filter_string else media_source['media_filter']
-            if media_source.get('media_folder', None):
-                media_folder = media_source['media_folder']
-                unfiltered_media_files = glob.glob(f'{media_folder}/*.*')
-                for media_type in self.MEDIA_TYPES:
-                    file_extension = media_type.split('/')[-1]
-                    media_type_files = filter(lambda x: file_extension in x, unfiltered_media_files)
-                    media_files.extend(media_type_files)
-                media_files = _get_sorted(media_files)
-                media_files = [url.replace(f'{media_folder}\\','').replace(f'{media_folder}/','') for url in media_files]
-            elif media_source.get('media_links', None):
-                media_files = media_source['media_links']
-
-            if bool(media_filter):
-                media_files = [media_file for media_file in media_files if media_filter in media_file]
-
-            return media_files, media_filter
-
-        media_files, media_filter = _get_media_list()
-
-        return {'media_list': media_files, 'media_filter': media_filter}
+            if mode == 'links':
+                media_files = media_source.get('media_links', None) or []
+                if bool(media_filter):
+                    match = MediaFilter(media_filter, ignore_case).match
+                    media_files = [media_file for media_file in media_files if match(media_file)]
+                if source in self._link_names:
+                    # Links are still filtered by URL, but listed by the names they are served as,
+                    # and fetched into the cache in the background ahead of the requests for them
+                    self._link_cache.prefetch(media_files)
+                    media_files = [MediaLinkCache.link_name(media_file) for media_file in media_files]
+                listing = LinkListing(media_files)
+            else:
+                # The filter is applied to the catalog's shared sort and name indexes, so no sorting happens here
+                sort_index = self._catalog(source).sort_index(build=not defer)
+                listing = sort_index.listing(mode, media_filter, ignore_case) if sort_index else None
+
+            return {'listing': listing, 'media_filter': media_filter}
+
+        version = self.media_list_version(source)['media_list_version']
+        cache_key = (source, filter_string, mode, ignore_case)
+        with self._media_list_cache_lock:
+            listing = self._media_list_cache.get(cache_key, None)
+            if listing and listing['media_list_version'] == version:
+                self._media_list_cache.move_to_end(cache_key)
+                self._media_list_cache_hits += 1
+            else:
+                listing = None
+                self._media_list_cache_misses += 1
+
+        if listing is None:
+            listing = _get_media_list()
+            listing['media_list_version'] = version
+            if listing['listing'] is not None:
+                with self._media_list_cache_lock:
+                    self._media_list_cache[cache_key] = listing
+                    self._media_list_cache.move_to_end(cache_key)
+                    while len(self._media_list_cache) > MEDIA_LIST_CACHE_SIZE:
+                        self._media_list_cache.popitem(last=False)
+
+        return listing
+
+    def contact_sheet(
+        self, source: str, sheet: int, columns: int, cell_width: int,
+        rows: int = 1, limit: Union[int, None] = None,
+        filter_string: Union[str, None] = None,
+        sort_flag: bool = False,
+        sort_by_date_flag: bool = True,
+        ascending: bool = False,
+        quality: Union[int, None] = None,
+        sort_by_size_flag: bool = False,
+        ignore_case: bool = False
+    ):
+        """
+        One composited image of the media_list entries [sheet * columns * rows, (sheet + 1) * columns * rows),
+        laid out as rows of columns cells, each cell_width pixels wide.
+        """
+        source = source.replace('(', '').replace(')', '').replace('"', '').strip()
+        media_source = self.MEDIA_SOURCES[source]
+        if not (media_source.get('media_folder', None) or source in self._link_names):
+            raise ValueError(f'Contact sheets are only available for media folder and cached link sources: {source}')
+        if not (1 <= columns <= 80 and 32 <= cell_width <= 1024 and 1 <= rows <= 50 and sheet >= 0):
+            raise ValueError('Contact sheets need 1-80 columns, 32-1024 pixel cells, 1-50 rows and a sheet >= 0')
+
+        mode = self._sort_mode(source, sort_flag, sort_by_date_flag, sort_by_size_flag)
+        listing = self._media_listing(source, filter_string, mode, ignore_case=ignore_case)['listing']
+        count = min(len(listing), limit) if limit and limit > 0 else len(listing)
+        start, end = sheet * columns * rows, min((sheet + 1) * columns * rows, count)
+        if start >= end:
+            raise FileNotFoundError(f'No contact sheet {sheet} for {source}')
+
+        if sort_flag and not ascending and mode != 'links':
+            names = listing.names(len(listing) - end, len(listing) - start)[::-1]
+        else:
+            names = listing.names(start, end)
+
+        cells = []
+        for name in names:
+            try:
+                filename, (size, mtime, _content_type) = self._media_entry(source, name)
+                cells.append((source, name, filename, mtime, size))
+            except OSError:
+                cells.append(None)
+
+        sheet_file = self._renditions.contact_sheet(cells, columns=columns, cell_width=cell_width, quality=quality)
+        return {'contact_sheet': sheet_file, 'etag': f'"{os.path.splitext(os.path.basename(sheet_file))[0]}"'}
+
+    def media_list(
+        self, source: str, 
+        filter_string: Union[str, None] = None,
+        sort_flag: bool = False, 
+        sort_by_date_flag: bool = True,
+        ascending: bool = False,
+        limit: Union[int, None] = None,
+        cursor: Union[str, None] = None,
+        sort_by_size_flag: bool = False,
+        ignore_case: bool = False
+    ):
+        source = source.replace('(', '').replace(')', '').replace('"', '').strip()
+        limit = limit if limit and limit > 0 else None
+
+        # Listings are held ascending by a stable, unique sort key (date + name, size + name, name, or link position),
+        # so a page is located by bisecting for the cursor's key and pages don't shift as files come and go.
+        # For descending (not ascending) order pages are read backwards from the end.
+
+        mode = self._sort_mode(source, sort_flag, sort_by_date_flag, sort_by_size_flag)
+        descending = sort_flag and (not ascending) and mode != 'links'
+        key = self._decode_cursor(mode, cursor) if cursor else None
+
+        listing = self._media_listing(source, filter_string, mode, defer=bool(limit and not cursor), ignore_case=ignore_case)
+        version = listing['media_list_version']
+
+        if listing['listing'] is None:
+            # First page of a listing that changed since its sort index was built: select just the page
+            # (O(n log limit)) and leave building the index to the next query
+            page, matched = top_k(self._catalog(source).entries(), mode, limit, descending, listing['media_filter'], ignore_case)
+            media_files = [media_file for media_file, _ in page]
+            last_key, more = (page[-1][1] if page else None), matched > len(page)
+        elif descending:
+            sorted_listing = listing['listing']
+            end = sorted_listing.bisect(key) if cursor else len(sorted_listing)
+            start = max(0, end - limit) if limit else 0
+            media_files = sorted_listing.names(start, end)[::-1]
+            last_key, more = (sorted_listing.key(start) if media_files else None), start > 0
+        else:
+            sorted_listing = listing['listing']
+            start = sorted_listing.bisect(key, right=True) if cursor else 0
+            end = min(len(sorted_listing), start + limit) if limit else len(sorted_listing)
+            media_files = sorted_listing.names(start, end)
+            last_key, more = (sorted_listing.key(end - 1) if media_files else None), end < len(sorted_listing)
+
+        next_cursor = self._encode_cursor(mode, last_key) if (limit and more and media_files) else None
+
+        return {
+            'media_list': media_files,
+            'media_filter': listing['media_filter'],
+            'media_list_version': version,
+            'next_cursor': next_cursor,
+        }
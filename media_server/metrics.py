@@ -0,0 +1,169 @@
+from time import perf_counter
+from bisect import bisect_left
+
+# Histogram bucket upper bounds (Prometheus 'le' labels), spanning page cache hits to slow renders
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(**labels):
+    return '{' + ','.join(f'{name}="{_label(value)}"' for name, value in labels.items()) + '}'
+
+class Histogram():
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, **labels):
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{_labels(**labels, le=bound)} {cumulative}')
+        lines.append(f'{name}_bucket{_labels(**labels, le="+Inf")} {self.count}')
+        lines.append(f'{name}_sum{_labels(**labels)} {self.sum}')
+        lines.append(f'{name}_count{_labels(**labels)} {self.count}')
+        return lines
+
+class ServerMetrics():
+
+    def __init__(self):
+        """
+        Request counters and histograms for the media server, rendered in the Prometheus text format.
+        They are only updated from the event loop (by MetricsMiddleware), so they need no locking.
+        """
+        self.requests = {}        # (method, route, status) -> count
+        self.latency = {}         # route -> Histogram of seconds
+        self.response_bytes = {}  # route -> Histogram of body sizes
+        self.in_flight = 0
+
+    def observe(self, method: str, route: str, status: int, seconds: float, size: int):
+        key = (method, route, status)
+        self.requests[key] = self.requests.get(key, 0) + 1
+
+        latency = self.latency.get(route, None)
+        if latency is None:
+            latency = self.latency[route] = Histogram(LATENCY_BUCKETS)
+            self.response_bytes[route] = Histogram(SIZE_BUCKETS)
+        latency.observe(seconds)
+        self.response_bytes[route].observe(size)
+
+    def render(self, cache_stats: dict = None):
+        """
+        The metrics as Prometheus text exposition, with hit and miss counts from cache_stats
+        ({cache: {'hits': n, 'misses': n}}) when given, and the sizes and evictions of the caches that
+        report them ('entries', 'bytes', 'max_bytes' and 'evictions').
+        """
+        lines = [
+            '# HELP media_server_requests_total Requests served, by method, route and status code.',
+            '# TYPE media_server_requests_total counter',
+        ]
+        for (method, route, status), count in sorted(self.requests.items()):
+            lines.append(f'media_server_requests_total{_labels(method=method, route=route, status=status)} {count}')
+
+        lines += [
+            '# HELP media_server_request_duration_seconds Time to send the whole response, by route.',
+            '# TYPE media_server_request_duration_seconds histogram',
+        ]
+        for route, histogram in sorted(self.latency.items()):
+            lines += histogram.render('media_server_request_duration_seconds', route=route)
+
+        lines += [
+            '# HELP media_server_response_size_bytes Response body sizes, by route.',
+            '# TYPE media_server_response_size_bytes histogram',
+        ]
+        for route, histogram in sorted(self.response_bytes.items()):
+            lines += histogram.render('media_server_response_size_bytes', route=route)
+
+        lines += [
+            '# HELP media_server_requests_in_flight Requests being handled.',
+            '# TYPE media_server_requests_in_flight gauge',
+            f'media_server_requests_in_flight {self.in_flight}',
+        ]
+
+        if cache_stats:
+            for kind in ('hits', 'misses'):
+                lines += [
+                    f'# HELP media_server_cache_{kind}_total Cache lookups that {"found" if kind == "hits" else "missed"} an entry, by cache.',
+                    f'# TYPE media_server_cache_{kind}_total counter',
+                ]
+                for cache, stats in sorted(cache_stats.items()):
+                    lines.append(f'media_server_cache_{kind}_total{_labels(cache=cache)} {stats[kind]}')
+            lines += [
+                '# HELP media_server_cache_hit_ratio Share of cache lookups that were hits, by cache.',
+                '# TYPE media_server_cache_hit_ratio gauge',
+            ]
+            for cache, stats in sorted(cache_stats.items()):
+                lookups = stats['hits'] + stats['misses']
+                lines.append(f'media_server_cache_hit_ratio{_labels(cache=cache)} {stats["hits"] / lookups if lookups else 0.0}')
+
+            # Caches bounded by size also report what they hold
+            bounded = sorted((cache, stats) for cache, stats in cache_stats.items() if 'bytes' in stats)
+            for name, key, kind, description in (
+                ('media_server_cache_entries', 'entries', 'gauge', 'Entries held, by cache.'),
+                ('media_server_cache_size_bytes', 'bytes', 'gauge', 'Bytes held, by cache.'),
+                ('media_server_cache_max_bytes', 'max_bytes', 'gauge', 'Budget the cache is kept within, by cache.'),
+                ('media_server_cache_evictions_total', 'evictions', 'counter', 'Entries evicted to stay within budget, by cache.'),
+            ):
+                if not bounded:
+                    break
+                lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+                for cache, stats in bounded:
+                    lines.append(f'{name}{_labels(cache=cache)} {stats[key]}')
+
+        return '\n'.join(lines) + '\n'
+
+class MetricsMiddleware():
+
+    def __init__(self, app, metrics: ServerMetrics):
+        """
+        Plain ASGI middleware (no per-request tasks or body buffering, unlike BaseHTTPMiddleware) that
+        records each HTTP request's route template, status, duration and body size in metrics.
+        """
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = perf_counter()
+        status, content_length, size = 500, 0, 0
+
+        async def send_recording(message):
+            nonlocal status, content_length, size
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                for name, value in message.get('headers', ()):
+                    if name == b'content-length':
+                        content_length = int(value)
+            elif message['type'] == 'http.response.body':
+                size += len(message.get('body', b''))
+            await send(message)
+
+        metrics = self.metrics
+        metrics.in_flight += 1
+        try:
+            await self.app(scope, receive, send_recording)
+        finally:
+            metrics.in_flight -= 1
+            # The router leaves the matched route in the scope, so paths are labelled by their template
+            route = scope.get('route', None)
+            metrics.observe(
+                scope['method'], getattr(route, 'path', 'unmatched'), status,
+                perf_counter() - start, size or content_length
+            )
@@ -0,0 +1,207 @@
+import os
+import re
+import mmap
+import struct
+import threading
+from array import array
+from bisect import bisect_left
+from fnmatch import translate
+
+_GLOB_CHARS = re.compile(r'[*?[]')
+_GLOB_WILDCARDS = re.compile(r'\[!?\]?[^\]]*\]|[*?]')
+
+# Name index files are a header, then the trigrams (in order) and their posting lists in native byte order
+# (they are only read on the machine that wrote them), each array padded to 8 bytes:
+#
+#   magic | name count (u64) | trigram count (u64)
+#   trigram offsets (u64, count + 1) | posting offsets (u64, count + 1) | postings (u32) | trigrams (utf-8)
+NAME_INDEX_MAGIC = b'MNAMEIX1'
+_NAME_INDEX_HEADER = struct.Struct('=8sQQ')
+
+def _trigrams(text: str):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class MediaFilter():
+
+    def __init__(self, pattern: str, ignore_case: bool = False):
+        """
+        A filename filter. Patterns with glob wildcards (*, ? or [...]) must match the whole name, so
+        'IMG_*' is a prefix filter, and other patterns match anywhere in it. Matching is case-sensitive
+        unless ignore_case is set.
+        """
+        self.pattern = pattern
+        self.ignore_case = ignore_case
+        self.glob = bool(_GLOB_CHARS.search(pattern))
+
+        needle = pattern.lower() if self.ignore_case else pattern
+        if self.glob:
+            regex = re.compile(translate(needle))
+            literals = _GLOB_WILDCARDS.split(needle)
+            # The text before the first wildcard, which every match starts with
+            self.prefix = literals[0]
+            if self.ignore_case:
+                self.match = lambda name: regex.match(name.lower()) is not None
+            else:
+                self.match = lambda name: regex.match(name) is not None
+        else:
+            literals = [needle]
+            self.prefix = ''
+            if self.ignore_case:
+                self.match = lambda name: needle in name.lower()
+            else:
+                self.match = lambda name: needle in name
+
+        # Runs of text every match contains, as the (lower case) keys of a MediaNameIndex
+        self.literals = [literal.lower() for literal in literals if len(literal) >= 3]
+
+def _padding(length: int):
+    return b'\0' * (-length % 8)
+
+class MappedNames():
+
+    def __init__(self, offsets, names):
+        """
+        Read-only sequence of the strings in a mapped index file, decoded when they are read.
+        """
+        self._offsets = offsets
+        self._names = names
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, position: int):
+        if position < 0:
+            position += len(self)
+        return str(self._names[self._offsets[position]:self._offsets[position + 1]], 'utf-8')
+
+    def __iter__(self):
+        return (self[position] for position in range(len(self)))
+
+class MappedPostings():
+
+    def __init__(self, trigrams: MappedNames, offsets, postings):
+        """
+        The posting lists of a mapped name index file by trigram, found by bisecting its sorted trigrams.
+        """
+        self._trigrams = trigrams
+        self._offsets = offsets
+        self._postings = postings
+
+    def get(self, trigram: str, default=None):
+        i = bisect_left(self._trigrams, trigram)
+        if i == len(self._trigrams) or self._trigrams[i] != trigram:
+            return default
+        return self._postings[self._offsets[i]:self._offsets[i + 1]]
+
+class MediaNameIndex():
+
+    def __init__(self, names: list):
+        """
+        Trigram index over the (lower cased) names of a sorted name list. Each trigram maps to the
+        ascending positions of the names that contain it, so the candidates for a filter are found
+        by intersecting its shortest posting lists, at a cost that follows the number of matches
+        rather than the number of names.
+        """
+        self.size = len(names)
+        self._postings = {trigram: array('I', posting) for trigram, posting in _postings(names).items()}
+
+    @staticmethod
+    def write(index_file: str, names):
+        """
+        Writes the name index of names to index_file, aside and then moved into place, so processes
+        mapping it never see part of a file.
+        """
+        postings = _postings(names)
+        trigrams = sorted(postings)
+        encoded = [trigram.encode('utf-8') for trigram in trigrams]
+        trigram_offsets, posting_offsets = array('Q', [0]), array('Q', [0])
+        for trigram, key in zip(trigrams, encoded):
+            trigram_offsets.append(trigram_offsets[-1] + len(key))
+            posting_offsets.append(posting_offsets[-1] + len(postings[trigram]))
+
+        partial_file = f'{index_file}.{os.getpid()}.{threading.get_ident()}.part'
+        try:
+            with open(partial_file, 'wb') as f:
+                f.write(_NAME_INDEX_HEADER.pack(NAME_INDEX_MAGIC, len(names), len(trigrams)))
+                f.write(_padding(_NAME_INDEX_HEADER.size))
+                for values in (trigram_offsets, posting_offsets):
+                    data = values.tobytes()
+                    f.write(data)
+                    f.write(_padding(len(data)))
+                length = 0
+                for trigram in trigrams:
+                    data = array('I', postings[trigram]).tobytes()
+                    f.write(data)
+                    length += len(data)
+                f.write(_padding(length))
+                f.write(b''.join(encoded))
+            os.replace(partial_file, index_file)
+        finally:
+            if os.path.exists(partial_file):
+                os.remove(partial_file)
+
+    @classmethod
+    def mapped(cls, index_file: str):
+        """
+        The name index in index_file (see write), memory-mapped rather than read, so every process using
+        the same file shares one copy of it in the page cache.
+        """
+        with open(index_file, 'rb') as f:
+            buffer = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        magic, size, count = _NAME_INDEX_HEADER.unpack_from(buffer)
+        if magic != NAME_INDEX_MAGIC:
+            raise ValueError(f'Not a name index file: {index_file}')
+
+        offset = _NAME_INDEX_HEADER.size + len(_padding(_NAME_INDEX_HEADER.size))
+        def section(fmt: str, length: int):
+            nonlocal offset
+            length *= struct.calcsize(fmt)
+            values = buffer[offset:offset + length].cast(fmt)
+            offset += length + len(_padding(length))
+            return values
+
+        trigram_offsets = section('Q', count + 1)
+        posting_offsets = section('Q', count + 1)
+        postings = section('I', posting_offsets[count])
+        trigrams = MappedNames(trigram_offsets, buffer[offset:offset + trigram_offsets[count]])
+
+        index = cls.__new__(cls)
+        index.size = size
+        index._postings = MappedPostings(trigrams, posting_offsets, postings)
+        return index
+
+    def candidates(self, media_filter: MediaFilter):
+        """
+        Ascending positions of the names that may match media_filter (a superset of the matches),
+        or None when the filter has no text long enough to look up, or matches too many names for
+        the index to beat a scan.
+        """
+        trigrams = set()
+        for literal in media_filter.literals:
+            trigrams.update(_trigrams(literal))
+        if not trigrams:
+            return None
+
+        postings = sorted((self._postings.get(trigram, ()) for trigram in trigrams), key=len)
+        if len(postings[0]) * 4 > self.size:
+            return None
+        candidates = postings[0]
+        for posting in postings[1:]:
+            if not candidates:
+                break
+            candidates = [position for position in candidates if _contains(posting, position)]
+        return candidates
+
+def _postings(names):
+    postings = {}
+    for position, name in enumerate(names):
+        for trigram in _trigrams(name.lower()):
+            posting = postings.get(trigram, None)
+            if posting is None:
+                posting = postings[trigram] = []
+            posting.append(position)
+    return postings
+
+def _contains(posting: array, position: int):
+    i = bisect_left(posting, position)
+    return i < len(posting) and posting[i] == position
@@ -0,0 +1,141 @@
+import os
+import io
+import re
+import time
+import hmac
+import random
+import pstats
+import asyncio
+import cProfile
+import contextvars
+from urllib.parse import parse_qs, parse_qsl, urlencode
+
+PROFILE_HEADER = b'x-profile'
+PROFILE_PARAM = 'profile'
+PROFILE_FILE_HEADER = b'x-profile-file'
+
+# Profiles of the work the request being profiled has offloaded to other threads
+_thread_profiles = contextvars.ContextVar('thread_profiles', default=None)
+
+def profiled(fn):
+    """
+    fn, wrapped to add a profile of itself to the current request's profile when the request is being
+    profiled. cProfile only sees its own thread, so work a request offloads to a pool goes through this.
+    """
+    profiles = _thread_profiles.get()
+    if profiles is None:
+        return fn
+
+    def run_profiled():
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # From Python 3.12 cProfile is built on sys.monitoring, which allows one profiler at a time and
+            # sees every thread, so the request's own profile already covers this thread
+            return fn()
+        try:
+            return fn()
+        finally:
+            profile.disable()
+            profiles.append(profile)
+
+    return run_profiled
+
+class ProfilingMiddleware():
+
+    def __init__(self, app, profile_folder: str, token: str = '', sample_rate: float = 0.0):
+        """
+        ASGI middleware that runs single requests under cProfile and saves each profile to profile_folder,
+        as a .prof file (for pstats, snakeviz etc.) with a .txt summary of the top functions beside it.
+
+        A request is profiled when it carries the admin token, in an X-Profile header or a profile query
+        parameter, or at random for a sample_rate fraction of traffic. Only one request is profiled at a
+        time. Work it offloads to threads is included when wrapped with profiled(), work done in other
+        processes (e.g. renditions) isn't captured.
+        """
+        self.app = app
+        self.profile_folder = os.path.abspath(profile_folder)
+        self.token = token.encode('utf-8') if token else b''
+        self.sample_rate = sample_rate
+        self._profiling = False
+
+    def _requested(self, scope):
+        if not self.token:
+            return False
+        for name, value in scope.get('headers', ()):
+            if name == PROFILE_HEADER:
+                return hmac.compare_digest(value, self.token)
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        values = query.get(PROFILE_PARAM, None)
+        return bool(values) and hmac.compare_digest(values[0].encode('utf-8'), self.token)
+
+    def _profile_file(self, scope):
+        path = re.sub(r'[^A-Za-z0-9_.-]+', '_', scope.get('path', '')).strip('_')[:80] or 'root'
+        now = time.time()
+        stamp = time.strftime('%Y%m%dT%H%M%S', time.localtime(now)) + f'{now % 1:.3f}'[1:]
+        return os.path.join(self.profile_folder, f'{stamp}_{scope["method"]}_{path}')
+
+    def _save(self, profiles: list, profile_file: str, scope, seconds: float):
+        os.makedirs(self.profile_folder, exist_ok=True)
+        summary = io.StringIO()
+        stats = pstats.Stats(*profiles, stream=summary)
+        stats.dump_stats(f'{profile_file}.prof')
+        # The admin token isn't written out with the request it profiled
+        query = urlencode([
+            (name, value) for name, value in parse_qsl(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True)
+            if name != PROFILE_PARAM
+        ])
+        summary.write(f'{scope["method"]} {scope.get("path", "")}{"?" + query if query else ""} took {seconds * 1000:.1f} ms\n')
+        stats.sort_stats('cumulative').print_stats(40)
+        with open(f'{profile_file}.txt', 'w') as f:
+            f.write(summary.getvalue())
+        print('Saved request profile:', f'{profile_file}.prof')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or self._profiling:
+            await self.app(scope, receive, send)
+            return
+
+        requested = self._requested(scope)
+        if not (requested or (self.sample_rate and random.random() < self.sample_rate)):
+            await self.app(scope, receive, send)
+            return
+
+        profile_file = self._profile_file(scope)
+
+        async def send_with_profile_file(message):
+            # An explicitly profiled request is told where its profile is saved
+            if requested and message['type'] == 'http.response.start':
+                message['headers'] = list(message.get('headers', ())) + [
+                    (PROFILE_FILE_HEADER, os.path.basename(f'{profile_file}.prof').encode('utf-8'))
+                ]
+            await send(message)
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # Another profiler is active (e.g. the server itself is run under cProfile)
+            print('Not profiling request:', str(e))
+            await self.app(scope, receive, send)
+            return
+        thread_profiles = []
+        thread_profiles_token = _thread_profiles.set(thread_profiles)
+        self._profiling = True
+        start = time.perf_counter()
+        try:
+            try:
+                await self.app(scope, receive, send_with_profile_file)
+            finally:
+                profile.disable()
+        finally:
+            seconds = time.perf_counter() - start
+            _thread_profiles.reset(thread_profiles_token)
+            self._profiling = False
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self._save, [profile] + thread_profiles, profile_file, scope, seconds
+                )
+            except Exception as e:
+                print('Failed to save request profile:', str(e))
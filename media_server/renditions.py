@@ -0,0 +1,402 @@
+import os
+import hashlib
+import warnings
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Formats Pillow can resize and re-encode without losing anything the browser would show (e.g. animation)
+RENDITION_FORMATS = {
+    'image/jpeg': ('JPEG', 'jpg'),
+    'image/jpg': ('JPEG', 'jpg'),
+    'image/png': ('PNG', 'png'),
+}
+
+# Smaller modern formats renditions can be encoded in, for clients whose Accept header lists them
+RENDITION_ENCODINGS = {
+    'image/avif': ('AVIF', 'avif'),
+    'image/webp': ('WEBP', 'webp'),
+}
+
+# Entries kept of what is known about media and renditions (image widths, which renditions are servable)
+RENDITION_MEMO_SIZE = 100000
+
+# Markers written beside an encoded rendition once it has been compared with the original format at its width
+SMALLER_MARKER = '.smaller'
+LARGER_MARKER = '.larger'
+
+def _avif_plugin():
+    # Pillow encodes AVIF itself from 11.2, earlier versions need the pillow-avif-plugin package
+    try:
+        import pillow_avif  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def encoder_available(image_format: str):
+    if Image is None:
+        return False
+    from PIL import features
+    if image_format == 'WEBP':
+        return features.check('webp')
+    if image_format == 'AVIF':
+        with warnings.catch_warnings():
+            # Pillow versions without AVIF support warn about the unknown feature
+            warnings.simplefilter('ignore')
+            return features.check('avif') or _avif_plugin()
+    return True
+
+def accepted_types(accept: str):
+    """
+    {media type: q} for the media types an Accept header names. Wildcards are left out, as clients sending
+    only */* or image/* can't be assumed to decode modern formats.
+    """
+    types = {}
+    for part in (accept or '').split(','):
+        media_type, *params = part.split(';')
+        media_type = media_type.strip().lower()
+        if not media_type or '*' in media_type:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        types[media_type] = q
+    return types
+
+def _render(src: str, dest: str, width: int, quality: int, image_format: str):
+    """
+    Resizes src to (at most) width pixels wide (unless width is None) and writes it to dest in image_format.
+    Runs in a worker process.
+    """
+    if image_format == 'AVIF':
+        _avif_plugin()
+    with Image.open(src) as image:
+        if width and image.width > width:
+            height = max(1, round(image.height * width / image.width))
+            image = image.resize((width, height), Image.LANCZOS)
+        if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        elif image_format in ('WEBP', 'AVIF') and image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if image.mode in ('LA', 'PA') or 'transparency' in image.info else 'RGB')
+        tmp = f'{dest}.{os.getpid()}.tmp'
+        if image_format == 'JPEG':
+            image.save(tmp, image_format, quality=quality, optimize=True, progressive=True)
+        elif image_format in ('WEBP', 'AVIF'):
+            image.save(tmp, image_format, quality=quality)
+        else:
+            image.save(tmp, image_format, optimize=True)
+    os.replace(tmp, dest)
+    return dest
+
+def _compare_rendition(src: str, rendition_file: str, fallback_file: str, width: int, quality: int, image_format: str):
+    """
+    Marks rendition_file as smaller (or not) than fallback_file, the original format at the same width, which is
+    rendered from src first if it isn't the original itself and isn't cached. Runs in a worker process.
+    """
+    if fallback_file != src and not os.path.isfile(fallback_file):
+        _render(src, fallback_file, width, quality, image_format)
+    smaller = os.path.getsize(rendition_file) < os.path.getsize(fallback_file)
+    with open(rendition_file + (SMALLER_MARKER if smaller else LARGER_MARKER), 'wb'):
+        pass
+    return smaller
+
+def _render_contact_sheet(cells: list, dest: str, columns: int, cell_width: int, gap: int, quality: int):
+    """
+    Composites cells (file paths, None for gaps) into a grid of columns cell_width pixels wide, with
+    each row as tall as its tallest image, and writes it to dest as a JPEG. Runs in a worker process.
+    """
+    thumbs = []
+    for src in cells:
+        thumb = None
+        if src:
+            try:
+                with Image.open(src) as image:
+                    height = max(1, round(image.height * cell_width / image.width))
+                    # For JPEGs, decode at the smallest DCT scale that still covers the cell
+                    image.draft('RGB', (cell_width, height))
+                    thumb = image.convert('RGB').resize((cell_width, height), Image.LANCZOS)
+            except Exception as e:
+                print(f'Contact sheet skipping {src}:', str(e))
+        thumbs.append(thumb)
+
+    rows = [thumbs[i:i + columns] for i in range(0, len(thumbs), columns)]
+    row_heights = [max([thumb.height for thumb in row if thumb] or [cell_width]) for row in rows]
+    sheet_size = (columns * cell_width + (columns - 1) * gap, sum(row_heights) + (len(rows) - 1) * gap)
+
+    sheet = Image.new('RGB', sheet_size, 'black')
+    y = 0
+    for row, row_height in zip(rows, row_heights):
+        for column, thumb in enumerate(row):
+            if thumb:
+                sheet.paste(thumb, (column * (cell_width + gap), y))
+        y += row_height + gap
+
+    tmp = f'{dest}.{os.getpid()}.tmp'
+    sheet.save(tmp, 'JPEG', quality=quality, optimize=True, progressive=True)
+    os.replace(tmp, dest)
+    return dest
+
+class MediaRenditions():
+
+    def __init__(self, renditions_folder: str, widths: list, quality: int = 85, workers: int = 2, encodings: list = None):
+        """
+        Produces resized renditions of media files in a process pool and keeps them in an on-disk
+        cache keyed by source, file, mtime, width bucket and format.
+
+        encodings are the modern media types (of RENDITION_ENCODINGS, in order of preference) that media is
+        transcoded to for clients that accept them. Those Pillow can't encode here are left out.
+        """
+        self.renditions_folder = os.path.abspath(renditions_folder)
+        self.widths = sorted(int(width) for width in widths)
+        self.quality = quality
+        self.workers = workers
+        self.encodings = [
+            media_type for media_type in (encodings or [])
+            if media_type in RENDITION_ENCODINGS and encoder_available(RENDITION_ENCODINGS[media_type][0])
+        ]
+
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = {}  # rendition file (or comparison marker) -> Future
+        self._widths = OrderedDict()     # (file, mtime, size) -> image width
+        self._servable = OrderedDict()   # encoded rendition file -> whether it is smaller than its fallback
+
+        # Renditions found in the cache, and those that had to be rendered
+        self.hits = 0
+        self.misses = 0
+
+        if Image is None:
+            print('Pillow is not installed, media will be served at its original size')
+
+    @staticmethod
+    def available():
+        return Image is not None
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def width_bucket(self, width: int):
+        """
+        The smallest configured width that is at least the requested width, or None if the
+        request is wider than every bucket (in which case the original is served).
+        """
+        i = bisect_left(self.widths, width)
+        return self.widths[i] if i < len(self.widths) else None
+
+    def negotiate(self, accept: str):
+        """
+        The encodings an Accept header accepts, highest q first, and in order of preference for equal q.
+        """
+        if not (accept and self.encodings):
+            return []
+        types = accepted_types(accept)
+        accepted = [media_type for media_type in self.encodings if types.get(media_type, 0) > 0]
+        # sorted() is stable, so encodings the client weighs the same stay in order of preference
+        return sorted(accepted, key=lambda media_type: -types[media_type])
+
+    def variants(self, content_type: str, width: int, quality: int = None, accept: str = None):
+        """
+        The (width bucket, quality, media type) renditions that may serve a request, best first: one per
+        accepted encoding, then the original format. Empty if the original is served. The width bucket is
+        None for full size renditions (and the original format at full size is the original itself).
+        """
+        if Image is None or content_type not in RENDITION_FORMATS:
+            return []
+        bucket = self.width_bucket(int(width)) if width else None
+        encodings = self.negotiate(accept)
+        if bucket is None and not encodings:
+            return []
+        quality = min(95, max(1, int(quality))) if quality else self.quality
+        return [(bucket, quality, media_type) for media_type in encodings + [content_type]]
+
+    def _rendition_file(self, source: str, media_file: str, mtime: float, size: int, width: int, quality: int, ext: str):
+        key = hashlib.sha1(f'{source}\0{media_file}\0{mtime}\0{size}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.renditions_folder, key[:2], f'{key}_w{width}_q{quality}.{ext}')
+
+    def _rendition_args(self, source: str, media_file: str, filename: str, mtime: float, size: int, content_type: str, variant):
+        bucket, quality, media_type = variant
+        image_format, ext = RENDITION_ENCODINGS.get(media_type, None) or RENDITION_FORMATS[content_type]
+        rendition_file = self._rendition_file(source, media_file, mtime, size, bucket or 0, quality, ext)
+        return rendition_file, (filename, rendition_file, bucket, quality, image_format)
+
+    def _remember(self, memo: OrderedDict, key, value):
+        with self._lock:
+            memo[key] = value
+            memo.move_to_end(key)
+            while len(memo) > RENDITION_MEMO_SIZE:
+                memo.popitem(last=False)
+
+    def _image_width(self, filename: str, mtime: float, size: int):
+        """
+        Width of the image in filename, read from its header once per version of the file. None if unreadable.
+        """
+        key = (filename, mtime, size)
+        width = self._widths.get(key, None)
+        if width is None:
+            try:
+                with Image.open(filename) as image:
+                    width = image.width
+            except Exception:
+                return None
+            self._remember(self._widths, key, width)
+        return width
+
+    def _smaller(self, rendition_file: str):
+        """
+        Whether an encoded rendition came out smaller than the original format at its width: True, False, or
+        None while it hasn't been rendered and compared.
+        """
+        smaller = self._servable.get(rendition_file, None)
+        if smaller is None:
+            if os.path.isfile(rendition_file + LARGER_MARKER):
+                smaller = False
+            elif os.path.isfile(rendition_file + SMALLER_MARKER):
+                smaller = True
+            else:
+                return None
+            self._remember(self._servable, rendition_file, smaller)
+        return smaller
+
+    def _compare_later(self, rendition_file: str, fallback_file: str, fallback_args: tuple):
+        """
+        Compares an encoded rendition with its fallback in the background, so later requests pass over it
+        if it isn't smaller.
+        """
+        marker = rendition_file + SMALLER_MARKER
+        with self._lock:
+            if marker in self._pending:
+                return
+        src, _fallback_file, bucket, quality, image_format = fallback_args
+        try:
+            future = self._submit(marker, _compare_rendition, src, rendition_file, fallback_file, bucket, quality, image_format)
+        except BrokenProcessPool:
+            # Left for a later request to retry
+            return
+        future.add_done_callback(lambda _future: self._compared(rendition_file, _future))
+
+    def _compared(self, rendition_file: str, future):
+        if not future.cancelled() and future.exception() is None:
+            self._remember(self._servable, rendition_file, future.result())
+
+    def rendition(
+        self, source: str, media_file: str, filename: str,
+        mtime: float, size: int, content_type: str,
+        width: int, quality: int = None, accept: str = None
+    ):
+        """
+        (path, variant) of the file that serves filename for the requested width and accepted types, rendering
+        it if it isn't cached. Returns (filename, None) when the original is served, as it is when it is no
+        wider than the width bucket and no encoding applies.
+
+        Only the preferred rendition is rendered for a request. Whether an encoding comes out smaller than
+        the original format at the same width (its resized rendition, or the original) is settled in the
+        background, and encodings that don't are passed over from then on.
+        """
+        variants = self.variants(content_type, width, quality, accept)
+        if variants and variants[0][0] is not None:
+            image_width = self._image_width(filename, mtime, size)
+            if image_width is not None and image_width <= variants[0][0]:
+                # Resizing wouldn't make it any smaller, so it is only transcoded (at full size)
+                variants = [(None, _quality, media_type) for _bucket, _quality, media_type in variants]
+        *encoded, plain = variants or [None]
+        if plain is None or (plain[0] is None and not encoded):
+            return filename, None
+
+        if plain[0] is None:
+            fallback_file, fallback_args = filename, (filename, filename, None, plain[1], None)
+        else:
+            fallback_file, fallback_args = self._rendition_args(source, media_file, filename, mtime, size, content_type, plain)
+
+        try:
+            for variant in encoded:
+                rendition_file, args = self._rendition_args(source, media_file, filename, mtime, size, content_type, variant)
+                smaller = self._smaller(rendition_file)
+                if smaller is False:
+                    continue
+                self._render_file(rendition_file, _render, *args)
+                if smaller is None:
+                    self._compare_later(rendition_file, fallback_file, fallback_args)
+                return rendition_file, variant
+
+            if plain[0] is None:
+                return filename, None
+            return self._render_file(fallback_file, _render, *fallback_args), plain
+        except BrokenProcessPool as e:
+            print('Rendition workers failed, serving the original:', filename, str(e))
+            return filename, None
+
+    def contact_sheet(self, cells: list, columns: int, cell_width: int, gap: int = 4, quality: int = None):
+        """
+        Path of the contact sheet compositing cells, a list of (source, media_file, filename, mtime, size)
+        tuples (or None for missing files), rendering it if it isn't cached.
+        """
+        if Image is None:
+            raise RuntimeError('Pillow is required to render contact sheets')
+
+        quality = min(95, max(1, int(quality))) if quality else self.quality
+        key = hashlib.sha1(repr([cell and (cell[0], cell[1], cell[3], cell[4]) for cell in cells]).encode('utf-8')).hexdigest()
+        sheet_file = os.path.join(
+            self.renditions_folder, 'sheets', key[:2],
+            f'{key}_c{columns}_w{cell_width}_g{gap}_q{quality}.jpg'
+        )
+        if os.path.isfile(sheet_file):
+            self.hits += 1
+            return sheet_file
+
+        return self._render_file(
+            sheet_file, _render_contact_sheet,
+            [cell and cell[2] for cell in cells], sheet_file, columns, cell_width, gap, quality
+        )
+
+    def _render_file(self, dest: str, fn, *args):
+        """
+        Renders dest with fn(*args) in the process pool, unless it is already there, and returns it.
+        A worker that dies (e.g. killed for memory) breaks the whole pool, which is then replaced and
+        the render tried once more. Raises BrokenProcessPool if that fails too.
+        """
+        if os.path.isfile(dest):
+            self.hits += 1
+            return dest
+        self.misses += 1
+        try:
+            return self._submit(dest, fn, *args).result()
+        except BrokenProcessPool:
+            return self._submit(dest, fn, *args).result()
+
+    def _submit(self, dest: str, fn, *args):
+        """
+        Future of fn(*args) run in the process pool to produce dest, shared between concurrent requests for it.
+        """
+        with self._lock:
+            future = self._pending.get(dest, None)
+            if future is not None and not (future.done() and isinstance(future.exception(), BrokenProcessPool)):
+                return future
+            if self._executor is not None and getattr(self._executor, '_broken', False):
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            future = self._executor.submit(fn, *args)
+            self._pending[dest] = future
+        future.add_done_callback(lambda _future: self._done(dest, _future))
+        return future
+
+    def _done(self, dest: str, future):
+        with self._lock:
+            if self._pending.get(dest, None) is future:
+                del self._pending[dest]
@@ -0,0 +1,111 @@
+import os
+import threading
+from stat import S_ISDIR
+from mimetypes import guess_type
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+class MediaScanner():
+
+    def __init__(self, media_extensions: list, recursive: bool = False, workers: int = 8):
+        """
+        Lists the media files in a folder (and optionally its subfolders) with os.scandir, using
+        the stat data each DirEntry carries. Files are classified in a single pass by looking their
+        extension up in a set. Recursive scans fan subfolders out across a thread pool, which pays
+        off for trees with many folders because scandir and stat release the GIL while they wait
+        on the filesystem.
+        """
+        self.media_extensions = frozenset(extension.lower().lstrip('.') for extension in media_extensions)
+        self.recursive = recursive
+        self.workers = max(1, int(workers))
+
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def is_media_file(self, name: str):
+        if name.startswith('.'):
+            return False
+        _, extension = os.path.splitext(name)
+        return extension[1:].lower() in self.media_extensions
+
+    def _scan_folder(self, folder: str, prefix: str):
+        """
+        Returns ({name: (size, mtime, content_type)}, [(subfolder, prefix, mtime)]) for one folder.
+        Names of files in subfolders are relative to the scanned root, using '/' separators.
+        """
+        files, subfolders = {}, []
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if entry.name.startswith('.'):
+                        continue
+                    try:
+                        # Symlinked folders aren't followed, so a link cycle can't make the walk endless
+                        if self.recursive and entry.is_dir(follow_symlinks=False):
+                            stat = entry.stat(follow_symlinks=False)
+                            subfolders.append((entry.path, f'{prefix}{entry.name}/', stat.st_mtime))
+                            continue
+                        if not self.is_media_file(entry.name) or not entry.is_file():
+                            continue
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    content_type, _ = guess_type(entry.name)
+                    files[f'{prefix}{entry.name}'] = (stat.st_size, stat.st_mtime, content_type)
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        except PermissionError as e:
+            print('Scanner skipping unreadable folder:', folder, str(e))
+        return files, subfolders
+
+    def folder_mtimes(self, media_folder: str, known_folders):
+        """
+        Current mtimes of the given folders (None for folders that have gone), used to decide whether
+        a rescan is needed. A file added to or removed from any folder changes that folder's mtime.
+        """
+        folder_mtimes = {}
+        for folder in known_folders:
+            try:
+                stat = os.stat(folder)
+                folder_mtimes[folder] = stat.st_mtime if S_ISDIR(stat.st_mode) else None
+            except FileNotFoundError:
+                folder_mtimes[folder] = None
+        if media_folder not in folder_mtimes:
+            folder_mtimes.update(self.folder_mtimes(media_folder, [media_folder]))
+        return folder_mtimes
+
+    def scan(self, media_folder: str):
+        """
+        Returns ({name: (size, mtime, content_type)}, {folder: mtime}) for every media file under
+        media_folder and every folder visited.
+        """
+        folder_mtimes = self.folder_mtimes(media_folder, [media_folder])
+        if folder_mtimes[media_folder] is None:
+            return {}, folder_mtimes
+
+        entries, subfolders = self._scan_folder(media_folder, '')
+        if not subfolders:
+            return entries, folder_mtimes
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='media-scanner')
+            executor = self._executor
+
+        pending = set()
+        while subfolders or pending:
+            for folder, prefix, mtime in subfolders:
+                folder_mtimes[folder] = mtime
+                pending.add(executor.submit(self._scan_folder, folder, prefix))
+            subfolders = []
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, found = future.result()
+                entries.update(files)
+                subfolders.extend(found)
+
+        return entries, folder_mtimes
@@ -0,0 +1,285 @@
+import os
+import mmap
+import struct
+import threading
+from array import array
+from bisect import bisect_left
+from functools import partial
+from heapq import nsmallest, nlargest
+
+try:
+    from .name_index import MediaFilter, MediaNameIndex, MappedNames
+except ImportError:
+    from name_index import MediaFilter, MediaNameIndex, MappedNames
+
+# Sort orders of media folder listings, each ascending by a unique key: name, (mtime, name) or (size, name)
+SORT_MODES = ('name', 'date', 'size')
+
+# Name indexes of larger listings are built on a background thread, with filters scanning the names meanwhile
+NAME_INDEX_BACKGROUND_MIN = 10000
+
+# Sort index files are a header, then the arrays of a MediaSortIndex in native byte order (they are only read
+# on the machine that wrote them), each padded to 8 bytes:
+#
+#   magic | version (u64) | name count (u64)
+#   name offsets (u64, count + 1) | mtimes (f64) | sizes (i64) | date order (u32) | size order (u32) | names (utf-8)
+SORT_INDEX_MAGIC = b'MSORTIX1'
+_SORT_INDEX_HEADER = struct.Struct('=8sQQ')
+
+def _sort_key(mode: str, name: str, size: int, mtime: float):
+    if mode == 'date':
+        return (mtime, name)
+    if mode == 'size':
+        return (size, name)
+    return name
+
+def top_k(entries, mode: str, k: int, descending: bool = False, media_filter: str = None, ignore_case: bool = False):
+    """
+    The first k (name, key) pairs of catalog entries in a sort order, by heap selection rather than
+    sorting them all (O(n log k)), and the number of entries that matched the filter.
+    """
+    match = MediaFilter(media_filter, ignore_case).match if media_filter else None
+    matched = 0
+    def keys():
+        nonlocal matched
+        for name, (size, mtime, _) in entries.items():
+            if match and not match(name):
+                continue
+            matched += 1
+            yield _sort_key(mode, name, size, mtime)
+
+    selected = (nlargest if descending else nsmallest)(k, keys())
+    return [(key if mode == 'name' else key[1], key) for key in selected], matched
+
+def _padding(length: int):
+    return b'\0' * (-length % 8)
+
+def _sorted_entries(entries):
+    """
+    Names, mtimes and sizes of catalog entries (a mapping of name: (size, mtime, content_type)), in name order.
+    """
+    items = sorted(entries.items())
+    names = [name for name, _ in items]
+    mtimes = array('d', (mtime for _, (_size, mtime, _content_type) in items))
+    sizes = array('q', (size for _, (size, _mtime, _content_type) in items))
+    return names, mtimes, sizes
+
+def name_index_file(index_file: str):
+    """
+    The file beside a sort index file that the trigram index of its names is written to.
+    """
+    return f'{os.path.splitext(index_file)[0]}.nameindex'
+
+def write_sort_index(index_file: str, entries, version: int):
+    """
+    Writes the sort index of one version of a catalog's entries (with every order built) to index_file,
+    aside and then moved into place, so processes mapping it never see part of a file.
+    """
+    names, mtimes, sizes = _sorted_entries(entries)
+    encoded = [name.encode('utf-8') for name in names]
+    offsets = array('Q', [0])
+    for name in encoded:
+        offsets.append(offsets[-1] + len(name))
+
+    partial_file = f'{index_file}.{os.getpid()}.{threading.get_ident()}.part'
+    try:
+        with open(partial_file, 'wb') as f:
+            f.write(_SORT_INDEX_HEADER.pack(SORT_INDEX_MAGIC, version, len(names)))
+            f.write(_padding(_SORT_INDEX_HEADER.size))
+            for values in (
+                offsets, mtimes, sizes,
+                # Positions are in name order already, so a stable sort on the value alone breaks ties by name
+                array('I', sorted(range(len(names)), key=mtimes.__getitem__)),
+                array('I', sorted(range(len(names)), key=sizes.__getitem__)),
+            ):
+                data = values.tobytes()
+                f.write(data)
+                f.write(_padding(len(data)))
+            f.write(b''.join(encoded))
+        os.replace(partial_file, index_file)
+    finally:
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
+
+class MediaSortIndex():
+
+    def __init__(self, entries, version: int):
+        """
+        Sort orders over one version of a catalog's entries. Names are held once, in name order,
+        beside compact arrays of their mtimes and sizes, and each order is an array of positions
+        into them that is built the first time a query needs it.
+        """
+        self.version = version
+        self.names, self.mtimes, self.sizes = _sorted_entries(entries)
+
+        self._lock = threading.Lock()
+        self._orders = {'name': range(len(self.names))}
+        self._name_index = None
+        self._name_index_file = None
+        self._name_index_thread = None
+
+    @classmethod
+    def mapped(cls, index_file: str):
+        """
+        The sort index in index_file (see write_sort_index), memory-mapped rather than read, so every
+        process using the same file shares one copy of it in the page cache.
+        """
+        with open(index_file, 'rb') as f:
+            buffer = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        magic, version, count = _SORT_INDEX_HEADER.unpack_from(buffer)
+        if magic != SORT_INDEX_MAGIC:
+            raise ValueError(f'Not a sort index file: {index_file}')
+
+        offset = _SORT_INDEX_HEADER.size + len(_padding(_SORT_INDEX_HEADER.size))
+        def section(fmt: str, length: int):
+            nonlocal offset
+            size = struct.calcsize(fmt) * length
+            values = buffer[offset:offset + size].cast(fmt)
+            offset += size + len(_padding(size))
+            return values
+
+        index = cls.__new__(cls)
+        index.version = version
+        offsets = section('Q', count + 1)
+        index.mtimes = section('d', count)
+        index.sizes = section('q', count)
+        orders = {'date': section('I', count), 'size': section('I', count)}
+        index.names = MappedNames(offsets, buffer[offset:offset + offsets[count]])
+
+        index._lock = threading.Lock()
+        index._orders = {'name': range(count), **orders}
+        index._name_index = None
+        index._name_index_file = name_index_file(index_file)
+        index._name_index_thread = None
+        return index
+
+    def key(self, mode: str, position: int):
+        return _sort_key(mode, self.names[position], self.sizes[position], self.mtimes[position])
+
+    def order(self, mode: str):
+        order = self._orders.get(mode, None)
+        if order is None:
+            with self._lock:
+                order = self._orders.get(mode, None)
+                if order is None:
+                    values = self.mtimes if mode == 'date' else self.sizes
+                    # Positions are in name order already, so a stable sort on the value alone breaks ties by name
+                    order = array('I', sorted(range(len(values)), key=values.__getitem__))
+                    self._orders[mode] = order
+        return order
+
+    def name_index(self):
+        """
+        The trigram index of the names, built when a listing is first filtered. Returns None while a
+        large index is still being built in the background. A mapped sort index shares its name index
+        through a file beside its own, which the first process to need it writes.
+        """
+        if self._name_index is None:
+            if len(self.names) < NAME_INDEX_BACKGROUND_MIN:
+                self._build_name_index()
+            else:
+                with self._lock:
+                    if self._name_index_thread is None:
+                        self._name_index_thread = threading.Thread(target=self._build_name_index, daemon=True)
+                        self._name_index_thread.start()
+        return self._name_index
+
+    def _build_name_index(self):
+        if self._name_index_file:
+            try:
+                if not os.path.isfile(self._name_index_file):
+                    MediaNameIndex.write(self._name_index_file, self.names)
+                self._name_index = MediaNameIndex.mapped(self._name_index_file)
+                return
+            except (OSError, ValueError) as e:
+                print('Name index file unavailable, building it in memory:', self._name_index_file, str(e))
+        self._name_index = MediaNameIndex(self.names)
+
+    def listing(self, mode: str, media_filter: str = None, ignore_case: bool = False):
+        order = self.order(mode)
+        if media_filter:
+            order = self._filter(mode, order, MediaFilter(media_filter, ignore_case))
+        return MediaListing(self, mode, order)
+
+    def _filter(self, mode: str, order: array, media_filter: MediaFilter):
+        names = self.names
+        if media_filter.prefix and not media_filter.ignore_case:
+            # Names are sorted, so the names with a (case-sensitive) prefix are a range of positions
+            candidates = range(
+                bisect_left(names, media_filter.prefix),
+                bisect_left(names, media_filter.prefix + '\U0010ffff')
+            )
+        else:
+            name_index = self.name_index()
+            candidates = name_index.candidates(media_filter) if name_index else None
+
+        if candidates is None:
+            return array('I', [position for position in order if media_filter.match(names[position])])
+
+        positions = [position for position in candidates if media_filter.match(names[position])]
+        if mode != 'name':
+            if len(positions) * 8 > len(names):
+                # Most names match, so picking them out of the sort order beats sorting them again
+                selected = bytearray(len(names))
+                for position in positions:
+                    selected[position] = 1
+                positions = [position for position in order if selected[position]]
+            else:
+                positions.sort(key=partial(self.key, mode))
+        return array('I', positions)
+
+class MediaListing():
+
+    def __init__(self, index: MediaSortIndex, mode: str, positions: array):
+        """
+        One (possibly filtered) sort order of a MediaSortIndex, ascending by its key.
+        """
+        self.index = index
+        self.mode = mode
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    def key(self, i: int):
+        return self.index.key(self.mode, self.positions[i])
+
+    def names(self, start: int, end: int):
+        names = self.index.names
+        return [names[position] for position in self.positions[start:end]]
+
+    def bisect(self, key, right: bool = False):
+        """
+        Index of the first entry whose key is greater than (right) or not less than key.
+        """
+        lo, hi = 0, len(self.positions)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key = self.key(mid)
+            if mid_key < key or (right and mid_key == key):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+class LinkListing():
+
+    mode = 'links'
+
+    def __init__(self, links: list):
+        """
+        Media links in their configured order, keyed by position.
+        """
+        self.links = links
+
+    def __len__(self):
+        return len(self.links)
+
+    def key(self, i: int):
+        return i
+
+    def names(self, start: int, end: int):
+        return self.links[start:end]
+
+    def bisect(self, key, right: bool = False):
+        return min(len(self.links), max(0, key + 1 if right else key))
@@ -0,0 +1,128 @@
+import os
+import sys
+import select
+import struct
+import threading
+import ctypes
+import ctypes.util
+
+# inotify(7) event flags
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_CLOSE_WRITE | IN_ATTRIB |
+    IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+)
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+class MediaFolderWatcher():
+
+    def __init__(self):
+        """
+        Watches media folders with inotify and applies create, delete and rename events to the
+        catalog listing of every source sharing a folder, so listings stay current without rescans.
+        """
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self._lock = threading.Lock()
+        self._catalogs = {}  # watch descriptor -> [MediaCatalog]
+        self._closed = False
+
+        self._thread = threading.Thread(name='Media Folder Watcher', target=self._run, daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def available():
+        return sys.platform.startswith('linux')
+
+    def watch(self, catalog):
+        wd = self._libc.inotify_add_watch(self._fd, catalog.media_folder.encode(), WATCH_MASK)
+        if wd < 0:
+            print(f'Unable to watch {catalog.media_folder} (errno {ctypes.get_errno()}), falling back to polling')
+            return False
+
+        with self._lock:
+            self._catalogs.setdefault(wd, []).append(catalog)
+
+        # Pick up anything that changed between loading the catalog and adding the watch
+        catalog.refresh()
+        catalog.watched = True
+        print('Watching:', catalog.media_folder)
+        return True
+
+    def close(self):
+        self._closed = True
+        self._thread.join(timeout=5)
+
+    def _unwatch(self, wd: int):
+        with self._lock:
+            catalogs = self._catalogs.pop(wd, [])
+        for catalog in catalogs:
+            catalog.watched = False
+            print('Stopped watching:', catalog.media_folder)
+
+    def _run(self):
+        while not self._closed:
+            try:
+                readable, _, _ = select.select([self._fd], [], [], 1.0)
+                if not readable:
+                    continue
+                buffer = os.read(self._fd, 64 * 1024)
+            except OSError as e:
+                print('Media folder watcher stopped:', str(e))
+                break
+
+            events = {}  # watch descriptor -> [file name]
+            overflow = False
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _cookie, length = _EVENT_HEADER.unpack_from(buffer, offset)
+                offset += _EVENT_HEADER.size
+                name = buffer[offset:offset + length].rstrip(b'\0').decode(errors='surrogateescape')
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    self._unwatch(wd)
+                elif name and not (mask & IN_ISDIR):
+                    # A rename arrives as MOVED_FROM + MOVED_TO; each name is re-stated on apply
+                    events.setdefault(wd, []).append(name)
+
+            with self._lock:
+                watched = {wd: list(catalogs) for wd, catalogs in self._catalogs.items()}
+
+            try:
+                if overflow:
+                    # Events were dropped by the kernel, so resynchronize from the folders
+                    for catalogs in watched.values():
+                        for catalog in catalogs:
+                            catalog.refresh(force=True)
+                else:
+                    for wd, names in events.items():
+                        for catalog in watched.get(wd, []):
+                            catalog.apply_events(names)
+            except Exception as e:
+                print('Media folder watcher failed to apply events:', str(e))
+
+        with self._lock:
+            catalogs = [catalog for catalogs in self._catalogs.values() for catalog in catalogs]
+            self._catalogs = {}
+        for catalog in catalogs:
+            catalog.watched = False
+        os.close(self._fd)
@@ -0,0 +1,120 @@
+import json
+import struct
+
+# Batch media responses are a sequence of length-prefixed records, one per requested file:
+#
+#   status (u8) | name length (u16) | content type length (u16) | etag length (u16) | body length (u64)
+#   name | content type | etag | body
+#
+# Integers are big-endian and strings are utf-8. Files that can't be served get a record with a
+# BATCH_NOT_FOUND status and an empty body, so records always line up with the requested names.
+
+MEDIA_BATCH_CONTENT_TYPE = 'application/x-media-batch'
+
+BATCH_OK = 0
+BATCH_NOT_FOUND = 1
+
+_BATCH_RECORD_HEADER = struct.Struct('>BHHHQ')
+
+def batch_record_header(media_file: str, content_type: str, etag: str, length: int, status: int = BATCH_OK):
+    name, content_type, etag = media_file.encode('utf-8'), (content_type or '').encode('utf-8'), (etag or '').encode('utf-8')
+    return _BATCH_RECORD_HEADER.pack(status, len(name), len(content_type), len(etag), length) + name + content_type + etag
+
+def iter_batch_records(content: bytes):
+    """
+    Yields (status, media_file, content_type, etag, body) for each record in a batch response body.
+    """
+    view = memoryview(content)
+    offset = 0
+    while offset < len(view):
+        status, name_len, content_type_len, etag_len, length = _BATCH_RECORD_HEADER.unpack_from(view, offset)
+        offset += _BATCH_RECORD_HEADER.size
+        media_file = bytes(view[offset:offset + name_len]).decode('utf-8')
+        offset += name_len
+        content_type = bytes(view[offset:offset + content_type_len]).decode('utf-8')
+        offset += content_type_len
+        etag = bytes(view[offset:offset + etag_len]).decode('utf-8')
+        offset += etag_len
+        body = bytes(view[offset:offset + length])
+        if len(body) != length:
+            raise ValueError(f'Truncated media batch record: {media_file}')
+        offset += length
+        yield status, media_file, content_type, etag, body
+
+# Compact media list responses are the listing's fields other than its names as a JSON object, then the names
+# front coded (each as the length of the prefix it shares with the previous name, and the rest of it):
+#
+#   header length (u32) | header (JSON) | name count (u32) | shared prefix lengths (u8 per name)
+#   name suffixes (NUL separated)
+#
+# Integers are big-endian, strings are utf-8 and prefix lengths count characters (up to 255). Sorted names (and
+# names in the same subfolders) share long prefixes, so this is a fraction of the JSON array's size.
+
+MEDIA_LIST_CONTENT_TYPE = 'application/x-media-list'
+
+# What clients ask /media_list for, most compact first
+MEDIA_LIST_ACCEPT = f'{MEDIA_LIST_CONTENT_TYPE}, application/json;q=0.9'
+
+_MAX_PREFIX = 0xFF
+_LENGTH = struct.Struct('>I')
+
+def _shared_prefix(previous: str, name: str, hint: int):
+    """
+    Length of the prefix previous and name share, searched for from hint (the previous pair's, which sorted
+    names mostly share give or take a character). Prefixes are compared as slices, so mostly in C.
+    """
+    end = min(len(previous), len(name), _MAX_PREFIX)
+    prefix = min(hint, end)
+    if previous[:prefix] == name[:prefix]:
+        while prefix < end and previous[prefix] == name[prefix]:
+            prefix += 1
+        return prefix
+    lo, hi = 0, prefix - 1
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if previous[:mid] == name[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def encode_media_list(listing: dict):
+    """
+    The compact encoding of a /media_list response ({'media_list': [...], ...}).
+    """
+    names = listing['media_list']
+    header = json.dumps({key: value for key, value in listing.items() if key != 'media_list'}).encode('utf-8')
+
+    prefixes, suffixes, previous, prefix = bytearray(), [], '', 0
+    for name in names:
+        prefix = _shared_prefix(previous, name, prefix)
+        prefixes.append(prefix)
+        suffixes.append(name[prefix:])
+        previous = name
+
+    return b''.join((
+        _LENGTH.pack(len(header)), header, _LENGTH.pack(len(names)), prefixes,
+        '\0'.join(suffixes).encode('utf-8')
+    ))
+
+def decode_media_list(content: bytes):
+    """
+    The /media_list response ({'media_list': [...], ...}) in a compact encoding.
+    """
+    header_length, = _LENGTH.unpack_from(content, 0)
+    offset = _LENGTH.size + header_length
+    listing = json.loads(content[_LENGTH.size:offset])
+    count, = _LENGTH.unpack_from(content, offset)
+    offset += _LENGTH.size
+
+    prefixes = content[offset:offset + count]
+    suffixes = content[offset + count:].decode('utf-8').split('\0') if count else []
+    if len(prefixes) != count or len(suffixes) != count:
+        raise ValueError(f'Truncated media list: {count} names expected')
+
+    names, previous = [], ''
+    for prefix, suffix in zip(prefixes, suffixes):
+        previous = previous[:prefix] + suffix
+        names.append(previous)
+    listing['media_list'] = names
+    return listing
@@ -0,0 +1,117 @@
+import json
+import struct
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from media_server.wire import MEDIA_LIST_ACCEPT, MEDIA_LIST_CONTENT_TYPE, decode_media_list
+
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+class MediaServerError(Exception):
+    """Base class for errors talking to the media server."""
+
+class MediaServerUnavailable(MediaServerError):
+    """The media server could not be reached, or timed out, after all retries."""
+
+class MediaServerResponseError(MediaServerError):
+    """The media server answered with an error status or an unreadable body."""
+    def __init__(self, url, status_code, message):
+        super().__init__(f'{status_code} from {url}: {message}')
+        self.url = url
+        self.status_code = status_code
+
+class MediaServerTransport():
+    def __init__(
+        self, pool_size=32, connect_timeout=3.05, read_timeout=30,
+        retries=3, retry_backoff=0.2
+    ):
+        """
+        Keep-alive HTTP connection pool to the media server, shared by every client in the process.
+        Idempotent GETs are retried with exponential backoff on connection errors and 502/503/504s.
+        """
+        self.timeout = (connect_timeout, read_timeout)
+
+        retry = Retry(
+            total=retries, connect=retries, read=retries, status=retries,
+            backoff_factor=retry_backoff,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry, pool_block=True)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, url, headers=None, **kwargs):
+        """
+        Sends a request, returning the response for 2xx and 304 statuses and raising a MediaServerError otherwise.
+        """
+        try:
+            response = self.session.request(method, url, headers=headers, timeout=self.timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise MediaServerUnavailable(f'{url}: {e}') from e
+        except requests.RequestException as e:
+            raise MediaServerError(f'{url}: {e}') from e
+
+        if response.status_code >= 400:
+            raise MediaServerResponseError(url, response.status_code, response.text)
+
+        return response
+
+    def get(self, url, headers=None, **kwargs):
+        return self.request('GET', url, headers=headers, **kwargs)
+
+    def post(self, url, headers=None, **kwargs):
+        return self.request('POST', url, headers=headers, **kwargs)
+
+    def get_json(self, url, **kwargs):
+        response = self.get(url, **kwargs)
+        try:
+            return _json_loads(response.content)
+        except ValueError as e:
+            raise MediaServerResponseError(url, response.status_code, f'invalid JSON ({e})') from e
+
+    def get_media_list(self, url, **kwargs):
+        """
+        A /media_list response, asking for its compact encoding first. requests offers the most compact
+        content codings it can decode (brotli when installed, then gzip) and decompresses the body.
+        """
+        response = self.get(url, headers={'Accept': MEDIA_LIST_ACCEPT}, **kwargs)
+        try:
+            if response.headers.get('Content-Type', '').startswith(MEDIA_LIST_CONTENT_TYPE):
+                return decode_media_list(response.content)
+            return _json_loads(response.content)
+        except (ValueError, struct.error) as e:
+            raise MediaServerResponseError(url, response.status_code, f'invalid media list ({e})') from e
+
+_TRANSPORTS = {}
+_TRANSPORTS_LOCK = threading.Lock()
+
+def get_transport(settings):
+    """
+    The process-wide transport for a [MEDIA_SERVER] settings section (one pool per distinct configuration).
+    """
+    options = dict(
+        pool_size=int(settings.get('POOL_SIZE', 32)),
+        connect_timeout=float(settings.get('CONNECT_TIMEOUT', 3.05)),
+        read_timeout=float(settings.get('READ_TIMEOUT', 30)),
+        retries=int(settings.get('RETRIES', 3)),
+        retry_backoff=float(settings.get('RETRY_BACKOFF', 0.2)),
+    )
+    key = tuple(sorted(options.items()))
+    with _TRANSPORTS_LOCK:
+        transport = _TRANSPORTS.get(key, None)
+        if transport is None:
+            transport = MediaServerTransport(**options)
+            _TRANSPORTS[key] = transport
+    return transport
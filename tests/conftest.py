@@ -0,0 +1,69 @@
+import os
+import json
+import importlib.util
+
+import pytest
+from PIL import Image
+
+ROOT_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_FOLDER = os.path.join(ROOT_FOLDER, 'media_server')
+
+SOURCE = 'TEST'
+
+def write_image(path, size=(64, 48), color=(200, 40, 40)):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.new('RGB', size, color).save(path, 'JPEG')
+
+@pytest.fixture
+def media_folder(tmp_path):
+    """
+    A media folder with a file at its top level and one in nested subfolders.
+    """
+    folder = tmp_path / 'media'
+    write_image(str(folder / 'top.jpg'))
+    write_image(str(folder / 'trips' / '2021' / 'beach 1.jpg'), color=(40, 40, 200))
+    return folder
+
+@pytest.fixture
+def load_media_server(tmp_path, media_folder, monkeypatch):
+    """
+    Loads a fresh copy of the media_server module (whose app serves media_folder recursively as SOURCE),
+    with any module settings given as keyword arguments applied before its app is built.
+    """
+    settings_file = tmp_path / 'media_service.toml'
+    settings_file.write_text('\n'.join([
+        f'MEDIA_TYPES = {json.dumps(["image/jpg", "image/jpeg", "image/png"])}',
+        f'CATALOG_FOLDER = {json.dumps(str(tmp_path / "catalog"))}',
+        'CATALOG_REFRESH_SECS = 0',
+        'WATCH_MEDIA_FOLDERS = false',
+        f'RENDITIONS_FOLDER = {json.dumps(str(tmp_path / "renditions"))}',
+        f'LINK_CACHE_FOLDER = {json.dumps(str(tmp_path / "links"))}',
+        '',
+        f'[MEDIA_SOURCES.{SOURCE}]',
+        f'media_folder = {json.dumps(str(media_folder))}',
+        "media_filter = ''",
+        'recursive = true',
+        '',
+    ]))
+    monkeypatch.setenv('MEDIA_SERVICE_SETTINGS', str(settings_file))
+    # media_server.py imports its sibling modules by name, as it does when run as a script
+    monkeypatch.syspath_prepend(SERVER_FOLDER)
+
+    apps = []
+    def load(**settings):
+        spec = importlib.util.spec_from_file_location('media_server_app', os.path.join(SERVER_FOLDER, 'media_server.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        apps.append(module.app)
+        if settings:
+            # Settings are module globals read when an app is built, so the app is built again with them
+            module.__dict__.update(settings)
+            module.app = module.MediaServerAPI_Wrapper()
+            apps.append(module.app)
+        return module
+
+    yield load
+
+    for app in apps:
+        for handler in app.router.on_shutdown:
+            handler()
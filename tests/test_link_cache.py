@@ -0,0 +1,53 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from media_server.link_cache import MediaLinkCache
+
+class OriginHandler(BaseHTTPRequestHandler):
+    # Bodies of 1000 bytes, sent without a Content-Type
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '1000')
+        self.end_headers()
+        self.wfile.write(self.path.encode('utf-8').ljust(1000, b'.'))
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def origin():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), OriginHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def link_cache(tmp_path):
+    link_cache = MediaLinkCache(str(tmp_path / 'links'), max_bytes=10_000)
+    yield link_cache
+    link_cache.close()
+
+def test_content_type_without_origin_header(origin, link_cache):
+    assert link_cache.entry(f'{origin}/photos/beach.jpg?w=1080')[3] == 'image/jpeg'
+    assert link_cache.entry(f'{origin}/photos/1234/download')[3] == 'application/octet-stream'
+
+def test_evicts_to_low_water(origin, link_cache):
+    urls = [f'{origin}/photos/{i}.jpg' for i in range(12)]
+    for url in urls[:10]:
+        link_cache.entry(url)
+    assert link_cache.stats()['bytes'] == 10_000
+    assert link_cache.evictions == 0
+
+    link_cache.entry(urls[10])
+    stats = link_cache.stats()
+    assert stats['bytes'] == 1000 * stats['entries'] <= 9000
+    assert os.path.isfile(link_cache.entry(urls[10])[0])
+
+    # The running total survives a restart
+    assert MediaLinkCache(link_cache.cache_folder, max_bytes=10_000).stats()['bytes'] == stats['bytes']
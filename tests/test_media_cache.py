@@ -0,0 +1,19 @@
+from media_server.media_cache import MediaCache
+
+def test_evicts_least_recently_used_by_bytes():
+    cache = MediaCache(1000, max_item_bytes=600)
+    assert cache.put('a', b'a' * 400, 400)
+    assert cache.put('b', b'b' * 400, 400)
+    assert cache.get('a') == b'a' * 400
+    assert cache.put('c', b'c' * 400, 400)
+    assert cache.get('b') is None
+    assert cache.stats()['bytes'] == 800
+    # Larger than max_item_bytes, so not cached at all
+    assert not cache.put('d', b'd' * 700, 700)
+
+def test_clear():
+    cache = MediaCache(1000)
+    cache.put('a', b'a' * 10, 10)
+    cache.clear()
+    assert cache.get('a') is None
+    assert cache.stats()['entries'] == cache.stats()['bytes'] == 0
@@ -0,0 +1,49 @@
+import io
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+from PIL import Image
+from fastapi.testclient import TestClient
+
+from conftest import SOURCE, write_image
+from media_client import RemoteMediaServerClient
+from media_transport import MediaServerTransport
+
+@pytest.fixture
+def remote_client(load_media_server):
+    """
+    A RemoteMediaServerClient talking to the app of load_media_server through a test client.
+    """
+    media_server = load_media_server()
+    with TestClient(media_server.app) as test_client:
+        # Built without __init__, which reads Streamlit secrets
+        client = RemoteMediaServerClient.__new__(RemoteMediaServerClient)
+        client.BASE_URL = 'http://testserver'
+        client.TRANSPORT = MediaServerTransport()
+        client.TRANSPORT.session = test_client
+        yield client
+
+def test_filters_are_escaped(remote_client, media_folder):
+    name = 'a&b #1+[x] 100%.jpg'
+    write_image(str(media_folder / name))
+    write_image(str(media_folder / 'A&B.jpg'))
+    media_filter = '*&b #1+[[]x]*'
+
+    url = remote_client._media_list_url(SOURCE, media_filter, sort_flag=True, ignore_case=True)
+    assert parse_qs(urlsplit(url).query)['filter_string'] == [media_filter]
+
+    media_list, returned_filter, _next_cursor = remote_client.get_media_list(
+        media_source=SOURCE, media_filter=media_filter, list_version='escaped'
+    )
+    assert media_list == [name] and returned_filter == media_filter
+
+    # Case is ignored when asked, in listings and contact sheets alike
+    media_list, _media_filter, _next_cursor = remote_client.get_media_list(
+        media_source=SOURCE, media_filter='a&b', list_version='escaped', ignore_case=True
+    )
+    assert sorted(media_list) == ['A&B.jpg', name]
+
+    url = remote_client._contact_sheet_url(SOURCE, 0, 2, 64, media_filter='a&b', ignore_case=True)
+    response = remote_client.TRANSPORT.get(url)
+    with Image.open(io.BytesIO(response.content)) as sheet:
+        assert sheet.size == (2 * 64 + 4, 48)
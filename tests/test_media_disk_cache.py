@@ -0,0 +1,55 @@
+import os
+import hashlib
+
+from media_disk_cache import MediaDiskCache, EVICT_LOW_WATER
+
+def body_files(cache_folder):
+    return sorted(f for _, _, files in os.walk(cache_folder) for f in files if len(f) == 64)
+
+def test_shared_bodies_counted_once(tmp_path):
+    cache = MediaDiskCache(str(tmp_path), 160_000)
+    cache.put('a', b'x' * 1000, '"1"', None, 0)
+    cache.put('b', b'x' * 1000, '"1"', None, 0)
+    assert cache.stats()['bytes'] == 1000
+    assert len(body_files(tmp_path)) == 1
+
+    # Replacing a key's body keeps the shared one, replacing the last key drops it
+    cache.put('a', b'y' * 500, '"2"', None, 0)
+    assert cache.stats()['bytes'] == 1500
+    cache.put('b', b'y' * 500, '"2"', None, 0)
+    assert cache.stats()['bytes'] == 500
+    assert len(body_files(tmp_path)) == 1
+    assert cache.get('a')[0] == b'y' * 500
+
+def test_evicts_least_recently_used_to_low_water(tmp_path):
+    cache = MediaDiskCache(str(tmp_path), 16_000)
+    for i in range(16):
+        cache.put(f'k{i}', bytes([i]) * 1000, None, None, 0)
+    assert cache.stats()['bytes'] == 16_000
+    assert cache.evictions == 0
+
+    cache.put('k16', bytes([16]) * 1000, None, None, 0)
+    stats = cache.stats()
+    assert stats['bytes'] <= 16_000 * EVICT_LOW_WATER
+    assert stats['bytes'] == 1000 * stats['entries'] == 1000 * len(body_files(tmp_path))
+    assert cache.get('k0') is None
+    assert cache.get('k16')[0] == bytes([16]) * 1000
+
+    # The running total survives a restart
+    assert MediaDiskCache(str(tmp_path), 16_000).stats()['bytes'] == stats['bytes']
+
+def test_missing_body_dropped_from_total(tmp_path):
+    cache = MediaDiskCache(str(tmp_path), 160_000)
+    cache.put('a', b'x' * 1000, '"1"', None, 0)
+    cache.put('b', b'y' * 500, '"2"', None, 0)
+
+    # A body removed behind the index (e.g. evicted by another process) stops counting towards the total
+    os.remove(cache._body_file(hashlib.sha256(b'x' * 1000).hexdigest()))
+    assert cache.get('a') is None
+    assert cache.stats()['bytes'] == 500
+    assert cache.stats()['entries'] == 1
+
+    # And is written again by the next put
+    cache.put('a', b'x' * 1000, '"1"', None, 0)
+    assert cache.get('a')[0] == b'x' * 1000
+    assert cache.stats()['bytes'] == 1500
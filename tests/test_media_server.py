@@ -0,0 +1,124 @@
+import io
+import os
+import time
+
+from PIL import Image
+from fastapi.testclient import TestClient
+
+from conftest import SOURCE, write_image
+
+NESTED = 'trips/2021/beach 1.jpg'
+
+def test_recursive_listing_serves_nested_media(load_media_server, media_folder):
+    media_server = load_media_server()
+    with TestClient(media_server.app) as client:
+        listing = client.get(f'/media_list/{SOURCE}', headers={'Accept': 'application/json'}).json()['media_list']
+        assert sorted(listing) == ['top.jpg', NESTED]
+
+        with open(media_folder / NESTED, 'rb') as f:
+            content = f.read()
+        # Slashes as they are, and percent-encoded
+        for path in ('trips/2021/beach%201.jpg', 'trips%2F2021%2Fbeach%201.jpg'):
+            response = client.get(f'/media/{SOURCE}/{path}')
+            assert response.status_code == 200
+            assert response.content == content
+
+        response = client.get(f'/media_full_path/{SOURCE}/trips/2021/beach%201.jpg')
+        assert response.json()['media_full_path'] == os.path.join(str(media_folder), NESTED)
+
+        assert client.get(f'/media/{SOURCE}/trips/2021/missing.jpg').status_code == 404
+
+def test_favorite_nested_media(load_media_server, media_folder):
+    media_server = load_media_server()
+    with TestClient(media_server.app) as client:
+        assert client.get(f'/favorite_media/{SOURCE}/trips/2021/beach%201.jpg').status_code == 200
+        assert os.path.isfile(media_folder / 'trips' / '2021' / 'FAV_beach 1.jpg')
+
+        listing = client.get(f'/media_list/{SOURCE}', headers={'Accept': 'application/json'}).json()['media_list']
+        assert 'trips/2021/FAV_beach 1.jpg' in listing
+
+def test_rename_stays_in_media_folder(load_media_server, media_folder):
+    outside = media_folder.parent / 'outside.jpg'
+    outside.write_bytes(b'not media')
+
+    media_server = load_media_server()
+    with TestClient(media_server.app) as client:
+        assert client.get(f'/delete_media/{SOURCE}/%2E%2E%2Foutside.jpg').status_code == 404
+    assert outside.is_file()
+
+def test_file_edited_in_place_is_served_current(load_media_server, media_folder):
+    media_server = load_media_server()
+    with TestClient(media_server.app) as client:
+        etag = client.get(f'/media_list/{SOURCE}').headers['ETag']
+        assert client.get(f'/media/{SOURCE}/top.jpg').status_code == 200
+
+        # Rewriting a file leaves its folder's mtime alone, so polling doesn't see it
+        folder_stat = os.stat(media_folder)
+        write_image(str(media_folder / 'top.jpg'), size=(320, 240))
+        os.utime(media_folder, ns=(folder_stat.st_atime_ns, folder_stat.st_mtime_ns))
+
+        response = client.get(f'/media/{SOURCE}/top.jpg')
+        assert response.content == (media_folder / 'top.jpg').read_bytes()
+        assert int(response.headers['Content-Length']) == os.path.getsize(media_folder / 'top.jpg')
+        assert client.get(f'/media_list/{SOURCE}').headers['ETag'] != etag
+
+def test_filters_are_case_sensitive_unless_asked(load_media_server, media_folder):
+    write_image(str(media_folder / 'Beach 2.jpg'))
+    media_server = load_media_server()
+    with TestClient(media_server.app) as client:
+        def listing(**params):
+            response = client.get(f'/media_list/{SOURCE}', params=params, headers={'Accept': 'application/json'})
+            return sorted(response.json()['media_list'])
+
+        assert listing(filter_string='beach') == [NESTED]
+        assert listing(filter_string='Beach') == ['Beach 2.jpg']
+        assert listing(filter_string='beach', ignore_case=True) == ['Beach 2.jpg', NESTED]
+        assert listing(filter_string='B*', sort_flag=True) == ['Beach 2.jpg']
+        assert listing(filter_string='b*', sort_flag=True, ignore_case=True) == ['Beach 2.jpg']
+
+def test_negotiated_media_type_matches_body(load_media_server, media_folder):
+    media_server = load_media_server()
+    accept = 'image/avif,image/webp,*/*'
+
+    def check(response):
+        assert response.status_code == 200
+        content_type, etag = response.headers['Content-Type'], response.headers['ETag']
+        with Image.open(io.BytesIO(response.content)) as image:
+            assert Image.MIME[image.format] == content_type
+        if content_type != 'image/jpeg':
+            assert etag.endswith(f'-{content_type.split("/")[1]}"')
+        return etag
+
+    with TestClient(media_server.app) as client:
+        for width in (None, 32):
+            params = {'width': width} if width else {}
+            etag = check(client.get(f'/media/{SOURCE}/top.jpg', params=params, headers={'Accept': accept}))
+
+            # An encoding found (in the background) not to be smaller is passed over, after which revalidating
+            # finds the same choice
+            deadline = time.monotonic() + 30
+            while True:
+                response = client.get(f'/media/{SOURCE}/top.jpg', params=params, headers={'Accept': accept, 'If-None-Match': etag})
+                if response.status_code == 304:
+                    break
+                etag = check(response)
+                assert time.monotonic() < deadline
+                time.sleep(0.05)
+
+def test_media_range_requests(load_media_server, media_folder):
+    media_server = load_media_server()
+    with open(media_folder / 'top.jpg', 'rb') as f:
+        content = f.read()
+    with TestClient(media_server.app) as client:
+        response = client.get(f'/media/{SOURCE}/top.jpg', headers={'Range': 'bytes=10-19'})
+        assert response.status_code == 206
+        assert response.headers['Content-Range'] == f'bytes 10-19/{len(content)}'
+        assert response.content == content[10:20]
+
+        response = client.get(f'/media/{SOURCE}/top.jpg', headers={'Range': 'bytes=-5'})
+        assert response.status_code == 206
+        assert response.content == content[-5:]
+
+        response = client.get(f'/media/{SOURCE}/top.jpg', headers={'Range': f'bytes={len(content)}-'})
+        assert response.status_code == 416
+        assert response.headers['Content-Range'] == f'bytes */{len(content)}'
@@ -0,0 +1,35 @@
+from fastapi.testclient import TestClient
+
+from conftest import SOURCE
+from media_server.media_cache import MediaCache
+from media_server.metrics import ServerMetrics
+
+def test_cache_sizes_reported_for_bounded_caches():
+    media_cache = MediaCache(1000, max_item_bytes=1000)
+    media_cache.put('a', b'x' * 600, 600)
+    media_cache.put('b', b'y' * 600, 600)
+    media_cache.get('b')
+
+    lines = ServerMetrics().render({
+        'media_list': {'hits': 3, 'misses': 1},
+        'media': media_cache.stats(),
+    }).splitlines()
+
+    assert 'media_server_cache_hits_total{cache="media_list"} 3' in lines
+    assert 'media_server_cache_hits_total{cache="media"} 1' in lines
+    assert 'media_server_cache_size_bytes{cache="media"} 600' in lines
+    assert 'media_server_cache_max_bytes{cache="media"} 1000' in lines
+    assert 'media_server_cache_evictions_total{cache="media"} 1' in lines
+    # Caches that only count lookups have no size series
+    assert not [line for line in lines if line.startswith('media_server_cache_entries{cache="media_list"')]
+
+def test_metrics_endpoint(load_media_server):
+    media_server = load_media_server()
+    with TestClient(media_server.app) as client:
+        client.get(f'/media_list/{SOURCE}')
+        client.get(f'/media_list/{SOURCE}')
+        response = client.get('/metrics')
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+    assert 'media_server_requests_total{method="GET",route="/media_list/{source}",status="200"} 2' in lines
+    assert 'media_server_cache_misses_total{cache="media_list"} 1' in lines
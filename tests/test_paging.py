@@ -0,0 +1,90 @@
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+from conftest import SOURCE, write_image
+
+# (sort_flag, sort_by_date_flag, sort_by_size_flag) for each sort mode
+SORT_MODES = {
+    'name': (True, False, False),
+    'date': (True, True, False),
+    'size': (True, False, True),
+}
+
+@pytest.fixture
+def paged_folder(media_folder):
+    """
+    media_folder with more files, some of them sharing a modification time or a size, so that pages
+    break inside runs of equal sort values.
+    """
+    for i in range(11):
+        path = str(media_folder / f'img_{i:02d}.jpg')
+        # Identical images have identical sizes
+        write_image(path, size=(16 + 8 * (i % 4), 16), color=(10 * (i % 4), 0, 0))
+        os.utime(path, (1600000000 + i // 3, 1600000000 + i // 3))
+    return media_folder
+
+def _expected(media_folder, mode):
+    names = []
+    for folder, _dirs, files in os.walk(media_folder):
+        names += [os.path.relpath(os.path.join(folder, f), media_folder).replace(os.sep, '/') for f in files]
+    stats = {name: os.stat(media_folder / name) for name in names}
+    if mode == 'date':
+        return sorted(names, key=lambda name: (stats[name].st_mtime, name))
+    if mode == 'size':
+        return sorted(names, key=lambda name: (stats[name].st_size, name))
+    return sorted(names)
+
+def _pages(client, mode, ascending, limit, on_page=None):
+    sort_flag, sort_by_date_flag, sort_by_size_flag = SORT_MODES[mode]
+    params = {
+        'sort_flag': sort_flag, 'sort_by_date_flag': sort_by_date_flag, 'sort_by_size_flag': sort_by_size_flag,
+        'ascending': ascending, 'limit': limit,
+    }
+    media_files, cursor = [], None
+    while True:
+        response = client.get(
+            f'/media_list/{SOURCE}', params=dict(params, cursor=cursor) if cursor else params,
+            headers={'Accept': 'application/json'}
+        ).json()
+        assert len(response['media_list']) <= limit
+        media_files += response['media_list']
+        cursor = response['next_cursor']
+        if on_page:
+            on_page(len(media_files))
+        if not cursor:
+            return media_files
+
+@pytest.mark.parametrize('mode', SORT_MODES)
+@pytest.mark.parametrize('ascending', [True, False])
+@pytest.mark.parametrize('limit', [1, 4, 13])
+def test_pages_cover_listing_once(load_media_server, paged_folder, mode, ascending, limit):
+    media_server = load_media_server()
+    expected = _expected(paged_folder, mode)
+    with TestClient(media_server.app) as client:
+        assert _pages(client, mode, ascending, limit) == (expected if ascending else expected[::-1])
+
+@pytest.mark.parametrize('ascending', [True, False])
+def test_cursor_survives_added_file(load_media_server, paged_folder, ascending):
+    media_server = load_media_server()
+    expected = _expected(paged_folder, 'name')
+
+    def add_files(seen):
+        if seen == 4:
+            # One file sorts before the pages read so far and one after
+            write_image(str(paged_folder / 'img_05a.jpg'))
+            write_image(str(paged_folder / ('aaa.jpg' if ascending else 'zzz.jpg')))
+            write_image(str(paged_folder / ('zzz.jpg' if ascending else 'aaa.jpg')))
+
+    with TestClient(media_server.app) as client:
+        media_files = _pages(client, 'name', ascending, 4, on_page=add_files)
+
+    read_first = (expected if ascending else expected[::-1])[:4]
+    assert len(media_files) == len(set(media_files))
+    assert media_files[:4] == read_first
+    # Nothing that was there is skipped, the file sorting after the pages read so far is picked up
+    assert set(expected) <= set(media_files)
+    assert ('zzz.jpg' if ascending else 'aaa.jpg') in media_files
+    assert ('aaa.jpg' if ascending else 'zzz.jpg') not in media_files
+    assert media_files == sorted(media_files, reverse=not ascending)
@@ -0,0 +1,47 @@
+import os
+import pstats
+
+from fastapi.testclient import TestClient
+
+from conftest import SOURCE
+
+def test_profiled_request_includes_offloaded_work(load_media_server, tmp_path):
+    profile_folder = tmp_path / 'profiles'
+    media_server = load_media_server(PROFILE_TOKEN='secret', PROFILE_FOLDER=str(profile_folder))
+    with TestClient(media_server.app) as client:
+        response = client.get(f'/media_list/{SOURCE}', headers={'Accept': 'application/json', 'X-Profile': 'secret'})
+        assert response.status_code == 200
+        assert len(response.json()['media_list']) == 2
+        profile_file = profile_folder / response.headers['X-Profile-File']
+
+        # Requests without the token aren't profiled
+        assert 'X-Profile-File' not in client.get(f'/media_list/{SOURCE}').headers
+
+    assert os.path.isfile(f'{os.path.splitext(profile_file)[0]}.txt')
+    functions = {name for _, _, name in pstats.Stats(str(profile_file)).stats}
+    # Run on the io pool, not in the request's thread
+    assert 'media_list_version' in functions
+
+def test_profiled_request_with_one_profiler_at_a_time(load_media_server, tmp_path, monkeypatch):
+    import cProfile
+    import threading
+
+    # As on Python 3.12+, where a second profiler can't be enabled while one is active
+    active = threading.Lock()
+    class SingleProfile(cProfile.Profile):
+        def enable(self, *args, **kwargs):
+            if not active.acquire(blocking=False):
+                raise ValueError('Another profiling tool is already active')
+            super().enable(*args, **kwargs)
+        def disable(self):
+            super().disable()
+            if active.locked():
+                active.release()
+
+    media_server = load_media_server(PROFILE_TOKEN='secret', PROFILE_FOLDER=str(tmp_path / 'profiles'))
+    monkeypatch.setattr('profiling.cProfile.Profile', SingleProfile)
+    with TestClient(media_server.app) as client:
+        headers = {'X-Profile': 'secret'}
+        assert client.get(f'/media_list/{SOURCE}', headers={'Accept': 'application/json', **headers}).status_code == 200
+        assert client.get(f'/media/{SOURCE}/top.jpg', headers=headers).status_code == 200
+        assert 'X-Profile-File' in client.get(f'/media_list/{SOURCE}', headers=headers).headers
@@ -0,0 +1,97 @@
+import os
+import time
+import random
+
+import pytest
+from PIL import Image
+
+from media_server.renditions import LARGER_MARKER, SMALLER_MARKER, MediaRenditions, encoder_available
+
+ENCODINGS = ['image/avif', 'image/webp']
+
+@pytest.fixture
+def renditions(tmp_path):
+    renditions = MediaRenditions(str(tmp_path / 'renditions'), widths=[64, 128], encodings=ENCODINGS)
+    yield renditions
+    renditions.close()
+
+def test_negotiate_orders_by_q_then_preference(renditions):
+    if renditions.encodings != ENCODINGS:
+        pytest.skip('needs AVIF and WebP encoders')
+    assert renditions.negotiate('image/webp,image/avif,*/*') == ['image/avif', 'image/webp']
+    assert renditions.negotiate('image/avif;q=0.5,image/webp;q=0.9') == ['image/webp', 'image/avif']
+    assert renditions.negotiate('image/avif;q=0,image/webp') == ['image/webp']
+    assert renditions.negotiate('image/*,*/*') == []
+
+def _rendition(renditions, filename, content_type, width=None, accept='image/webp'):
+    stat = os.stat(filename)
+    return renditions.rendition(
+        'TEST', os.path.basename(filename), filename, mtime=stat.st_mtime, size=stat.st_size,
+        content_type=content_type, width=width, accept=accept
+    )
+
+def _compared(rendition_file):
+    # Waits for the background comparison of an encoded rendition with its fallback
+    deadline = time.monotonic() + 30
+    while not any(os.path.isfile(rendition_file + marker) for marker in (SMALLER_MARKER, LARGER_MARKER)):
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+def test_encoding_only_served_when_smaller(renditions, tmp_path):
+    if not encoder_available('WEBP'):
+        pytest.skip('needs a WebP encoder')
+
+    # A PNG of one pixel is smaller than any WebP of it; the WebP is served until that is known
+    tiny = str(tmp_path / 'tiny.png')
+    Image.new('RGB', (1, 1), 'red').save(tiny, 'PNG')
+    rendition_file, variant = _rendition(renditions, tiny, 'image/png')
+    assert variant[2] == 'image/webp'
+    _compared(rendition_file)
+    assert _rendition(renditions, tiny, 'image/png') == (tiny, None)
+
+    # An uncompressed PNG of a smooth gradient isn't
+    gradient = str(tmp_path / 'gradient.png')
+    Image.linear_gradient('L').convert('RGB').save(gradient, 'PNG', compress_level=0)
+    rendition_file, variant = _rendition(renditions, gradient, 'image/png')
+    assert variant[2] == 'image/webp' and rendition_file.endswith('.webp')
+    _compared(rendition_file)
+    assert _rendition(renditions, gradient, 'image/png') == (rendition_file, variant)
+    assert os.path.getsize(rendition_file) < os.path.getsize(gradient)
+
+    # Resized, an encoding has to beat the resized rendition in the original format, which noise doesn't
+    random.seed(1)
+    noise = str(tmp_path / 'noise.jpg')
+    Image.frombytes('RGB', (256, 256), random.randbytes(256 * 256 * 3)).save(noise, 'JPEG', quality=90)
+    resized = _rendition(renditions, noise, 'image/jpeg', width=100, accept=None)
+    assert resized[1] == (128, renditions.quality, 'image/jpeg')
+    _compared(_rendition(renditions, noise, 'image/jpeg', width=100)[0])
+    assert _rendition(renditions, noise, 'image/jpeg', width=100) == resized
+
+def test_narrow_image_not_resized(renditions, tmp_path):
+    narrow = str(tmp_path / 'narrow.jpg')
+    Image.new('RGB', (50, 80), 'blue').save(narrow, 'JPEG')
+    assert _rendition(renditions, narrow, 'image/jpeg', width=100, accept=None) == (narrow, None)
+    assert renditions.misses == 0
+
+    if encoder_available('WEBP'):
+        # Only transcoded, at full size
+        rendition_file, variant = _rendition(renditions, narrow, 'image/jpeg', width=100)
+        assert variant == (None, renditions.quality, 'image/webp')
+        with Image.open(rendition_file) as image:
+            assert image.size == (50, 80)
+
+def test_broken_pool_replaced(renditions, tmp_path):
+    image = str(tmp_path / 'image.jpg')
+    Image.new('RGB', (256, 256), 'green').save(image, 'JPEG')
+    first, _variant = _rendition(renditions, image, 'image/jpeg', width=64, accept=None)
+    assert first != image
+
+    # A worker killed (e.g. for memory) breaks the whole pool
+    for process in list(renditions._executor._processes.values()):
+        process.kill()
+        process.join()
+
+    rendition_file, variant = _rendition(renditions, image, 'image/jpeg', width=100, accept=None)
+    assert variant == (128, renditions.quality, 'image/jpeg')
+    with Image.open(rendition_file) as rendered:
+        assert rendered.width == 128
@@ -0,0 +1,36 @@
+import asyncio
+import threading
+
+import httpx
+
+from conftest import SOURCE
+
+def test_media_served_while_a_listing_blocks(load_media_server, monkeypatch):
+    media_server = load_media_server()
+
+    # A listing that doesn't finish until released, like a cold scan of a large source
+    listing_started, release_listing = threading.Event(), threading.Event()
+    media_list = media_server.MediaService.media_list
+    def blocked_media_list(self, *args, **kwargs):
+        listing_started.set()
+        release_listing.wait(10)
+        return media_list(self, *args, **kwargs)
+    monkeypatch.setattr(media_server.MediaService, 'media_list', blocked_media_list)
+
+    async def check():
+        transport = httpx.ASGITransport(app=media_server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://media-server') as client:
+            listing = asyncio.create_task(client.get(f'/media_list/{SOURCE}'))
+            try:
+                assert await asyncio.get_running_loop().run_in_executor(None, listing_started.wait, 10)
+                responses = await asyncio.wait_for(
+                    asyncio.gather(*(client.get(f'/media/{SOURCE}/top.jpg') for _ in range(4))), timeout=5
+                )
+                assert [response.status_code for response in responses] == [200] * 4
+                # Served while the listing was still blocked, not after it
+                assert not listing.done()
+            finally:
+                release_listing.set()
+            assert (await listing).status_code == 200
+
+    asyncio.run(check())
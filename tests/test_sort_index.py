@@ -0,0 +1,108 @@
+import os
+import random
+
+import pytest
+
+from conftest import write_image
+from media_server import catalog as catalog_module
+from media_server.catalog import MediaCatalog
+from media_server.name_index import MediaFilter
+from media_server.sort_index import SORT_MODES, MediaSortIndex, top_k, write_sort_index
+
+FILTERS = [(None, False), ('img_1*', False), ('IMG_1', True), ('*[0-9]?.png', False), ('nothing', False)]
+
+@pytest.fixture(scope='module')
+def entries():
+    """
+    Catalog entries (name: (size, mtime, content_type)) with many equal sizes and modification times.
+    """
+    random.seed(7)
+    names = [f'img_{i:03d}.jpg' for i in range(300)] + [f'IMG_{i}.png' for i in range(50)] + ['é/ü.jpg', 'a b.jpg']
+    return {name: (random.randrange(20), 1600000000 + random.randrange(30) / 4, 'image/jpeg') for name in names}
+
+def _expected(entries, mode, descending, media_filter, ignore_case):
+    match = MediaFilter(media_filter, ignore_case).match if media_filter else None
+    names = [name for name in entries if not match or match(name)]
+    key = {
+        'name': lambda name: name,
+        'date': lambda name: (entries[name][1], name),
+        'size': lambda name: (entries[name][0], name),
+    }[mode]
+    return sorted(names, key=key, reverse=descending)
+
+@pytest.mark.parametrize('mode', SORT_MODES)
+@pytest.mark.parametrize('descending', [False, True])
+@pytest.mark.parametrize('media_filter,ignore_case', FILTERS)
+def test_orders_match_sorted(tmp_path, entries, mode, descending, media_filter, ignore_case):
+    expected = _expected(entries, mode, descending, media_filter, ignore_case)
+
+    # Top-k selection, which answers first pages before the index is built
+    for k in (1, 10, len(entries)):
+        page, matched = top_k(entries, mode, k, descending, media_filter, ignore_case)
+        assert [name for name, _key in page] == expected[:k]
+        assert matched == len(expected)
+
+    index_file = str(tmp_path / 'catalog.1.sortindex')
+    write_sort_index(index_file, entries, 1)
+    for index in (MediaSortIndex(entries, 1), MediaSortIndex.mapped(index_file)):
+        listing = index.listing(mode, media_filter, ignore_case)
+        names = listing.names(0, len(listing))
+        assert (names[::-1] if descending else names) == expected
+
+def test_old_sort_index_files_removed_on_a_later_build(tmp_path, monkeypatch):
+    folder = tmp_path / 'media'
+    write_image(str(folder / 'a.jpg'))
+    catalog = MediaCatalog(str(tmp_path / 'catalog' / 'TEST.sqlite'), str(folder), ['jpg'], refresh_interval=0)
+
+    def sort_index_files():
+        return sorted(f for f in os.listdir(tmp_path / 'catalog') if f.endswith('.sortindex'))
+
+    first = catalog.sort_index()
+    first_file = os.path.basename(catalog._sort_index_file(first.version))
+
+    # As on Windows, where a file still mapped can't be removed
+    remove = os.remove
+    def remove_unless_mapped(path):
+        if os.path.basename(path) == first_file:
+            raise PermissionError(13, 'The process cannot access the file because it is being used', path)
+        remove(path)
+    monkeypatch.setattr(catalog_module.os, 'remove', remove_unless_mapped)
+
+    write_image(str(folder / 'b.jpg'))
+    catalog.refresh(force=True)
+    second = catalog.sort_index()
+    assert second.version > first.version
+    assert first_file in sort_index_files()
+
+    monkeypatch.setattr(catalog_module.os, 'remove', remove)
+    write_image(str(folder / 'c.jpg'))
+    catalog.refresh(force=True)
+    third = catalog.sort_index()
+    assert sort_index_files() == [os.path.basename(catalog._sort_index_file(third.version))]
+    assert list(third.names) == ['a.jpg', 'b.jpg', 'c.jpg']
+
+def test_catalogs_share_entries_and_indexes(tmp_path):
+    folder = tmp_path / 'media'
+    write_image(str(folder / 'a.jpg'))
+    catalog_file = str(tmp_path / 'catalog' / 'TEST.sqlite')
+    # As two worker processes would, with polling off so nothing is rescanned
+    first, second = (MediaCatalog(catalog_file, str(folder), ['jpg'], refresh_interval=3600) for _ in range(2))
+    assert sorted(first.entries()) == sorted(second.entries()) == ['a.jpg']
+
+    # Entries are read from the catalog file, so one catalog's changes are seen by the other
+    write_image(str(folder / 'Beach 1.jpg'))
+    assert first.apply_events(['Beach 1.jpg'])
+    assert second.entry('Beach 1.jpg') == first.entry('Beach 1.jpg') is not None
+    assert sorted(second.entries()) == ['Beach 1.jpg', 'a.jpg']
+
+    # Both map the same sort and name index files
+    listing = first.sort_index().listing('name', 'beach', ignore_case=True)
+    assert listing.names(0, len(listing)) == ['Beach 1.jpg']
+    index_files = sorted(f for f in os.listdir(tmp_path / 'catalog') if f.endswith('index'))
+    assert [os.path.splitext(f)[1] for f in index_files] == ['.nameindex', '.sortindex']
+    listing = second.sort_index().listing('name', 'beach', ignore_case=True)
+    assert listing.names(0, len(listing)) == ['Beach 1.jpg']
+    assert sorted(f for f in os.listdir(tmp_path / 'catalog') if f.endswith('index')) == index_files
+
+    for catalog in (first, second):
+        catalog.close()
@@ -0,0 +1,47 @@
+import os
+import time
+
+import pytest
+
+from conftest import write_image
+from media_server.catalog import MediaCatalog
+from media_server.watcher import MediaFolderWatcher
+
+@pytest.fixture
+def watcher():
+    if not MediaFolderWatcher.available():
+        pytest.skip('needs inotify (Linux)')
+    try:
+        watcher = MediaFolderWatcher()
+    except OSError as e:
+        pytest.skip(f'inotify unavailable: {e}')
+    yield watcher
+    watcher.close()
+
+def _listed(catalog, version, names):
+    # Waits for the watcher thread to apply the events (which may come in more than one read)
+    deadline = time.monotonic() + 10
+    while sorted(catalog.entries()) != names:
+        assert time.monotonic() < deadline, f'listing not updated to {names}'
+        time.sleep(0.02)
+    assert catalog.version > version
+    assert list(catalog.sort_index().names) == names
+    return catalog.version
+
+def test_watched_folder_changes_update_listing(tmp_path, watcher):
+    folder = tmp_path / 'media'
+    write_image(str(folder / 'a.jpg'))
+    # Polled only once an hour, so any change seen comes from the watcher
+    catalog = MediaCatalog(str(tmp_path / 'catalog' / 'TEST.sqlite'), str(folder), ['jpg'], refresh_interval=3600)
+    assert watcher.watch(catalog) and catalog.watched
+    version = catalog.version
+    assert sorted(catalog.entries()) == ['a.jpg']
+
+    write_image(str(folder / 'b.jpg'))
+    version = _listed(catalog, version, ['a.jpg', 'b.jpg'])
+
+    os.rename(folder / 'a.jpg', folder / 'c.jpg')
+    version = _listed(catalog, version, ['b.jpg', 'c.jpg'])
+
+    os.remove(folder / 'b.jpg')
+    _listed(catalog, version, ['c.jpg'])
@@ -0,0 +1,78 @@
+import io
+import hashlib
+
+from PIL import Image
+from fastapi.testclient import TestClient
+
+from conftest import SOURCE, write_image
+from media_server.wire import (
+    BATCH_NOT_FOUND, BATCH_OK, MEDIA_LIST_ACCEPT, MEDIA_LIST_CONTENT_TYPE,
+    decode_media_list, encode_media_list, iter_batch_records
+)
+
+NESTED = 'trips/2021/beach 1.jpg'
+
+def test_media_batch_round_trip(load_media_server, media_folder):
+    write_image(str(media_folder / 'wide.jpg'), size=(600, 400))
+    media_server = load_media_server()
+    media_files = ['top.jpg', 'missing.jpg', NESTED, 'wide.jpg']
+    with TestClient(media_server.app) as client:
+        for width in (None, 100):
+            response = client.post(f'/media_batch/{SOURCE}', json={'media_files': media_files, 'width': width})
+            assert response.status_code == 200
+            records = list(iter_batch_records(response.content))
+            assert [(status, media) for status, media, *_ in records] == [
+                (BATCH_OK, 'top.jpg'), (BATCH_NOT_FOUND, 'missing.jpg'), (BATCH_OK, NESTED), (BATCH_OK, 'wide.jpg')
+            ]
+            assert records[1][2:] == ('', '', b'')
+
+            for _status, media, content_type, etag, media_bytes in (records[0], records[2], records[3]):
+                # Each record carries what /media serves for the same file and width
+                single = client.get(f'/media/{SOURCE}/{media}', params={'width': width} if width else {})
+                assert media_bytes == single.content
+                assert content_type == single.headers['Content-Type'] == 'image/jpeg'
+                assert etag == single.headers['ETag']
+
+            with Image.open(io.BytesIO(records[3][4])) as wide:
+                assert wide.width == (128 if width else 600)
+            # Narrower than the width bucket, so served as the original
+            assert records[0][4] == (media_folder / 'top.jpg').read_bytes()
+
+# Shared prefixes of every length, past the 255 characters a prefix length holds, and non-ASCII names
+LISTED_NAMES = (
+    [f'IMG_2021{i:04d}.jpg' for i in range(120)]
+    + [f'{hashlib.sha1(str(i).encode()).hexdigest()[:16]}.jpg' for i in range(150)]
+    + ['café.jpg', 'café au lait.jpg', 'ßtraße.jpg', '日本/東京 1.jpg', '日本/東京 2.jpg', '😀.png']
+    + [f'{"deep/" * 60}{"x" * 40}{suffix}.jpg' for suffix in ('a', 'b', 'é')]
+)
+
+def test_media_list_compact_encoding(load_media_server, media_folder):
+    content = (media_folder / 'top.jpg').read_bytes()
+    for name in LISTED_NAMES:
+        path = media_folder / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+
+    listing = {'media_list': sorted(LISTED_NAMES), 'media_filter': '', 'next_cursor': None}
+    assert decode_media_list(encode_media_list(listing)) == listing
+    # Unsorted names (e.g. in date order) share less, but decode the same
+    listing['media_list'] = LISTED_NAMES[::-1]
+    assert decode_media_list(encode_media_list(listing)) == listing
+
+    media_server = load_media_server()
+    encodings = ['gzip'] + (['br'] if media_server.brotli is not None else [])
+    with TestClient(media_server.app) as client:
+        for params in ({}, {'sort_flag': True, 'sort_by_date_flag': False, 'ascending': True}, {'limit': 50}):
+            expected = client.get(f'/media_list/{SOURCE}', params=params, headers={'Accept': 'application/json'})
+            assert expected.headers['Content-Type'] == 'application/json'
+            expected = expected.json()
+            if 'limit' not in params:
+                assert set(LISTED_NAMES) <= set(expected['media_list'])
+
+            for encoding in [None] + encodings:
+                headers = {'Accept': MEDIA_LIST_ACCEPT, 'Accept-Encoding': encoding or 'identity'}
+                response = client.get(f'/media_list/{SOURCE}', params=params, headers=headers)
+                assert response.headers['Content-Type'] == MEDIA_LIST_CONTENT_TYPE
+                assert response.headers.get('Content-Encoding', None) == encoding
+                # The test client undoes the content coding, as requests does for the app
+                assert decode_media_list(response.content) == expected